@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the plugin on synthetic notebooks.
+
+Every scenario generates notebooks (see generate_notebooks.py) in a
+temporary directory and runs py.test on them in a new process, reporting:
+
+    cells/s    tested cells per second of wall time of the whole run
+    msgs/s     iopub messages per second of cell execution
+    collect    time spent collecting the notebooks
+    rss        peak resident memory of the py.test process
+    kernel     peak resident memory of the kernels (Linux)
+
+Everything runs locally; only py.test, IPython and the plugin are needed.
+Extra arguments are passed to py.test, e.g. `--nb-pipeline` or
+`--nb-kernel-pool 2`, to compare options.
+
+Usage: `python bench_notebooks.py [--scale S] [--only NAME] [py.test args]`
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate_notebooks as gen
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# name: (notebooks, cells per notebook, lines per cell, image side,
+#        sanitize rules)
+SCENARIOS = [
+    ('small cells', 4, 100, 1, 0, 0),
+    ('chatty cells', 2, 10, 10000, 0, 0),
+    ('large images', 4, 20, 1, 600, 0),
+    ('many rules', 2, 20, 1000, 0, 200),
+]
+
+# Written in the directory of the notebooks: it records the collection time
+# and the peak memory of the py.test process
+CONFTEST = '''
+import json, resource, time
+
+def pytest_collection(session):
+    session.config._bench_collect = time.time()
+
+def pytest_collection_finish(session):
+    session.config._bench_collect = time.time() - session.config._bench_collect
+
+def pytest_sessionfinish(session):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    with open('bench.json', 'w') as f:
+        json.dump({'collect': session.config._bench_collect, 'rss': rss}, f)
+'''
+
+
+def scaled(n, scale):
+    return max(int(round(n * scale)), 1)
+
+
+def run_scenario(scenario, scale, pytest_args):
+    name, notebooks, cells, lines, image_side, rules = scenario
+    cells, lines = scaled(cells, scale), scaled(lines, scale)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for i in range(notebooks):
+            gen.write_notebook(os.path.join(tmpdir, 'nb%d.ipynb' % i),
+                               gen.make_notebook(cells, lines, image_side))
+        with open(os.path.join(tmpdir, 'conftest.py'), 'w') as f:
+            f.write(CONFTEST)
+        args = [sys.executable, '-m', 'pytest', '-q', '--ipynb',
+                '-p', 'pytest_validate_nb.plugin', '-p', 'no:cacheprovider',
+                '--nb-durations-json', 'durations.json']
+        if rules:
+            with open(os.path.join(tmpdir, 'sanitize.cfg'), 'w') as f:
+                f.write(gen.make_sanitize_file(rules))
+            args += ['--sanitize-with', 'sanitize.cfg']
+
+        env = dict(os.environ)
+        # The plugin of this tree, even if another version is installed
+        env['PYTEST_DISABLE_PLUGIN_AUTOLOAD'] = '1'
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+
+        start = time.time()
+        returncode = subprocess.call(args + pytest_args, env=env, cwd=tmpdir,
+                                     stdout=open(os.devnull, 'w'))
+        wall = time.time() - start
+        if returncode != 0:
+            print('%s: py.test failed (exit code %d)' % (name, returncode))
+            return None
+
+        with open(os.path.join(tmpdir, 'bench.json')) as f:
+            bench = json.load(f)
+        with open(os.path.join(tmpdir, 'durations.json')) as f:
+            records = json.load(f)['notebooks']
+    finally:
+        shutil.rmtree(tmpdir)
+
+    all_cells = [cell for record in records for cell in record['cells']]
+    messages = sum(cell.get('messages', 0) for cell in all_cells)
+    execution = sum(cell.get('execute', 0) for cell in all_cells)
+    kernel_rss = [record.get('kernel_peak_rss') for record in records]
+    kernel_rss = max(kernel_rss) if None not in kernel_rss else None
+    return {'cells': len(all_cells),
+            'wall': wall,
+            'cells/s': len(all_cells) / wall,
+            'msgs/s': messages / execution if execution else 0,
+            'collect': bench['collect'],
+            'rss': bench['rss'],
+            'kernel': kernel_rss}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='multiply the number of cells and lines of '
+                             'every scenario')
+    parser.add_argument('--only', action='append', default=[],
+                        metavar='NAME', help='only run this scenario')
+    args, pytest_args = parser.parse_known_args()
+
+    mb = 1024. ** 2
+    print('%-14s %6s %8s %8s %9s %8s %9s %9s' % (
+        'scenario', 'cells', 'wall', 'cells/s', 'msgs/s', 'collect', 'rss',
+        'kernel'))
+    for scenario in SCENARIOS:
+        if args.only and scenario[0] not in args.only:
+            continue
+        result = run_scenario(scenario, args.scale, pytest_args)
+        if result is None:
+            continue
+        print('%-14s %6d %7.2fs %8.1f %9.0f %7.3fs %7.1fMB %9s' % (
+            scenario[0], result['cells'], result['wall'], result['cells/s'],
+            result['msgs/s'], result['collect'], result['rss'] / mb,
+            '%.1fMB' % (result['kernel'] / mb) if result['kernel'] else '-'))
+
+
+if __name__ == '__main__':
+    main()
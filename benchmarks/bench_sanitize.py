@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the sanitizing of the outputs.
+
+Compares the original implementation (uncompiled patterns applied with
+re.sub in dictionary order) with the Sanitizer, applying the patterns one
+by one and in a single pass, on a multi-megabyte stream output.
+
+Usage: `python bench_sanitize.py [size in MB [number of rules]]`
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pytest_validate_nb.sanitize import Sanitizer, OrderedDict
+
+
+def make_patterns(nrules):
+    """ Typical sanitize rules: dates, times, addresses, plus filler. """
+    patterns = OrderedDict()
+    patterns[r'\d\d\d\d-\d\d-\d\d'] = 'DATESTAMP'
+    patterns[r'\d\d:\d\d:\d\d'] = 'TIMESTAMP'
+    patterns[r'0x[0-9a-fA-F]+'] = 'MEMORY_ADDRESS'
+    for i in range(nrules - len(patterns)):
+        patterns[r'rule%d_[a-z]+' % i] = 'RULE%d' % i
+    return patterns
+
+
+def make_output(size_mb):
+    """ A log-like stream output of about `size_mb` megabytes. """
+    line = ('2015-04-08 14:17:21 INFO: step %06d, object at 0x7f9ca97cc890, '
+            'residual 1.2345e-05\n')
+    nlines = int(size_mb * 1024 ** 2 / len(line % 0))
+    return ''.join(line % i for i in range(nlines))
+
+
+def original_sanitize(patterns, s):
+    for regex, replace in patterns.items():
+        s = re.sub(regex, replace, s)
+    return s
+
+
+def main(size_mb=4, nrules=30, repeat=3):
+    patterns = make_patterns(nrules)
+    # The original implementation kept the patterns in a plain dict
+    dict_patterns = dict(patterns)
+    text = make_output(size_mb)
+
+    sequential = Sanitizer(patterns)
+    single_pass = Sanitizer(patterns, single_pass=True)
+    assert single_pass.merged is not None
+    assert sequential.sanitize(text) == single_pass.sanitize(text)
+
+    cases = [('original (re.sub, dict order)',
+              lambda: original_sanitize(dict_patterns, text)),
+             ('Sanitizer (compiled, sequential)',
+              lambda: sequential.sanitize(text)),
+             ('Sanitizer (compiled, single pass)',
+              lambda: single_pass.sanitize(text))]
+
+    print('%.1f MB of output, %d rules' % (len(text) / 1024. ** 2, nrules))
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        print('%-36s %8.3f s  %8.1f MB/s'
+              % (name, best, len(text) / 1024. ** 2 / best))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Startup overhead of the plugin on py.test runs that do not test notebooks.
+
+Runs a trivial test module with and without the plugin (plugin autoloading
+is disabled in both cases, so only the plugin itself makes a difference)
+and reports the best wall time of several runs. The plugin still uses the
+`path` argument of the pytest_collect_file hook, which recent versions of
+pytest reject: the benchmark then stops with the error of the run.
+
+Usage: `python bench_startup.py [number of runs]`
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def best_time(args, env, cwd, runs):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        process = subprocess.Popen(args, env=env, cwd=cwd,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        times.append(time.time() - start)
+        if process.returncode != 0:
+            sys.exit('%s failed with exit status %d:\n\n%s'
+                     % (' '.join(args), process.returncode,
+                        output.decode('utf-8', 'replace')))
+    return min(times)
+
+
+def pytest_version():
+    import pytest
+    return pytest.__version__
+
+
+def main(runs=10):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmpdir, 'test_trivial.py'), 'w') as f:
+            f.write('def test_trivial():\n    pass\n')
+
+        env = dict(os.environ)
+        env['PYTEST_DISABLE_PLUGIN_AUTOLOAD'] = '1'
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+
+        # Assertion rewriting is not measured (and old versions of pytest
+        # cannot do it with recent versions of Python)
+        pytest = [sys.executable, '-m', 'pytest', '-q', '--assert=plain',
+                  '-p', 'no:cacheprovider']
+        cases = [('py.test', pytest),
+                 ('py.test + plugin', pytest + ['-p', 'pytest_validate_nb.plugin'])]
+
+        print('pytest %s, Python %s' % (pytest_version(),
+                                        sys.version.split()[0]))
+        results = {}
+        for name, args in cases:
+            results[name] = best_time(args, env, tmpdir, runs)
+            print('%-20s %8.3f s' % (name, results[name]))
+
+        print('%-20s %8.3f s' % ('plugin overhead',
+                                 results['py.test + plugin'] - results['py.test']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Generators of synthetic notebooks for the benchmarks.
+
+The notebooks are written with their reference outputs, computed here
+without running a kernel, so they pass when they are tested. They can
+contain:
+
+* any number of code cells, each one printing a number of lines,
+* stored PNG images of a given size in every cell (noise, so they do not
+  compress), which are not compared by default but have to be read,
+* a sanitize file with a number of rules that never match.
+
+Usage: `python generate_notebooks.py <directory> [cells [lines [image side]]]`
+"""
+
+from __future__ import print_function
+
+import base64
+import json
+import os
+import random
+import struct
+import sys
+import zlib
+
+# Printed by every line of the cells: the reference output is computed with
+# the same format, so it is identical to the one of the kernel
+LINE = 'cell %d line %d value %.6f'
+
+CELL_SOURCE = ("for i in range(%(lines)d):\n"
+               "    print('%(line)s' %% (%(cell)d, i, i * 0.5))")
+
+
+def make_png(side, seed=0):
+    """ A valid RGB PNG of side x side pixels of random noise. """
+    rng = random.Random(seed)
+    rows = b''.join(b'\0' + bytearray(rng.getrandbits(8)
+                                      for i in range(3 * side))
+                    for j in range(side))
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) +
+            chunk(b'IEND', b''))
+
+
+def make_cell(cell, lines, image=None):
+    """ Code cell printing `lines` lines, with an optional stored image. """
+    outputs = []
+    if lines:
+        text = ''.join(LINE % (cell, i, i * 0.5) + '\n' for i in range(lines))
+        outputs.append({'output_type': 'stream', 'name': 'stdout',
+                        'text': text})
+    if image is not None:
+        # Only image/png, which is not compared, so the cell still passes
+        outputs.append({'output_type': 'display_data', 'metadata': {},
+                        'data': {'image/png': image}})
+    return {'cell_type': 'code', 'execution_count': cell + 1,
+            'metadata': {}, 'outputs': outputs,
+            'source': CELL_SOURCE % {'lines': lines, 'line': LINE,
+                                     'cell': cell}}
+
+
+def make_notebook(cells, lines=1, image_side=0):
+    """
+    Notebook with `cells` code cells printing `lines` lines each, and a
+    stored image of image_side x image_side pixels per cell if image_side
+    is not 0.
+    """
+    image = None
+    if image_side:
+        image = base64.b64encode(make_png(image_side)).decode('ascii') + '\n'
+    return {'cells': [make_cell(i, lines, image) for i in range(cells)],
+            'metadata': {}, 'nbformat': 4, 'nbformat_minor': 0}
+
+
+def make_sanitize_file(nrules):
+    """ Contents of a sanitize file with `nrules` rules that never match. """
+    return ''.join('regex: never_printed_%d_[a-z]+\nreplace: RULE%d\n\n'
+                   % (i, i) for i in range(nrules))
+
+
+def write_notebook(fname, nb):
+    with open(fname, 'w') as f:
+        json.dump(nb, f, indent=1, sort_keys=True)
+
+
+def main(directory, cells=100, lines=10, image_side=0):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fname = os.path.join(directory, 'synthetic.ipynb')
+    write_notebook(fname, make_notebook(cells, lines, image_side))
+    print(fname)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], *[int(arg) for arg in sys.argv[2:5]])
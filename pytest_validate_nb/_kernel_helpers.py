@@ -0,0 +1,229 @@
+"""
+Helpers run inside the kernels (see RunningKernel.run_helper).
+
+This module is not imported by the plugin: its source is sent to the kernel,
+which loads it as the module `_pytest_validate_nb` (in sys.modules only), so
+nothing is added to the namespace of the notebook. It is called with silent
+executions, which do not change the execution count nor the history, and do
+not trigger the pre_run_cell and post_run_cell events.
+
+"""
+
+import cProfile
+import os
+import sys
+import sysconfig
+import threading
+import warnings
+
+# Callbacks waiting for the next cell, by the name of the helper that
+# registered them: [(event, callback)]
+_next_cell = {}
+
+# Peak of the memory allocated by the last cell traced by trace_next_cell()
+traced_peak = None
+
+
+def profile_next_cell(fname):
+    """
+    Profile the next cell with cProfile and write the stats to `fname`.
+
+    The profiler is enabled and disabled by the pre_run_cell and
+    post_run_cell events of IPython, so only the code of the cell is
+    profiled, not the handling of the requests by the kernel.
+    """
+    profiler = cProfile.Profile()
+
+    def post_run_cell():
+        profiler.disable()
+        profiler.dump_stats(fname)
+
+    on_next_cell('profile', profiler.enable, post_run_cell)
+
+
+def trace_next_cell():
+    """
+    Trace the memory allocated by the next cell with tracemalloc (Python
+    3.4 or newer), storing its peak in `traced_peak`.
+    """
+    import tracemalloc
+    global traced_peak
+    traced_peak = None
+    was_tracing = []
+
+    def pre_run_cell():
+        if tracemalloc.is_tracing():
+            # Traced by the notebook itself: without reset_peak (Python
+            # 3.9) the peak is the one since tracemalloc was started
+            was_tracing.append(True)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+
+    def post_run_cell():
+        global traced_peak
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        if not was_tracing:
+            tracemalloc.stop()
+
+    on_next_cell('trace', pre_run_cell, post_run_cell)
+
+
+def on_next_cell(name, pre, post):
+    """
+    Call `pre` before and `post` after the next cell, and then forget them.
+    Callbacks registered before under the same `name` are dropped, in case
+    their cell never ran (e.g. it was interrupted before starting).
+    """
+    events = get_ipython().events
+    _unregister(events, name)
+
+    def pre_run_cell(*args):
+        pre()
+
+    def post_run_cell(*args):
+        _unregister(events, name)
+        post()
+
+    _next_cell[name] = [('pre_run_cell', pre_run_cell),
+                        ('post_run_cell', post_run_cell)]
+    for event, callback in _next_cell[name]:
+        events.register(event, callback)
+
+
+def _unregister(events, name):
+    for event, callback in _next_cell.pop(name, []):
+        try:
+            events.unregister(event, callback)
+        except ValueError:
+            pass
+
+
+# State of the fresh kernel, restored by reset()
+_baseline = {}
+
+
+def snapshot():
+    """
+    Remember the state of a fresh kernel, before it runs any notebook.
+    """
+    shell = get_ipython()
+    _baseline.update(modules=set(sys.modules),
+                     path=list(sys.path),
+                     cwd=os.getcwd(),
+                     environ=dict(os.environ),
+                     names=set(shell.user_ns),
+                     threads=threading.active_count(),
+                     callbacks=_count_callbacks(shell),
+                     rc=_get_rc())
+
+
+def reset():
+    """
+    Bring the kernel back to the state of snapshot() after a notebook:
+
+    * the namespace is reset (%reset -f) and the execution count restarts,
+    * sys.path, the working directory and the environment are restored,
+    * the figures of matplotlib are closed and its rcParams restored,
+    * the modules imported by the notebook are removed from sys.modules,
+      except the ones from the standard library and the installed packages
+      (extension modules cannot be unloaded, and they are the imports that
+      take time); those stay loaded for the next notebooks.
+
+    Raises RuntimeError if the notebook left something that was not undone
+    (names in the namespace, running threads, event callbacks), in which
+    case the kernel has to be restarted.
+    """
+    shell = get_ipython()
+    # As %reset -f, but starting a new session of the history, so the
+    # execution count starts again from 1
+    shell.reset(new_session=True)
+    sys.path[:] = _baseline['path']
+    os.chdir(_baseline['cwd'])
+    os.environ.clear()
+    os.environ.update(_baseline['environ'])
+    _reset_matplotlib()
+    _unload_modules()
+
+    leaks = []
+    names = set(shell.user_ns) - _baseline['names']
+    if names:
+        leaks.append('names %s' % ', '.join(sorted(names)))
+    threads = threading.active_count() - _baseline['threads']
+    if threads > 0:
+        leaks.append('%d threads' % threads)
+    callbacks = _count_callbacks(shell) - _baseline['callbacks']
+    if callbacks > 0:
+        leaks.append('%d event callbacks' % callbacks)
+    if leaks:
+        raise RuntimeError('the notebook left ' + '; '.join(leaks))
+
+
+def _count_callbacks(shell):
+    pending = sum(len(callbacks) for callbacks in _next_cell.values())
+    return sum(len(callbacks)
+               for callbacks in shell.events.callbacks.values()) - pending
+
+
+def _get_rc():
+    matplotlib = sys.modules.get('matplotlib')
+    if matplotlib is None:
+        return None
+    with warnings.catch_warnings():
+        # Reading deprecated parameters warns
+        warnings.simplefilter('ignore')
+        return dict(matplotlib.rcParams)
+
+
+def _reset_matplotlib():
+    pyplot = sys.modules.get('matplotlib.pyplot')
+    if pyplot is not None:
+        pyplot.close('all')
+    matplotlib = sys.modules.get('matplotlib')
+    if matplotlib is None:
+        return
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if _baseline['rc'] is None:
+            # Imported by the notebook: it stays loaded with the defaults
+            matplotlib.rcdefaults()
+            _baseline['rc'] = _get_rc()
+        else:
+            matplotlib.rcParams.update(_baseline['rc'])
+
+
+def _library_paths():
+    paths = set()
+    for name in ('stdlib', 'platstdlib', 'purelib', 'platlib'):
+        path = sysconfig.get_paths().get(name)
+        if path:
+            paths.add(os.path.realpath(path))
+    try:
+        import site
+        paths.update(os.path.realpath(path) for path in
+                     site.getsitepackages() + [site.getusersitepackages()])
+    except AttributeError:
+        # site of virtualenvs with Python 2
+        pass
+    return tuple(path + os.sep for path in paths)
+
+
+def _unload_modules():
+    libraries = _library_paths()
+    for name in list(sys.modules):
+        if name in _baseline['modules']:
+            continue
+        fname = getattr(sys.modules[name], '__file__', None)
+        if (sys.modules[name] is not None and
+                (fname is None or
+                 os.path.realpath(fname).startswith(libraries))):
+            # Built-in, namespace package or installed: kept loaded
+            _baseline['modules'].add(name)
+        else:
+            del sys.modules[name]
+
+
+def get_ipython():
+    from IPython import get_ipython
+    return get_ipython()
@@ -0,0 +1,78 @@
+"""
+Zygote process forking ready kernels (see zygote.py).
+
+It is run as a script by the Zygote class, so it does not import the plugin.
+The commands are JSON lines on stdin and the answers JSON lines on stdout:
+
+    {"preload": "<code>"}  ->  {"ok": true}  or  {"error": "<traceback>"}
+    {"fork": [<argv>]}     ->  {"pid": <pid of the new kernel>}
+
+The zygote must not start threads nor open ZMQ sockets: they would not
+survive the fork. Only the imports are shared with the kernels.
+"""
+
+import json
+import os
+import signal
+import sys
+import traceback
+
+
+def import_kernel_app():
+    try:
+        from ipykernel.kernelapp import IPKernelApp
+    except ImportError:
+        from IPython.kernel.zmq.kernelapp import IPKernelApp
+    return IPKernelApp
+
+
+def run_kernel(argv):
+    """ Body of a forked kernel. Never returns. """
+    try:
+        # A session of its own, so signals sent to the process group of the
+        # kernel (e.g. interrupts) do not reach the zygote
+        os.setsid()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # The kernel exits when its parent, the zygote, is gone
+        os.environ['JPY_PARENT_PID'] = str(os.getppid())
+        # The pipes of the zygote belong to the zygote
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        import_kernel_app().launch_instance(argv=argv)
+    finally:
+        os._exit(0)
+
+
+def answer(**kwargs):
+    sys.stdout.write(json.dumps(kwargs) + '\n')
+    sys.stdout.flush()
+
+
+def main():
+    # The kernels are reaped automatically, so they do not become zombies
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # Interrupts are for the kernels, not for the zygote
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import_kernel_app()
+
+    for line in iter(sys.stdin.readline, ''):
+        command = json.loads(line)
+        if 'preload' in command:
+            try:
+                exec(compile(command['preload'], '<preload>', 'exec'), {})
+            except Exception:
+                answer(error=traceback.format_exc())
+            else:
+                answer(ok=True)
+        elif 'fork' in command:
+            pid = os.fork()
+            if pid == 0:
+                run_kernel(command['fork'])
+            answer(pid=pid)
+
+
+if __name__ == '__main__':
+    main()
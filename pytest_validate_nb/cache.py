@@ -0,0 +1,75 @@
+"""
+Cache of the notebooks that passed (--nb-cache-dir).
+
+A notebook is identified by a hash of everything that determines the result
+of its tests: the code of the cells, the sanitized reference outputs and the
+hashes of the reference images, the sanitize patterns, the comparison
+options of the session and of the notebook metadata, and a fingerprint of
+the environment declared by the user (e.g. a lockfile or a list of package
+versions).
+
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+def get_environment_fingerprint(entries):
+    """
+    Hash of the environment declared with --nb-cache-env. Every entry is
+    either a file (e.g. a lockfile), whose contents are hashed, or a plain
+    string (e.g. 'numpy==1.9.2'). The Python version is always included.
+    """
+    h = hashlib.sha1(sys.version.encode('utf-8'))
+    for entry in entries:
+        if os.path.isfile(entry):
+            with open(entry, 'rb') as f:
+                h.update(f.read())
+        else:
+            h.update(entry.encode('utf-8'))
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Directory with one file per notebook key that passed.
+    """
+    def __init__(self, path, environment=''):
+        self.path = path
+        self.environment = environment
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get_key(self, cells, fingerprint, options=None):
+        """
+        Key of a notebook, from what determines the result of every cell
+        (e.g. its source, reference digest and metadata options), the
+        fingerprint of the sanitize patterns and the `options` of the
+        session and notebook. The cells and options must be serializable to
+        JSON.
+        """
+        h = hashlib.sha1()
+        h.update(self.environment.encode('utf-8'))
+        h.update(fingerprint.encode('utf-8'))
+        h.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+        for cell in cells:
+            h.update(json.dumps(list(cell), sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def _fname(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def has_passed(self, key):
+        return os.path.exists(self._fname(key))
+
+    def record_pass(self, key, notebook):
+        """ Remember that the notebook with the given key passed. """
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'notebook': notebook, 'time': time.time()}, f)
+        # Atomic, so concurrent runs sharing the directory are safe
+        os.rename(tmpname, self._fname(key))
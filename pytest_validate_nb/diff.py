@@ -0,0 +1,189 @@
+"""
+Line diff of mismatching outputs, for the failure reports.
+
+The lines are replaced by integers (every distinct line gets its own number,
+so lines are compared by their hash only once) and matched with the
+patience diff algorithm: the lines that appear exactly once in both texts
+are matched first, in order (longest increasing subsequence), and the
+regions between them are diffed in the same way. This is O(n log n) in the
+number of lines, also for outputs with hundreds of thousands of lines,
+unlike difflib, which is quadratic in the worst case. Regions without unique
+lines are reported as replaced.
+
+"""
+
+from bisect import bisect_left
+
+
+def hash_lines(a, b):
+    """ Replace the lines of `a` and `b` by integers. """
+    numbers = {}
+    return ([numbers.setdefault(line, len(numbers)) for line in a],
+            [numbers.setdefault(line, len(numbers)) for line in b])
+
+
+def unique_matches(a, alo, ahi, b, blo, bhi):
+    """
+    Longest increasing sequence of (i, j) pairs such that a[i] == b[j] is a
+    line that appears exactly once in a[alo:ahi] and in b[blo:bhi].
+    """
+    counts = {}
+    for i in range(alo, ahi):
+        count, _ = counts.get(a[i], (0, None))
+        counts[a[i]] = (count + 1, i)
+    b_counts = {}
+    for j in range(blo, bhi):
+        count, _ = b_counts.get(b[j], (0, None))
+        b_counts[b[j]] = (count + 1, j)
+
+    pairs = []
+    for line, (count, i) in counts.items():
+        if count == 1 and b_counts.get(line, (0, None))[0] == 1:
+            pairs.append((i, b_counts[line][1]))
+    pairs.sort()
+
+    # Patience sorting of the j's: tops[k] is the index in `pairs` of the
+    # smallest last element of an increasing sequence of length k + 1
+    tops = []
+    top_js = []
+    previous = [None] * len(pairs)
+    for n, (i, j) in enumerate(pairs):
+        k = bisect_left(top_js, j)
+        if k > 0:
+            previous[n] = tops[k - 1]
+        if k == len(tops):
+            tops.append(n)
+            top_js.append(j)
+        else:
+            tops[k] = n
+            top_js[k] = j
+
+    sequence = []
+    n = tops[-1] if tops else None
+    while n is not None:
+        sequence.append(pairs[n])
+        n = previous[n]
+    sequence.reverse()
+    return sequence
+
+
+def matching_lines(a, b):
+    """ Sorted list of the (i, j) pairs of matching lines of `a` and `b`. """
+    matches = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        # Common prefix and suffix
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = unique_matches(a, alo, ahi, b, blo, bhi)
+        if not anchors:
+            # Reported as replaced
+            continue
+        for i, j in anchors:
+            stack.append((alo, i, blo, j))
+            matches.append((i, j))
+            alo, blo = i + 1, j + 1
+        stack.append((alo, ahi, blo, bhi))
+    matches.sort()
+    return matches
+
+
+def get_opcodes(a, b):
+    """
+    Opcodes as the ones of difflib.SequenceMatcher.get_opcodes, for the
+    lists of lines `a` and `b`.
+    """
+    ha, hb = hash_lines(a, b)
+    opcodes = []
+    i = j = 0
+    for mi, mj in matching_lines(ha, hb) + [(len(a), len(b))]:
+        if i < mi or j < mj:
+            tag = 'replace'
+            if i == mi:
+                tag = 'insert'
+            elif j == mj:
+                tag = 'delete'
+            opcodes.append((tag, i, mi, j, mj))
+        if mi < len(a):
+            if opcodes and opcodes[-1][0] == 'equal':
+                opcodes[-1] = ('equal', opcodes[-1][1], mi + 1,
+                               opcodes[-1][3], mj + 1)
+            else:
+                opcodes.append(('equal', mi, mi + 1, mj, mj + 1))
+        i, j = mi + 1, mj + 1
+    return opcodes
+
+
+def group_opcodes(opcodes, n=3):
+    """
+    Hunks of the opcodes with up to `n` lines of context (as
+    difflib.SequenceMatcher.get_grouped_opcodes).
+    """
+    codes = list(opcodes)
+    if not codes:
+        return []
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    groups = []
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            groups.append(group)
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        groups.append(group)
+    return groups
+
+
+def unified_diff(ref, test, n=3, max_lines=None):
+    """
+    *Arguments*
+
+    ref, test:  strings
+
+    n:  number of lines of context around the changes
+
+    max_lines:  maximum number of lines of the diff (None for no limit)
+
+    *Returns*
+
+    The list of lines of the unified diff of `ref` (-) and `test` (+).
+
+    """
+    a = ref.splitlines()
+    b = test.splitlines()
+    lines = []
+    for group in group_opcodes(get_opcodes(a, b), n):
+        first, last = group[0], group[-1]
+        lines.append('@@ -%d,%d +%d,%d @@' % (first[1] + 1, last[2] - first[1],
+                                              first[3] + 1, last[4] - first[3]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                lines.extend(' ' + line for line in a[i1:i2])
+                continue
+            lines.extend('-' + line for line in a[i1:i2])
+            lines.extend('+' + line for line in b[j1:j2])
+
+    if max_lines is not None and len(lines) > max_lines:
+        omitted = len(lines) - max_lines
+        lines = lines[:max_lines]
+        lines.append('... (%d more lines of the diff omitted)' % omitted)
+    return lines
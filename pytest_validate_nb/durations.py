@@ -0,0 +1,161 @@
+"""
+Timing of the notebooks and cells (--nb-durations, --nb-durations-json).
+
+The notebooks (IPyNbFile) and cells (IPyNbCell) always record the duration
+of their phases in a `timings` dictionary, since reading a clock costs much
+less than anything they do. The Durations object of the session only
+collects and reports them.
+
+Phases of a notebook:
+
+    read          reading the notebook at collection time
+    kernel_start  getting a running kernel (new, forked or from the pool)
+    kernel_boot   starting the kernel process, when it was started for the
+                  notebook (the pool starts its kernels in the background)
+    setup         whole setup of the notebook (includes kernel_start)
+    kernel_stop   giving the kernel back to the pool or stopping it
+    teardown      whole teardown of the notebook (includes kernel_stop)
+
+and its `kernel_peak_rss` (in bytes, Linux only; the peak of the notebook
+when the kernel comes from a pool, on Linux 4.0 or newer).
+
+Phases of a cell:
+
+    execute   from sending the cell to the 'idle' status of the kernel,
+              reading the iopub messages of the cell
+    drain     waiting for the execute_reply after the 'idle' status
+    sanitize  sanitizing the outputs of the execution
+    compare   comparing the outputs (includes sanitize)
+
+and the number of iopub `messages` of the cell. The memory of the kernel is
+also recorded after every cell (in bytes, when it is known):
+
+    rss          resident memory of the kernel
+    rss_growth   growth of the resident memory during the cell
+    peak_rss     peak resident memory of the kernel so far in the notebook
+    traced_peak  peak of the memory allocated by the cell (--nb-tracemalloc)
+
+"""
+
+import json
+import time
+
+# High resolution clock (time.perf_counter is not in Python 2)
+timer = getattr(time, 'perf_counter', time.time)
+
+NOTEBOOK_PHASES = ('read', 'kernel_start', 'setup', 'teardown')
+CELL_PHASES = ('execute', 'drain', 'sanitize', 'compare')
+
+
+class Timer(object):
+    """
+    Context manager adding the time spent in its block to `timings[name]`.
+    """
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings[self.name] = (self.timings.get(self.name, 0) +
+                                   timer() - self.start)
+        return False
+
+
+def format_seconds(seconds):
+    return '%8.3fs' % seconds
+
+
+def format_bytes(n):
+    if n is None:
+        return '%9s' % '-'
+    return '%7.1fMB' % (n / 1024. ** 2)
+
+
+class Durations(object):
+    """
+    Notebooks of the session, with their timings and the ones of their
+    cells.
+    """
+    def __init__(self):
+        self.notebooks = []
+
+    def add(self, nbfile):
+        self.notebooks.append(nbfile)
+
+    def records(self):
+        """ Timings of the notebooks and their cells, as plain data. """
+        records = []
+        for nbfile in self.notebooks:
+            # Whether all the cells of the notebook ran (a notebook stopped
+            # early or run with a selection of cells is shorter)
+            complete = (not nbfile.cached_pass and
+                        nbfile.skip_reason is None and
+                        len(nbfile.selected_cells or []) == nbfile.ncells)
+            record = {'notebook': nbfile.nodeid,
+                      'cached': nbfile.cached_pass,
+                      'complete': complete,
+                      'cells': []}
+            record.update(nbfile.timings)
+            for cell in nbfile.selected_cells or []:
+                cell_record = {'cell': cell.cell_num, 'index': cell.index}
+                cell_record.update(cell.timings)
+                record['cells'].append(cell_record)
+            # With --nb-workers the kernel is not started in the setup
+            phases = ('setup', 'teardown')
+            if nbfile.background is not None:
+                phases += ('kernel_start',)
+            record['total'] = (sum(record.get(phase, 0) for phase in phases) +
+                               sum(cell.get('execute', 0) +
+                                   cell.get('drain', 0) +
+                                   cell.get('compare', 0)
+                                   for cell in record['cells']))
+            records.append(record)
+        return records
+
+    def summary(self, n=None):
+        """
+        Lines of the report of the `n` slowest notebooks and cells (all of
+        them if `n` is None or 0).
+        """
+        records = self.records()
+        notebooks = sorted(records, key=lambda r: r['total'], reverse=True)
+        cells = sorted([(cell, record['notebook'])
+                        for record in records for cell in record['cells']],
+                       key=lambda c: c[0].get('execute', 0) +
+                       c[0].get('drain', 0) + c[0].get('compare', 0),
+                       reverse=True)
+        if n:
+            notebooks, cells = notebooks[:n], cells[:n]
+
+        lines = ['%9s %9s %9s %9s %9s %9s  %s' % (
+            'total', 'read', 'kernel', 'setup', 'teardown', 'peak rss',
+            'notebook')]
+        for record in notebooks:
+            lines.append(' '.join(
+                [format_seconds(record['total'])] +
+                [format_seconds(record.get(phase, 0))
+                 for phase in NOTEBOOK_PHASES] +
+                [format_bytes(record.get('kernel_peak_rss'))]) +
+                '  ' + record['notebook'])
+
+        lines.append('')
+        lines.append('%9s %9s %9s %9s %9s %9s %9s  %s' % (
+            'execute', 'drain', 'sanitize', 'compare', 'messages', 'rss +',
+            'traced', 'cell'))
+        for cell, notebook in cells:
+            lines.append(' '.join(
+                [format_seconds(cell.get(phase, 0)) for phase in CELL_PHASES] +
+                ['%9d' % cell.get('messages', 0),
+                 format_bytes(cell.get('rss_growth')),
+                 format_bytes(cell.get('traced_peak'))]) +
+                '  %s::cell %d' % (notebook, cell['cell']))
+        return lines
+
+    def write_json(self, fname):
+        with open(fname, 'w') as f:
+            json.dump({'version': 1, 'notebooks': self.records()}, f,
+                      indent=1, sort_keys=True)
@@ -0,0 +1,115 @@
+"""
+Comparison of the image/png outputs (--nb-compare-images).
+
+The images are compared in steps of increasing cost, and the comparison
+stops at the first one that decides:
+
+1. Identical payloads (or payload hashes, see nbreader) match, without
+   decoding the images.
+2. The images are decoded with PIL. If `max_hash_distance` is given, their
+   difference hashes (dHash, a perceptual hash of the gradients of a tiny
+   grayscale version of the image) are compared: images whose hashes differ
+   by more than `max_hash_distance` bits (out of 64) are different without
+   comparing their pixels. Small changes of nearly uniform images (e.g.
+   anti-aliasing) can flip many bits, so this step is only done on demand.
+3. The pixels are compared with NumPy: differences of a channel up to
+   `pixel_tol` (0-255) are ignored and the root mean square of the remaining
+   differences must not be larger than `rms_tol`.
+
+PIL (Pillow) and NumPy are only imported when two images must be decoded.
+
+"""
+
+import base64
+import io
+
+from .nbreader import HASH_PREFIX, hash_strings
+
+def payload_hash(b64):
+    return HASH_PREFIX + hash_strings(b64).hexdigest()
+
+
+def decode_png(b64):
+    """ Return the PIL RGBA image of a base64-encoded PNG. """
+    from PIL import Image
+    image = Image.open(io.BytesIO(base64.b64decode(''.join(b64.split()))))
+    return image.convert('RGBA')
+
+
+def dhash(image, size=8):
+    """
+    Difference hash of a PIL image: one bit per pixel of a (size + 1, size)
+    grayscale thumbnail, set when the pixel is brighter than the next one.
+    """
+    small = image.convert('L').resize((size + 1, size))
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            bits = (bits << 1) | (left > pixels[row * (size + 1) + col + 1])
+    return bits
+
+
+def hash_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def compare_pixels(test, ref, pixel_tol=0, rms_tol=0.):
+    """
+    Compare two PIL images pixel by pixel, returning None if they match or
+    a description of the difference.
+    """
+    import numpy
+    if test.size != ref.size:
+        return ('the image is %dx%d, the reference is %dx%d'
+                % (test.size + ref.size))
+
+    diff = numpy.abs(numpy.asarray(test, dtype=numpy.int16) -
+                     numpy.asarray(ref, dtype=numpy.int16))
+    diff[diff <= pixel_tol] = 0
+    rms = numpy.sqrt(numpy.mean(diff.astype(float) ** 2))
+    if rms > rms_tol:
+        return ('%d pixels differ by more than %d, RMS difference %.4g > %g'
+                % (numpy.count_nonzero(diff.max(axis=-1)), pixel_tol,
+                   rms, rms_tol))
+    return None
+
+
+def compare_png(test, ref, pixel_tol=0, rms_tol=0., load_ref=None,
+                max_hash_distance=None):
+    """
+    *Arguments*
+
+    test:  base64-encoded PNG produced by the execution
+
+    ref:  base64-encoded reference PNG, or the hash of it as read by
+        nbreader.read_notebook
+
+    pixel_tol, rms_tol:  tolerances (see the module docstring)
+
+    load_ref:  function returning the reference PNG when `ref` is a hash
+
+    max_hash_distance:  if given, the images whose dHashes differ by more
+        bits are different, without comparing their pixels
+
+    *Returns*
+
+    None if the images match, or a description of the difference.
+
+    """
+    if ref.startswith(HASH_PREFIX):
+        if payload_hash(test) == ref:
+            return None
+        ref = load_ref()
+    if ''.join(test.split()) == ''.join(ref.split()):
+        return None
+
+    test_image, ref_image = decode_png(test), decode_png(ref)
+    if max_hash_distance is not None:
+        distance = hash_distance(dhash(test_image), dhash(ref_image))
+        if distance > max_hash_distance:
+            return ('the images are different (%d bits of their perceptual '
+                    'hashes differ, more than %d)'
+                    % (distance, max_hash_distance))
+    return compare_pixels(test_image, ref_image, pixel_tol, rms_tol)
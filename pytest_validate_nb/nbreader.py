@@ -0,0 +1,484 @@
+"""
+Reading of the notebooks at collection time.
+
+Only the code of the cells and the outputs that are compared are needed, but
+a notebook may be mostly embedded images. The notebook is therefore parsed as
+a stream of JSON events (with ijson, if it is installed), one cell at a time,
+and the payloads under the `hashed` keys (e.g. 'image/png' or 'traceback')
+are replaced by a hash of their contents as they are read. The long strings
+of the payloads (e.g. a base64 image) are hashed block by block before they
+reach ijson (see filter_payloads), so the memory used to read a notebook
+does not grow with the size of its images. Without ijson the whole file is
+loaded with the json module and reduced in the same way, so at least the
+payloads are not kept for the whole session.
+
+"""
+
+import hashlib
+import json
+import os
+import re
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+try:
+    from decimal import Decimal
+except ImportError:
+    Decimal = float
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+# Limits of the size of the blocks read by ijson (see buffer_size). The
+# notebooks are read in blocks of MIN_BUF_SIZE, and their payloads of at
+# least MIN_BUF_SIZE bytes are hashed by filter_payloads
+MIN_BUF_SIZE = 1 << 20
+MAX_BUF_SIZE = 1 << 26
+
+# Prefix of the strings that replace the hashed payloads
+HASH_PREFIX = 'sha1:'
+
+# A complete escape sequence in a JSON string (surrogate pairs are whole)
+ESCAPE = re.compile(br'\\(?:u[dD][89abAB][0-9a-fA-F]{2}\\u[0-9a-fA-F]{4}|'
+                    br'u(?![dD][89abAB])[0-9a-fA-F]{4}|[^u])')
+
+# A colon and the start of a string, after a key (see filter_payloads)
+MAX_SPACE = 64
+KEY_VALUE = re.compile(br'\s{0,%d}:\s{0,%d}"' % (MAX_SPACE, MAX_SPACE))
+
+# Longest escape sequence in a JSON string, a surrogate pair
+MAX_ESCAPE = len(r'\ud83d\ude00')
+
+# (ijson prefix of a map, key) of the values that may be hashed
+CELL = 'cells.item'
+OUTPUT = 'cells.item.outputs.item'
+DATA = 'cells.item.outputs.item.data'
+
+
+def _encode(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+class HashingReader(object):
+    """
+    File wrapper computing the sha1 of everything that is read from it.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha1.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+
+class ChunkReader(object):
+    """
+    File-like object reading the chunks of bytes of the iterator `chunks`.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = []
+        self.size = 0
+
+    def read(self, size=-1):
+        while size < 0 or self.size < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            self.pending.append(chunk)
+            self.size += len(chunk)
+        data = b''.join(self.pending)
+        if 0 <= size < len(data):
+            data, rest = data[:size], data[size:]
+        else:
+            rest = b''
+        self.pending = [rest]
+        self.size = len(rest)
+        return data
+
+
+def string_end(data, pos):
+    """
+    Index of the quote ending the JSON string of `data` that goes on at
+    `pos`, out of an escape sequence, or -1 if it ends after `data`.
+    """
+    quote = data.find(b'"', pos)
+    while quote >= 0:
+        # The quote is escaped if an odd number of backslashes precede it
+        i = quote
+        while i > pos and data[i - 1:i] == b'\\':
+            i -= 1
+        if (quote - i) % 2 == 0:
+            return quote
+        quote = data.find(b'"', quote + 1)
+    return -1
+
+
+def escapes_end(data, pos):
+    """
+    The end of the complete escape sequences of the string `data[pos:]`,
+    which begins out of an escape sequence: `data` without its last escape
+    sequence if it is cut (e.g. by the end of a block).
+    """
+    end = len(data)
+    i = data.find(b'\\', max(pos, end - 2 * MAX_ESCAPE))
+    if i < 0:
+        return end
+    j = i
+    while j > pos and data[j - 1:j] == b'\\':
+        j -= 1
+    # With an odd number of backslashes before it, the backslash is escaped
+    i -= (i - j) % 2
+    while i >= 0:
+        match = ESCAPE.match(data, i)
+        if match is None and end - i < MAX_ESCAPE:
+            return i
+        i = data.find(b'\\', i + 2 if match is None else match.end())
+    return end
+
+
+def decode_escape(match):
+    """ utf-8 bytes of the JSON escape sequence of the re `match`. """
+    return json.loads('"%s"' % match.group().decode('ascii')).encode('utf-8')
+
+
+def unescape(data):
+    """
+    utf-8 bytes of the part `data` of a JSON string, made of whole escape
+    sequences.
+    """
+    backslashes = data.count(b'\\')
+    if not backslashes:
+        return data
+    if backslashes == data.count(b'\\n'):
+        # Only newlines, e.g. in the base64 images of the older versions of
+        # IPython
+        return data.replace(b'\\n', b'\n')
+    return ESCAPE.sub(decode_escape, data)
+
+
+def filter_payloads(f, keys, min_size=MIN_BUF_SIZE,
+                    block_size=MIN_BUF_SIZE):
+    """
+    Generator of the contents of the JSON file `f`, in which the string
+    values of at least `min_size` bytes of the `keys` (e.g. "image/png") are
+    replaced by the string with their hash (see hash_strings).
+
+    The strings are hashed as they are read, in blocks of `block_size`
+    bytes, so a payload is never held in memory as a whole. The values that
+    are lists or maps, or shorter strings, are left to iter_events.
+
+    In valid JSON, a key between quotes that are not escaped can only be a
+    string, so the file is not tokenized: the keys are found with a plain
+    search, which is much faster in Python.
+    """
+    keys = [json.dumps(key).encode('utf-8') for key in keys]
+    longest_key = max([len(key) for key in keys] or [0])
+    data = f.read(block_size)
+    # data[:pos] is searched and data[:mark] is yielded, and data begins
+    # `offset` bytes into the file
+    pos = mark = offset = 0
+    # The next position of each key in `data` (-1 if there is none), only
+    # searched again when it is passed
+    found = {}
+    while data:
+        for key in keys:
+            i = found.get(key)
+            if i is None or 0 <= i < pos:
+                found[key] = data.find(key, pos)
+        start, key = min([(i, key) for key, i in found.items() if i >= 0] or
+                         [(-1, None)])
+        if start < 0 or len(data) - start < longest_key + MAX_SPACE:
+            # Read the next block, keeping what may be the start of a key
+            more = f.read(block_size)
+            if more:
+                keep = max(pos, len(data) - longest_key - MAX_SPACE
+                           if start < 0 else start - 1)
+                yield data[mark:keep]
+                data, pos, mark = data[keep:] + more, 0, 0
+                offset += keep
+                found = {}
+                continue
+            if start < 0:
+                yield data[mark:]
+                return
+
+        value = KEY_VALUE.match(data, start + len(key))
+        # Is the key out of a string (its first quote is not escaped)? The
+        # backslashes may be in the previous block, then it is not hashed
+        i = start
+        while i > 0 and data[i - 1:i] == b'\\':
+            i -= 1
+        if value is None or i == 0 and offset > 0 or (start - i) % 2:
+            pos = start + 1
+            continue
+
+        # Read the string as a whole if it is short
+        start = value.end() - 1
+        end = string_end(data, start + 1)
+        while end < 0 and len(data) - start < min_size + 2:
+            more = f.read(block_size)
+            if not more:
+                break
+            yield data[mark:start]
+            offset += start
+            data, start, mark = data[start:] + more, 0, 0
+            found = {}
+            end = string_end(data, start + 1)
+        if 0 <= end < start + min_size + 1:
+            pos = end + 1
+            continue
+
+        # Hash the string, block by block
+        yield data[mark:start]
+        h = hashlib.sha1()
+        pos = start + 1
+        while end < 0:
+            more = f.read(block_size)
+            if not more:
+                raise ValueError('Unterminated string in the notebook')
+            cut = escapes_end(data, pos)
+            h.update(unescape(data[pos:cut]))
+            data, pos = data[cut:] + more, 0
+            offset += cut
+            found = {}
+            end = string_end(data, pos)
+        h.update(unescape(data[pos:end]))
+        yield json.dumps(HASH_PREFIX + h.hexdigest()).encode('utf-8')
+        pos = mark = end + 1
+
+
+def buffer_size(f):
+    """
+    Size of the blocks in which ijson reads the whole file `f` (see
+    read_cell): its size, between MIN_BUF_SIZE and MAX_BUF_SIZE bytes.
+
+    ijson (at least its C backend) copies the part of a string read so far
+    for every new block, so reading a string takes a time quadratic in its
+    number of blocks. With its default blocks of 64 KB, a notebook with
+    images of several MB takes seconds to read instead of a fraction.
+    """
+    try:
+        size = os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, OSError, IOError, ValueError):
+        # Not a real file, e.g. io.BytesIO
+        try:
+            position = f.tell()
+            size = f.seek(0, os.SEEK_END) - position
+            f.seek(position)
+        except (AttributeError, OSError, IOError, ValueError, TypeError):
+            return MIN_BUF_SIZE
+    return int(min(max(size, MIN_BUF_SIZE), MAX_BUF_SIZE))
+
+
+def hash_strings(obj, h=None):
+    """
+    Update the sha1 `h` with the strings in `obj` (a string or a list or
+    dict of them), in order, and return it.
+    """
+    if h is None:
+        h = hashlib.sha1()
+    if isinstance(obj, string_types):
+        h.update(_encode(obj))
+    elif isinstance(obj, list):
+        for item in obj:
+            hash_strings(item, h)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            hash_strings(item, h)
+    return h
+
+
+def hashed_keys(keys):
+    """
+    Map from the (ijson prefix, key) pairs to hash, for the given output
+    keys (mime types or fields of the outputs).
+    """
+    pairs = set([(CELL, 'attachments')])
+    for key in keys:
+        pairs.add((DATA, key))
+        pairs.add((OUTPUT, key))
+    return pairs
+
+
+def reduce_cell(cell, hashed):
+    """
+    Join the multiline strings of a cell and replace its payloads under
+    the `hashed` pairs (see `hashed_keys`) by their hash, in place.
+    """
+    def reduce_map(obj, prefix):
+        for key, value in obj.items():
+            if (prefix, key) in hashed and not (
+                    isinstance(value, string_types) and
+                    value.startswith(HASH_PREFIX)):
+                obj[key] = HASH_PREFIX + hash_strings(value).hexdigest()
+
+    reduce_map(cell, CELL)
+    if isinstance(cell.get('source'), list):
+        cell['source'] = ''.join(cell['source'])
+    if cell.get('cell_type') != 'code':
+        # Only the code cells are run and compared
+        cell['source'] = ''
+        return cell
+
+    for output in cell.get('outputs', []):
+        reduce_map(output, OUTPUT)
+        if isinstance(output.get('text'), list):
+            output['text'] = ''.join(output['text'])
+        data = output.get('data', {})
+        reduce_map(data, DATA)
+        for mime, value in data.items():
+            if isinstance(value, list):
+                data[mime] = ''.join(value)
+    return cell
+
+
+def iter_events(events, hashed):
+    """
+    Filter the ijson `events`, replacing the values under the `hashed`
+    pairs by the string with their hash, without building them.
+    """
+    events = iter(events)
+    for prefix, event, value in events:
+        yield prefix, event, value
+        if event != 'map_key' or (prefix, value) not in hashed:
+            continue
+
+        # Consume the value of the key, which may be a nested array or map,
+        # or may already be hashed (see filter_payloads)
+        prefix, event, value = next(events)
+        if event == 'string' and value.startswith(HASH_PREFIX):
+            yield prefix, event, value
+            continue
+        h = hashlib.sha1()
+        depth = 0
+        while True:
+            if event == 'string':
+                h.update(_encode(value))
+            elif event in ('start_array', 'start_map'):
+                depth += 1
+            elif event in ('end_array', 'end_map'):
+                depth -= 1
+            if depth == 0:
+                break
+            prefix, event, value = next(events)
+        yield prefix, 'string', HASH_PREFIX + h.hexdigest()
+
+
+def parse_stream(f, hashed, buf_size=MIN_BUF_SIZE):
+    """
+    Build the notebook dict from the JSON events of `f`, one cell at a time.
+    """
+    nb = {'cells': [], 'metadata': {}, 'nbformat': None}
+    builder = None
+    events = ijson.parse(f, buf_size=buf_size)
+    for prefix, event, value in iter_events(events, hashed):
+        if prefix == CELL and event == 'start_map':
+            builder = ObjectBuilder()
+        elif prefix == 'metadata' and event == 'start_map':
+            builder = ObjectBuilder()
+        elif prefix == 'nbformat' and event == 'number':
+            nb['nbformat'] = value
+            continue
+
+        if builder is None:
+            continue
+        builder.event(event, value)
+
+        if prefix == CELL and event == 'end_map':
+            nb['cells'].append(reduce_cell(builder.value, hashed))
+            builder = None
+        elif prefix == 'metadata' and event == 'end_map':
+            nb['metadata'] = builder.value
+            builder = None
+    return nb
+
+
+def read_cell(f, index):
+    """
+    Return the cell number `index` of the notebook in the binary file `f`,
+    with all its payloads (e.g. to compare the images of the cell).
+    """
+    if ijson is None:
+        nb = json.loads(f.read().decode('utf-8'))
+        return reduce_cell(nb['cells'][index], set())
+
+    count = -1
+    builder = None
+    for prefix, event, value in ijson.parse(f, buf_size=buffer_size(f)):
+        if prefix == CELL and event == 'start_map':
+            count += 1
+            if count == index:
+                builder = ObjectBuilder()
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == CELL and event == 'end_map':
+                return reduce_cell(builder.value, set())
+    raise IndexError('The notebook has no cell %d' % index)
+
+
+def to_node(obj, node):
+    """ Convert the dicts in `obj` to `node` (e.g. NotebookNode). """
+    if isinstance(obj, dict):
+        return node((key, to_node(value, node)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [to_node(value, node) for value in obj]
+    if isinstance(obj, Decimal):
+        # ijson reads the non-integer numbers as decimals
+        return float(obj)
+    return obj
+
+
+def read_notebook(f, hashed=(), node=dict):
+    """
+    *Arguments*
+
+    f:  binary file with the notebook
+
+    hashed:  output keys (mime types or output fields) whose values are
+        replaced by 'sha1:<hash of the value>'
+
+    node:  class of the returned mappings (e.g. NotebookNode)
+
+    *Returns*
+
+    (notebook, sha1 of the file). The notebook only has the 'cells',
+    'metadata' and 'nbformat' fields, and the sources of the cells that are
+    not code cells are empty. It is None if the notebook is not in the
+    version 4 of the format, which must then be read (and converted) with
+    nbformat.
+
+    """
+    pairs = hashed_keys(hashed)
+    reader = HashingReader(f)
+    if ijson is not None:
+        chunks = filter_payloads(reader, hashed)
+        nb = parse_stream(ChunkReader(chunks), pairs)
+    else:
+        nb = json.loads(reader.read().decode('utf-8'))
+        nb = {'cells': [reduce_cell(cell, pairs)
+                        for cell in nb.get('cells', [])],
+              'metadata': nb.get('metadata', {}),
+              'nbformat': nb.get('nbformat')}
+    # Finish reading, so the hash is the hash of the whole file
+    while reader.read(1 << 16):
+        pass
+
+    if nb['nbformat'] != 4:
+        return None, reader.hexdigest()
+    return to_node(nb, node), reader.hexdigest()
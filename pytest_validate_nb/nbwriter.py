@@ -0,0 +1,109 @@
+"""
+Writing back to the notebooks (--nb-record-baseline, --nb-update-references).
+
+The notebooks are read again as plain JSON, with all their payloads, and
+only the entries changed by the plugin are modified: everything else (the
+layout of the multiline strings, the cell ids, the metadata, ...) is
+written back as it was. The notebooks are written as nbformat does, and
+atomically, so an interrupted session never leaves a truncated notebook.
+
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+
+# os.rename does not replace an existing file on Windows
+replace = getattr(os, 'replace', os.rename)
+
+
+def dumps_notebook(nb):
+    """ The JSON of the notebook `nb`, formatted as nbformat does. """
+    s = json.dumps(nb, sort_keys=True, indent=1, ensure_ascii=False,
+                   separators=(',', ': '))
+    if isinstance(s, bytes):
+        # Python 2 returns bytes when everything is ASCII
+        s = s.decode('utf-8')
+    return s + u'\n'
+
+
+# Text mime types whose values nbformat stores as lists of lines
+TEXT_MIMETYPES = ('application/javascript', 'image/svg+xml')
+
+
+def split_lines(text):
+    """ Multiline string as nbformat stores it: a list of lines. """
+    return text.splitlines(True)
+
+
+def nbformat_outputs(outs, execute_reply):
+    """
+    Convert the outputs collected from the kernel messages (see
+    IPyNbCell.execute) to the outputs of a nbformat 4 code cell.
+
+    The error of the cell is taken from its `execute_reply`. Consecutive
+    stream outputs are merged, and clear_output drops the outputs before
+    it, as in the notebook.
+    """
+    outputs = []
+    for out in outs:
+        output_type = out['output_type']
+        if output_type == 'clear_output':
+            outputs = []
+        elif output_type == 'stream':
+            if (outputs and outputs[-1]['output_type'] == 'stream' and
+                    outputs[-1]['name'] == out['stream']):
+                outputs[-1]['text'] += out['text']
+            else:
+                outputs.append({'output_type': 'stream',
+                                'name': out['stream'],
+                                'text': out['text']})
+        elif output_type in ('display_data', 'execute_result'):
+            output = {'output_type': output_type,
+                      'metadata': out.get('metadata', {}),
+                      'data': dict((key, value) for key, value in out.items()
+                                   if key not in ('output_type', 'metadata'))}
+            if output_type == 'execute_result':
+                output['execution_count'] = execute_reply.get(
+                    'execution_count')
+            outputs.append(output)
+
+    if execute_reply.get('status') == 'error':
+        outputs.append({'output_type': 'error',
+                        'ename': execute_reply.get('ename', ''),
+                        'evalue': execute_reply.get('evalue', ''),
+                        'traceback': execute_reply.get('traceback', [])})
+
+    for output in outputs:
+        if 'text' in output:
+            output['text'] = split_lines(output['text'])
+        for key, value in output.get('data', {}).items():
+            if ((key.startswith('text/') or key in TEXT_MIMETYPES) and
+                    isinstance(value, type(u''))):
+                output['data'][key] = split_lines(value)
+    return outputs
+
+
+def update_notebook(fname, update):
+    """
+    Call `update(nb)` with the JSON contents of the notebook `fname`, and
+    write the notebook back if it returns True.
+    """
+    with io.open(fname, 'r', encoding='utf-8') as f:
+        nb = json.load(f)
+    if not update(nb):
+        return False
+
+    directory = os.path.dirname(os.path.abspath(fname))
+    fd, tmpname = tempfile.mkstemp(dir=directory, suffix='.ipynb.tmp')
+    try:
+        with io.open(fd, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(dumps_notebook(nb))
+        shutil.copymode(fname, tmpname)
+        replace(tmpname, fname)
+    except Exception:
+        os.remove(tmpname)
+        raise
+    return True
@@ -0,0 +1,79 @@
+"""
+Comparison of text outputs with a numeric tolerance (--nb-rtol, --nb-atol).
+
+A text is split into its numbers (including the ones of printed NumPy
+arrays) and a skeleton, the text with every number replaced by a marker.
+Two texts match when their skeletons are identical and their numbers are
+close, as in numpy.allclose:
+
+    abs(test - reference) <= atol + rtol * abs(reference)
+
+Runs of spaces in the skeletons are compared as a single space, since the
+width of the columns of a printed array depends on its numbers.
+
+"""
+
+import math
+import re
+
+
+# A number is not part of a word (e.g. x1 or 0x7f), of a version (1.2.3) or
+# of a date (2015-04-08): the digits in those are compared as text
+NUMBER = re.compile(r'(?<![\w.])(?<!\d[-+])'
+                    r'[-+]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan|inf)'
+                    r'(?!\w|\.\d|[-+]\d)')
+SPACES = re.compile(r' +')
+MARKER = '\0'
+
+
+def split_numbers(s):
+    """
+    Return the skeleton of the string `s` and the list of its numbers.
+    """
+    numbers = [float(token) for token in NUMBER.findall(s)]
+    skeleton = SPACES.sub(' ', NUMBER.sub(MARKER, s))
+    return skeleton, numbers
+
+
+def allclose(test, ref, rtol, atol):
+    """ numpy.allclose (NaNs are equal), with a fallback without NumPy. """
+    # NumPy is only imported when numbers are compared: the plugin is
+    # loaded by every py.test run
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        return bool(numpy.allclose(test, ref, rtol=rtol, atol=atol,
+                                   equal_nan=True))
+    for a, b in zip(test, ref):
+        if math.isnan(a) and math.isnan(b):
+            continue
+        if a == b:
+            # Also infinities of the same sign
+            continue
+        if not abs(a - b) <= atol + rtol * abs(b):
+            return False
+    return True
+
+
+def compare_numbers(test, ref, rtol=0., atol=0.):
+    """
+    Compare the strings `test` and `ref` with a numeric tolerance.
+
+    *Returns*
+
+    None if they match, or a description of the difference.
+
+    """
+    test_skeleton, test_numbers = split_numbers(test)
+    ref_skeleton, ref_numbers = split_numbers(ref)
+    if test_skeleton != ref_skeleton:
+        return 'the text around the numbers differs'
+    if not allclose(test_numbers, ref_numbers, rtol, atol):
+        worst = max(range(len(ref_numbers)),
+                    key=lambda i: abs(test_numbers[i] - ref_numbers[i]))
+        return ('the numbers are not close (rtol=%g, atol=%g), e.g. number '
+                '%d: %r != %r' % (rtol, atol, worst + 1, test_numbers[worst],
+                                  ref_numbers[worst]))
+    return None
@@ -9,26 +9,73 @@ import pytest
 import os
 import sys
 import re
+import threading
+import time
+import inspect
+import warnings
 
 try:
     from exceptions import Exception
 except:
     pass
 
-wrapped_stdin = sys.stdin
-sys.stdin = sys.__stdin__
-
-# Kernel for IPython notebooks
-from IPython.kernel.manager import start_new_kernel
-
-sys.stdin = wrapped_stdin
 try:
-    from Queue import Empty
+    from Queue import Empty, Queue
 except:
-    from queue import Empty
+    from queue import Empty, Queue
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# The IPython modules are imported by import_ipython(), only when notebooks
+# are tested: the plugin is loaded by every py.test run
+start_new_kernel = KernelManager = reads = NotebookNode = None
+_ipython_lock = threading.Lock()
 
-# from IPython.nbformat.current import reads, NotebookNode
-from IPython.nbformat import reads, NotebookNode
+
+def import_ipython():
+    """
+    Import the IPython kernel manager and notebook format (once).
+
+    The kernels of the KernelPool are started in background threads, so
+    the first calls may be concurrent: the lock makes sure the imports and
+    the swap of sys.stdin are only done once, by a single thread.
+    """
+    global start_new_kernel, KernelManager, reads, NotebookNode
+    with _ipython_lock:
+        if start_new_kernel is not None:
+            return
+
+        wrapped_stdin = sys.stdin
+        sys.stdin = sys.__stdin__
+        try:
+            # Kernel for IPython notebooks
+            from IPython.kernel.manager import \
+                start_new_kernel as _start_new_kernel, \
+                KernelManager as _KernelManager
+        finally:
+            sys.stdin = wrapped_stdin
+
+        # from IPython.nbformat.current import reads, NotebookNode
+        from IPython.nbformat import reads as _reads, \
+            NotebookNode as _NotebookNode
+
+        reads, NotebookNode = _reads, _NotebookNode
+        KernelManager = _KernelManager
+        start_new_kernel = _start_new_kernel
+
+
+from .sanitize import Sanitizer, get_sanitize_patterns, string_types
+from .numeric import compare_numbers
+from .diff import unified_diff
+from .stream import StreamComparator
+from .durations import Durations, Timer, timer
+from .nbwriter import update_notebook, nbformat_outputs
+from .schedule import (parse_shard, load_history, load_shard_history,
+                       record_history, estimate_durations, assign_shards,
+                       longest_first)
 
 
 # Colours for outputs
@@ -45,6 +92,251 @@ class NbCellError(Exception):
     """ custom exception for error reporting. """
 
 
+# Entries of the outputs that are not compared
+SKIP_COMPARE = ('metadata',
+                'image/png',
+                'traceback',
+                'latex',
+                'prompt_number',
+                'stdout',
+                'stream',
+                'output_type',
+                'name',
+                'execution_count'
+                )
+
+# Entries of the outputs compared with a numeric tolerance (--nb-rtol)
+NUMERIC_COMPARE = ('text', 'text/plain')
+
+# Entries of the outputs that are not compared and may be large: only their
+# hash is read from the notebooks
+HASHED_OUTPUTS = ('image/png', 'traceback')
+
+# Options that change the result of the cells, part of the key of the
+# notebooks in the result cache (--nb-cache-dir)
+RESULT_OPTIONS = ('nb_rtol', 'nb_atol', 'nb_compare_images',
+                  'nb_image_pixel_tol', 'nb_image_rms_tol',
+                  'nb_image_hash_distance', 'nb_cell_timeout',
+                  'nb_budget_action', 'nb_record_baseline')
+
+# Module of the helpers run in the kernels (see RunningKernel.run_helper),
+# and the code loading it without adding names to the notebook namespace
+HELPERS_MODULE = '_pytest_validate_nb'
+HELPERS_LOADER = ("exec(compile(%%r, %(module)r, 'exec'), "
+                  "__import__('sys').modules.setdefault(%(module)r, "
+                  "__import__('types').ModuleType(%(module)r)).__dict__)"
+                  % {'module': HELPERS_MODULE})
+# Seconds to wait for the helpers that do not run with a cell
+HELPERS_TIMEOUT = 60
+_helpers_source = None
+
+
+def get_helpers_source():
+    """ Source of the helpers run in the kernels (read once). """
+    global _helpers_source
+    if _helpers_source is None:
+        fname = os.path.join(os.path.dirname(__file__), '_kernel_helpers.py')
+        with open(fname, 'r') as f:
+            _helpers_source = f.read()
+    return _helpers_source
+
+
+def argument_names(function):
+    """ Names of the arguments of `function`, without *args and **kwargs. """
+    try:
+        parameters = inspect.signature(function).parameters.values()
+    except AttributeError:
+        # Python 2
+        return inspect.getargspec(function).args
+    return [parameter.name for parameter in parameters
+            if parameter.kind not in (parameter.VAR_POSITIONAL,
+                                      parameter.VAR_KEYWORD)]
+
+
+def accepts_argument(cls, method, name):
+    """
+    Whether the method `method` of the class `cls` has an argument `name`.
+    Wrappers only taking *args and **kwargs (e.g. the methods of the
+    blocking clients of jupyter_client) are looked through, to the method
+    of the base classes.
+    """
+    for base in inspect.getmro(cls):
+        function = base.__dict__.get(method)
+        if function is None:
+            continue
+        names = argument_names(function)
+        if name in names:
+            return True
+        if names[1:]:
+            # Not a wrapper: the argument is not accepted
+            return False
+    return False
+
+
+def to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def get_output_digest(outputs, sanitize, skip_compare=SKIP_COMPARE):
+    """
+    Merge the outputs of a cell into a dictionary with one entry per key,
+    containing the sanitized values of that key in all the outputs.
+
+    For every different key, we will store the outputs in a
+    single string, in a dictionary with the same keys
+    At the end, every dictionary entry will be compared
+    We skip the unimportant keys in the 'skip_compare' list
+
+    We concatenate the outputs because the ipython notebook produces
+    them in a random number of dictionaries. So, it is easier
+    to compare only one chunk of data. The entries of every output
+    have the structure:
+
+    {'output_type': 'stream', 'stream': 'stdout',
+     'text': "The time is: 11:44:21\nToday's date is: 13/03/15\n"}
+
+    """
+    parts = {}
+    for output in outputs:
+        for key in output.keys():
+            if key in skip_compare:
+                continue
+
+            # In the EXECUTION, we already processed the display_data
+            # (or execute_count)
+            # kind of dictionary entries. In the notebook, display_data has
+            # a 'data' sub dictionary which contains the relevant information
+            # about the Figure: 'text/plain', 'image/png', ...
+            #
+            # EXAMPLES:
+            #
+            # display_data type:
+            # {'output_type': 'display_data', 'image/png': 'iVBORw0...
+            #  'text/plain': <matplotlib.figure.Figure at 0x7f9ca97cc890>
+            #  'metadata': {} }
+            #
+            # Hence, we look into these sub dictionary entries and
+            # append them to the corresponding dictionary entry
+            if key == 'data':
+                for data_key in output[key].keys():
+                    # Filter the keys in the SUB-dictionary again
+                    if data_key not in skip_compare:
+                        parts.setdefault(data_key, []).append(
+                            sanitize(output[key][data_key]))
+            else:
+                parts.setdefault(key, []).append(sanitize(output[key]))
+
+    digest = {}
+    for key, values in parts.items():
+        if all(isinstance(value, string_types) for value in values):
+            digest[key] = ''.join(values)
+        else:
+            # Only strings can be concatenated
+            digest[key] = values[-1]
+    return digest
+
+
+def get_image_hashes(outputs):
+    """
+    Hashes of the image/png outputs of a cell, which are not part of its
+    output digest (see nbreader.read_notebook).
+    """
+    from .nbreader import HASH_PREFIX
+    from .images import payload_hash
+
+    hashes = []
+    for output in outputs:
+        image = output.get('data', {}).get('image/png')
+        if image is not None:
+            if not (isinstance(image, string_types) and
+                    image.startswith(HASH_PREFIX)):
+                image = payload_hash(image)
+            hashes.append(image)
+    return hashes
+
+
+def get_sanitize_files(config):
+    """
+    Return list of all sanitize files provided by the user on the command line.
+
+    N.B.: We only support one sanitize file at the moment, but
+          this is likely to change in the future
+
+    """
+    if config.option.sanitize_with is not None:
+        return [config.option.sanitize_with]
+    else:
+        return []
+
+
+def get_sanitizer(config):
+    """
+    Return the Sanitizer of the session. The sanitize files are read and
+    the patterns compiled only the first time.
+    """
+    sanitizer = getattr(config, '_nb_sanitizer', None)
+    if sanitizer is None:
+        sanitizer = Sanitizer.from_files(
+            get_sanitize_files(config),
+            single_pass=config.option.sanitize_single_pass)
+        config._nb_sanitizer = sanitizer
+    return sanitizer
+
+
+def load_profile(fnames, stream=None):
+    """
+    Return the pstats.Stats merging the profiles in the files `fnames`, or
+    None if none of them has anything.
+    """
+    import pstats
+
+    stats = None
+    for fname in fnames:
+        try:
+            profile = pstats.Stats(fname, stream=stream)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            # Missing (e.g. the kernel was restarted), or nothing was
+            # profiled (e.g. an empty cell)
+            continue
+        if stats is None:
+            stats = profile
+        else:
+            stats.add(profile)
+    return stats
+
+
+def format_profile(fname, n):
+    """
+    Summary of the pstats file `fname`: the `n` functions with the largest
+    cumulative time.
+    """
+    out = StringIO()
+    stats = load_profile([fname], stream=out)
+    if stats is None:
+        return 'Nothing was profiled in the kernel'
+    stats.strip_dirs().sort_stats('cumulative').print_stats(n)
+    return out.getvalue().strip('\n') + '\n\nFull profile: %s' % fname
+
+
+# Memory limits of the cell and notebook metadata (in MB): (option, entry
+# of the timings of the cell, description)
+MEMORY_LIMITS = (('max_rss_growth', 'rss_growth',
+                  'growth of the resident memory of the kernel'),
+                 ('max_peak_rss', 'peak_rss',
+                  'peak resident memory of the kernel in the notebook'),
+                 ('max_traced_peak', 'traced_peak',
+                  'peak of the memory allocated by the cell'))
+
+
+# Key of the plugin options in the notebook and cell metadata, e.g.
+#
+#     "metadata": {"pytest_validate_nb": {"timeout": 60}}
+#
+METADATA_KEY = 'pytest_validate_nb'
+
+
 def pytest_addoption(parser):
     """
     Adds the --ipynb option flag for py.test.
@@ -62,15 +354,359 @@ def pytest_addoption(parser):
                          'the outputs. This option only works when '
                          'the --ipynb flag is passed to py.test')
 
+    group.addoption('--sanitize-single-pass', action='store_true',
+                    help='Merge the sanitize regexes into a single one, '
+                         'so every output is scanned only once. At a '
+                         'given position the first regex that matches '
+                         'wins, and replaced text is not matched again')
+
+    group.addoption('--nb-kernel-pool', type=int, default=0, metavar='N',
+                    help='Start N kernels in the background when the '
+                         'session starts and hand a ready kernel to every '
+                         'notebook (0 disables the pool)')
+
+    group.addoption('--nb-kernel-recycle', default='restart',
+                    choices=['restart', 'discard', 'reset'],
+                    help='What the kernel pool does with a kernel after a '
+                         'notebook finished: restart it in place, discard '
+                         'it and start a new one, or reset its namespace '
+                         'and keep it (restarting it if the notebook left '
+                         'something behind)')
+
+    group.addoption('--nb-kernel-max-uses', type=int, default=None,
+                    metavar='K',
+                    help='Discard pooled kernels after they ran K notebooks')
+
+    group.addoption('--nb-kernel-max-rss', type=float, default=None,
+                    metavar='MB',
+                    help='Discard pooled kernels whose resident memory is '
+                         'above MB megabytes after running a notebook')
+
+    group.addoption('--nb-zygote', action='store_true',
+                    help='Fork the kernels from a process that already '
+                         'imported the kernel and ran the preload code '
+                         '(needs os.fork, e.g. Linux)')
+
+    group.addoption('--nb-zygote-preload', metavar='FILE',
+                    help='Python file run once in the zygote process '
+                         'before forking the kernels, typically importing '
+                         'heavy packages used by the notebooks')
+
+    group.addoption('--nb-workers', type=int, default=1, metavar='N',
+                    help='Execute up to N notebooks concurrently, every one '
+                         'in its own kernel. Cells are still reported as '
+                         'individual tests')
+
+    group.addoption('--nb-pipeline', action='store_true',
+                    help='Send all the cells of a notebook to the kernel '
+                         'up front instead of one after the other')
+
+    group.addoption('--nb-cache-dir', metavar='DIR',
+                    help='Remember the notebooks that passed in DIR, and '
+                         'report them as passed without executing them '
+                         'while their code, outputs, sanitize patterns and '
+                         'environment (see --nb-cache-env) do not change')
+
+    group.addoption('--nb-cache-env', action='append', default=[],
+                    metavar='FILE_OR_STRING',
+                    help='Part of the environment for --nb-cache-dir: the '
+                         'contents of a file (e.g. a lockfile) or a string '
+                         '(e.g. a package version). Can be repeated')
+
+    group.addoption('--nb-cell-timeout', type=float, default=2000,
+                    metavar='SECONDS',
+                    help='Maximum execution time of a cell. It can be '
+                         'overridden with the "timeout" entry of the '
+                         'notebook or cell metadata')
+
+    group.addoption('--nb-interrupt-grace', type=float, default=10,
+                    metavar='SECONDS',
+                    help='Time given to the kernel to stop after a cell '
+                         'timed out and was interrupted; after it the '
+                         'kernel is restarted')
+
+    group.addoption('--nb-compare-images', action='store_true',
+                    help='Compare the image/png outputs too (needs PIL and '
+                         'NumPy). It can also be enabled with the '
+                         '"compare_images" entry of the notebook or cell '
+                         'metadata')
+
+    group.addoption('--nb-image-pixel-tol', type=int, default=0,
+                    metavar='N',
+                    help='Ignore the differences of up to N (0-255) in a '
+                         'channel of a pixel when comparing images. '
+                         'Metadata entry: "image_pixel_tol"')
+
+    group.addoption('--nb-image-rms-tol', type=float, default=0,
+                    metavar='RMS',
+                    help='Maximum root mean square of the pixel differences '
+                         'of two matching images. Metadata entry: '
+                         '"image_rms_tol"')
+
+    group.addoption('--nb-image-hash-distance', type=int, default=None,
+                    metavar='BITS',
+                    help='Report the images whose perceptual hashes (dHash, '
+                         '64 bits) differ by more than BITS bits as '
+                         'different, without comparing their pixels. Off by '
+                         'default. Metadata entry: "image_hash_distance"')
+
+    group.addoption('--nb-rtol', type=float, default=None, metavar='RTOL',
+                    help='Compare the numbers in the text outputs with this '
+                         'relative tolerance, and the rest of the text '
+                         'exactly. Metadata entry: "rtol"')
+
+    group.addoption('--nb-atol', type=float, default=None, metavar='ATOL',
+                    help='Compare the numbers in the text outputs with this '
+                         'absolute tolerance, and the rest of the text '
+                         'exactly. Metadata entry: "atol"')
+
+    group.addoption('--nb-diff-max-lines', type=int, default=200,
+                    metavar='N',
+                    help='Show at most N lines of the diff of a mismatching '
+                         'output in the failure report (0 for no limit)')
+
+    group.addoption('--nb-diff-dir', metavar='DIR',
+                    help='Write the reference and test versions of the '
+                         'mismatching outputs to files in DIR')
+
+    group.addoption('--nb-stream-compare', action='store_true',
+                    help='Compare the outputs of a cell while they arrive, '
+                         'failing at the first mismatch without keeping the '
+                         'outputs in memory. Not used with --nb-rtol or '
+                         '--nb-atol. Metadata entry: "stream_compare"')
+
+    group.addoption('--nb-stream-interrupt', action='store_true',
+                    help='With --nb-stream-compare, interrupt the kernel as '
+                         'soon as an output does not match, instead of '
+                         'letting the cell finish')
+
+    group.addoption('--nb-stop-on-error', action='store_true',
+                    help='Skip the remaining cells of a notebook after a '
+                         'cell raised an error that is not in its stored '
+                         'outputs. Metadata entry: "stop_on_error"')
+
+    group.addoption('--nb-durations', type=int, default=None, metavar='N',
+                    help='Show the N slowest notebooks and cells, with the '
+                         'time spent in every phase (N=0 for all)')
+
+    group.addoption('--nb-durations-json', metavar='FILE',
+                    help='Write the timings of all the notebooks and cells '
+                         'to FILE (JSON)')
+
+    group.addoption('--nb-update-references', action='store_true',
+                    help='Write the new outputs of the cells whose outputs '
+                         'do not match back to the notebooks, keeping the '
+                         'rest of the notebooks unchanged. The cells are '
+                         'still reported as failed')
+
+    group.addoption('--nb-budget-action', default='fail',
+                    choices=('fail', 'warn'),
+                    help='What to do when a cell takes longer than the time '
+                         'budget of its metadata ("max_time" seconds, or '
+                         '"max_time_ratio" times its "baseline_time"): '
+                         'fail (default) or warn. Metadata entry: '
+                         '"budget_action"')
+
+    group.addoption('--nb-record-baseline', action='store_true',
+                    help='Write the execution time of every cell that ran '
+                         'to its metadata ("baseline_time"), the reference '
+                         'of the "max_time_ratio" budgets. The budgets are '
+                         'not checked')
+
+    group.addoption('--nb-tracemalloc', action='store_true',
+                    help='Trace the peak of the memory allocated by every '
+                         'cell in the kernel with tracemalloc (Python 3.4 '
+                         'or newer). Metadata entry: "tracemalloc"')
+
+    group.addoption('--nb-shard', type=parse_shard, metavar='I/N',
+                    help='Only run the I-th of N shards of the notebooks '
+                         '(e.g. 2/4), balanced with the durations of '
+                         '--nb-shard-durations (or else the number of '
+                         'cells), for CI jobs split across nodes')
+
+    group.addoption('--nb-shard-durations', metavar='FILE',
+                    help='Balance --nb-shard with the durations of FILE '
+                         '(written by --nb-durations-json), the same for '
+                         'every node, and order --nb-order with them '
+                         'instead of the ones in the pytest cache')
+
+    group.addoption('--nb-order', default='auto',
+                    choices=('auto', 'file', 'longest'),
+                    help='Order of the notebooks: as collected (file), or '
+                         'the longest ones first according to the durations '
+                         'of earlier runs (longest). auto (the default) is '
+                         'longest with --nb-workers, else file. The cells '
+                         'of a notebook always run in order')
+
+    group.addoption('--nb-profile', action='store_true',
+                    help='Profile the cells in the kernel with cProfile, '
+                         'adding the functions with the largest cumulative '
+                         'time to the reports. Metadata entry: "profile"')
+
+    group.addoption('--nb-profile-dir', default='nb_profile', metavar='DIR',
+                    help='Directory of the pstats files of the cells and '
+                         'notebooks profiled with --nb-profile '
+                         '(default: nb_profile)')
+
+    group.addoption('--nb-profile-top', type=int, default=20, metavar='N',
+                    help='Number of functions reported by --nb-profile '
+                         '(default: 20)')
+
+
+def pytest_configure(config):
+    """ called after command line options have been parsed
+        and all plugins and initial conftest files been loaded.
+    """
+    if config.option.ipynb and config.option.nb_cache_dir:
+        from .cache import ResultCache, get_environment_fingerprint
+        config._nb_result_cache = ResultCache(
+            config.option.nb_cache_dir,
+            get_environment_fingerprint(config.option.nb_cache_env))
+
+    if config.option.ipynb and config.option.nb_zygote:
+        from .zygote import Zygote
+        preload = ''
+        if config.option.nb_zygote_preload:
+            with open(config.option.nb_zygote_preload, 'r') as f:
+                preload = f.read()
+        config._nb_zygote = Zygote(preload)
+
+    if config.option.ipynb:
+        # Always collected: the durations are stored in the cache for
+        # --nb-shard
+        config._nb_durations = Durations()
+
+    if config.option.ipynb and config.option.nb_kernel_pool > 0:
+        # Imported before the kernels are started in background threads,
+        # since the imports swap sys.stdin
+        import_ipython()
+        config._nb_kernel_pool = KernelPool(
+            config.option.nb_kernel_pool,
+            recycle=config.option.nb_kernel_recycle,
+            max_uses=config.option.nb_kernel_max_uses,
+            max_rss=config.option.nb_kernel_max_rss,
+            zygote=getattr(config, '_nb_zygote', None))
+
+
+def pytest_collection_modifyitems(session, config, items):
+    """
+    With --nb-shard, deselect the notebooks of the other shards, and with
+    --nb-order, run the longest notebooks first.
+    """
+    if not config.option.ipynb:
+        return
+    order = config.option.nb_order
+    if order == 'auto':
+        order = 'longest' if config.option.nb_workers > 1 else 'file'
+    if not config.option.nb_shard and order == 'file':
+        return
+
+    cells = {}
+    for item in items:
+        if isinstance(item, IPyNbCell):
+            cells[item.parent.nodeid] = item.parent.ncells
+    history = load_history(getattr(config, 'cache', None),
+                           config.option.nb_shard_durations)
+    durations = estimate_durations(cells, history)
+
+    if config.option.nb_shard:
+        # Every node must compute the same shards: the durations in the
+        # cache of this node are not used
+        shard, nshards = config.option.nb_shard
+        shard_durations = estimate_durations(
+            cells, load_shard_history(config.option.nb_shard_durations))
+        selected = set(assign_shards(shard_durations, nshards)[shard - 1])
+
+        # The other tests are not sharded
+        remaining, deselected = [], []
+        for item in items:
+            if (isinstance(item, IPyNbCell) and
+                    item.parent.nodeid not in selected):
+                deselected.append(item)
+            else:
+                remaining.append(item)
+        if deselected:
+            config.hook.pytest_deselected(items=deselected)
+            items[:] = remaining
+
+    if order == 'longest':
+        items[:] = longest_first(
+            items,
+            lambda item: (item.parent.nodeid
+                          if isinstance(item, IPyNbCell) else None),
+            durations)
+
 
-# def pytest_configure(config):
-#     """ called after command line options have been parsed
-#         and all plugins and initial conftest files been loaded.
-#     """
-#     if config.option.sanitise_file:
-#         if not config.option.ipynb:
-#             raise NameError('ERROR: Config file without --ipynb flag')
-#         else:
+def pytest_collection_finish(session):
+    """
+    With --nb-workers, start executing the collected notebooks in the
+    background as soon as the collection (and deselection) is done.
+    """
+    config = session.config
+    if not config.option.ipynb or config.option.collectonly:
+        return
+
+    # Group the cells by notebook, keeping the order of the session
+    notebooks = []
+    for item in session.items:
+        if isinstance(item, IPyNbCell):
+            if item.parent.selected_cells is None:
+                notebooks.append(item.parent)
+                item.parent.selected_cells = []
+            item.parent.selected_cells.append(item)
+
+    if config.option.nb_workers < 2:
+        return
+
+    scheduler = NotebookScheduler(config.option.nb_workers)
+    for nbfile in notebooks:
+        if not nbfile.cached_pass:
+            scheduler.submit(nbfile, nbfile.selected_cells)
+    scheduler.start()
+    config._nb_scheduler = scheduler
+
+
+def pytest_sessionfinish(session):
+    durations = getattr(session.config, '_nb_durations', None)
+    if durations is None:
+        return
+    if session.config.option.nb_durations_json:
+        durations.write_json(session.config.option.nb_durations_json)
+    cache = getattr(session.config, 'cache', None)
+    if cache is not None:
+        record_history(cache, durations.records())
+
+
+def pytest_terminal_summary(terminalreporter):
+    """ Report of --nb-durations. """
+    config = terminalreporter.config
+    durations = getattr(config, '_nb_durations', None)
+    if durations is None or config.option.nb_durations is None:
+        return
+    n = config.option.nb_durations
+    terminalreporter.write_sep('=', 'slowest %snotebooks and cells'
+                               % ('%d ' % n if n else ''))
+    for line in durations.summary(n):
+        terminalreporter.write_line(line)
+
+
+def pytest_unconfigure(config):
+    """ Shut down the kernels still alive in the pool (if any). """
+    scheduler = getattr(config, '_nb_scheduler', None)
+    if scheduler is not None:
+        # Notebooks that were not started yet (e.g. after -x) are dropped
+        scheduler.close()
+        del config._nb_scheduler
+
+    pool = getattr(config, '_nb_kernel_pool', None)
+    if pool is not None:
+        pool.close()
+        del config._nb_kernel_pool
+
+    zygote = getattr(config, '_nb_zygote', None)
+    if zygote is not None:
+        zygote.close()
+        del config._nb_zygote
 
 
 def pytest_collect_file(path, parent):
@@ -78,6 +714,7 @@ def pytest_collect_file(path, parent):
     Collect IPython notebooks using the specified pytest hook
     """
     if path.fnmatch("*.ipynb") and parent.config.option.ipynb:
+        import_ipython()
         return IPyNbFile(path, parent)
 
 
@@ -92,113 +729,942 @@ class RunningKernel(object):
     this class.
 
     """
-    def __init__(self):
-        self.km, self.kc = start_new_kernel(extra_arguments=['--matplotlib=inline'],
-                                            stderr=open(os.devnull, 'w'))
+    def __init__(self, zygote=None):
+        import_ipython()
+        start = timer()
+        if zygote is not None:
+            # Fork the kernel from the zygote process (--nb-zygote)
+            self.km, self.kc = zygote.start_new_kernel(
+                extra_arguments=['--matplotlib=inline'])
+        else:
+            self.km, self.kc = start_new_kernel(extra_arguments=['--matplotlib=inline'],
+                                                stderr=open(os.devnull, 'w'))
+        # Time it took to start the kernel (--nb-durations)
+        self.boot_time = timer() - start
+
         # We need iopub to read every line in the cells
         self.iopub = self.kc.iopub_channel
 
+        # Number of notebooks run with this kernel (used by the KernelPool
+        # to decide when the kernel has to be discarded)
+        self.uses = 0
+
+        # MessageRouter sorting the iopub messages by request, when the
+        # cells are pipelined (see start_router)
+        self.router = None
+
+        # Replies received while waiting for the reply of another request
+        self._replies = {}
+
+        # Whether the helpers of _kernel_helpers.py are loaded in the kernel
+        self._helpers_loaded = False
+
+    @property
+    def pid(self):
+        """
+        PID of the kernel process, or None if the manager does not know it.
+        """
+        kernel = getattr(self.km, 'kernel', None)
+        if kernel is None:
+            # Newer kernel managers keep the process in a provisioner
+            kernel = getattr(self.km, 'provisioner', None)
+        return getattr(kernel, 'pid', None)
+
+    def rss(self):
+        """ Resident memory of the kernel process in bytes (or None). """
+        return get_process_rss(self.pid)
+
+    def peak_rss(self):
+        """ Peak resident memory of the kernel process in bytes (or None). """
+        return get_process_peak_rss(self.pid)
+
+    def reset_peak_rss(self):
+        """
+        Make the peak resident memory start from the current one, e.g. when
+        a pooled kernel starts a new notebook (Linux 4.0 or newer).
+        """
+        pid = self.pid
+        if pid is None:
+            return
+        try:
+            with open('/proc/%d/clear_refs' % pid, 'w') as f:
+                f.write('5')
+        except (IOError, OSError):
+            pass
+
     def get_message(self, timeout=None):
         return self.iopub.get_msg(timeout=timeout)
 
-    def execute_cell_input(self, cell_input, allow_stdin=None):
-        return self.kc.execute(cell_input, allow_stdin=allow_stdin)
+    def execute_cell_input(self, cell_input, allow_stdin=None,
+                           stop_on_error=True):
+        kwargs = {}
+        if not stop_on_error:
+            # Only understood by recent kernel clients (see can_pipeline),
+            # so we do not pass it unless needed
+            kwargs['stop_on_error'] = False
+        msg_id = self.kc.execute(cell_input, allow_stdin=allow_stdin,
+                                 **kwargs)
+        if self.router is not None:
+            self.router.expect(msg_id)
+        return msg_id
+
+    def can_pipeline(self):
+        """
+        Whether cells can be queued in the kernel: the client must accept
+        stop_on_error=False, otherwise the kernel aborts the queued cells
+        after the first error (e.g. the clients of IPython 3).
+        """
+        return accepts_argument(type(self.kc), 'execute', 'stop_on_error')
+
+    def start_router(self):
+        """
+        Start reading the iopub channel in the background, sorting the
+        messages by the request that produced them. This allows several
+        cells to be queued in the kernel at the same time.
+        """
+        if self.router is None:
+            self.router = MessageRouter(self.get_message)
+
+    def stop_router(self):
+        if self.router is not None:
+            self.router.stop()
+            self.router = None
+
+    def get_cell_message(self, msg_id, timeout=None):
+        """
+        Return the next iopub message produced by the request `msg_id`,
+        dropping the messages of other requests. Raises Empty if there is
+        no message within `timeout` seconds.
+        """
+        if self.router is not None:
+            return self.router.get(msg_id, timeout=timeout)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if timeout is not None:
+                timeout = max(deadline - time.time(), 0)
+            msg = self.get_message(timeout=timeout)
+            if msg['parent_header'].get('msg_id') == msg_id:
+                return msg
+
+    def get_reply(self, msg_id, timeout=None):
+        """
+        Return the reply to the request `msg_id` from the shell channel.
+        Replies to other requests are kept until they are asked for.
+        Raises Empty if the reply does not arrive within `timeout` seconds.
+        """
+        if msg_id in self._replies:
+            return self._replies.pop(msg_id)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if timeout is not None:
+                timeout = max(deadline - time.time(), 0)
+            msg = self.kc.get_shell_msg(timeout=timeout)
+            parent_id = msg['parent_header'].get('msg_id')
+            if parent_id == msg_id:
+                return msg
+            self._replies[parent_id] = msg
+
+    def run_silent(self, code, timeout=None, user_expressions=None):
+        """
+        Run `code` in the kernel without outputs nor history, e.g. to set
+        up the next cell, and return the content of the reply. Raises
+        RuntimeError if the code raised an error, and Empty if it did not
+        finish within `timeout` seconds.
+        """
+        msg_id = self.kc.execute(code, silent=True, store_history=False,
+                                 user_expressions=user_expressions,
+                                 allow_stdin=False)
+        try:
+            reply = self.get_reply(msg_id, timeout=timeout)['content']
+        finally:
+            self.forget(msg_id)
+        if reply['status'] != 'ok':
+            raise RuntimeError('%s: %s' % (reply.get('ename'),
+                                           reply.get('evalue')))
+        return reply
+
+    def run_helper(self, call, timeout=None):
+        """
+        Run `call` (e.g. "profile_next_cell('cell.pstats')") with the
+        helpers of _kernel_helpers.py, which are loaded in the kernel the
+        first time they are used.
+        """
+        if not self._helpers_loaded:
+            self.run_silent(HELPERS_LOADER % (get_helpers_source(),),
+                            timeout=timeout)
+            self._helpers_loaded = True
+        return self.run_silent("__import__(%r).%s" % (HELPERS_MODULE, call),
+                               timeout=timeout)
+
+    def snapshot(self):
+        """
+        Remember the state of the fresh kernel, restored by
+        reset_namespace() (see _kernel_helpers.snapshot).
+        """
+        self.run_helper('snapshot()', timeout=HELPERS_TIMEOUT)
+
+    def reset_namespace(self):
+        """
+        Bring the kernel back to the state of snapshot() after a notebook,
+        without restarting the process (see _kernel_helpers.reset). Raises
+        RuntimeError if the notebook left something that was not undone.
+        """
+        self.run_helper('reset()', timeout=HELPERS_TIMEOUT)
+
+    def helper_value(self, name, timeout=None):
+        """
+        Return the repr of the variable `name` of the helpers (which must
+        have been loaded by run_helper), e.g. the peak of trace_next_cell.
+        """
+        expression = "__import__(%r).%s" % (HELPERS_MODULE, name)
+        reply = self.run_silent('', timeout=timeout,
+                                user_expressions={'value': expression})
+        value = reply['user_expressions']['value']
+        if value['status'] != 'ok':
+            raise RuntimeError('%s: %s' % (value.get('ename'),
+                                           value.get('evalue')))
+        return value['data']['text/plain']
+
+    def forget(self, msg_id):
+        """ Discard whatever is left from the request `msg_id`. """
+        self._replies.pop(msg_id, None)
+        if self.router is not None:
+            self.router.discard(msg_id)
+
+    def flush(self, timeout=0.1):
+        """
+        Discard the messages left in the iopub channel, e.g. the status
+        messages published while the kernel was starting.
+        """
+        while True:
+            try:
+                self.get_message(timeout=timeout)
+            except Empty:
+                break
+
+    def interrupt(self, msg_id, timeout=None):
+        """
+        Send SIGINT to the kernel (through the kernel manager) and wait up
+        to `timeout` seconds for the request `msg_id` to finish. Returns
+        False if the kernel did not stop in time.
+        """
+        self.km.interrupt_kernel()
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            while True:
+                if timeout is not None:
+                    timeout = max(deadline - time.time(), 0)
+                msg = self.get_cell_message(msg_id, timeout=timeout)
+                if (msg['msg_type'] == 'status' and
+                        msg['content']['execution_state'] == 'idle'):
+                    break
+            if timeout is not None:
+                timeout = max(deadline - time.time(), 0)
+            self.get_reply(msg_id, timeout=timeout)
+        except Empty:
+            return False
+        finally:
+            self.forget(msg_id)
+        return True
 
     # These options are in case we wanted to restart the nb every time
     # it is executed a certain task
     def restart(self):
+        # Nothing can read the channels while the kernel restarts
+        pipelined = self.router is not None
+        self.stop_router()
+        self._replies = {}
+        self._helpers_loaded = False
+
         self.km.restart_kernel(now=True)
+        if hasattr(self.kc, 'wait_for_ready'):
+            self.kc.wait_for_ready()
+        self.flush()
+
+        if pipelined:
+            self.start_router()
 
     def stop(self):
+        self.stop_router()
         self.kc.stop_channels()
         self.km.shutdown_kernel(now=True)
         del self.km
 
 
+class MessageRouter(object):
+    """
+    Read the messages of a kernel channel in a background thread and sort
+    them in one buffer per request, using the msg_id of their parent header.
+
+    Only the requests registered with expect() are kept. Messages that
+    arrive before their request is registered (the kernel can be faster
+    than kc.execute() returning) are kept for a while in `orphans`.
+    """
+    max_orphans = 1000
+
+    def __init__(self, get_message):
+        self._get_message = get_message
+        self._buffers = {}
+        self._orphans = {}
+        self._orphan_ids = []
+        self._lock = threading.Lock()
+        self._running = True
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self):
+        while self._running:
+            try:
+                msg = self._get_message(timeout=0.1)
+            except Empty:
+                continue
+            msg_id = msg['parent_header'].get('msg_id')
+            with self._lock:
+                if msg_id in self._buffers:
+                    self._buffers[msg_id].put(msg)
+                elif msg_id is not None:
+                    if msg_id not in self._orphans:
+                        self._orphans[msg_id] = []
+                        self._orphan_ids.append(msg_id)
+                        if len(self._orphan_ids) > self.max_orphans:
+                            del self._orphans[self._orphan_ids.pop(0)]
+                    self._orphans[msg_id].append(msg)
+
+    def expect(self, msg_id):
+        """ Start keeping the messages of the request `msg_id`. """
+        with self._lock:
+            if msg_id in self._buffers:
+                return
+            buf = self._buffers[msg_id] = Queue()
+            if msg_id in self._orphans:
+                self._orphan_ids.remove(msg_id)
+                for msg in self._orphans.pop(msg_id):
+                    buf.put(msg)
+
+    def get(self, msg_id, timeout=None):
+        with self._lock:
+            buf = self._buffers[msg_id]
+        return buf.get(timeout=timeout)
+
+    def discard(self, msg_id):
+        with self._lock:
+            self._buffers.pop(msg_id, None)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+
+# psutil module, False if it is not installed (see get_psutil)
+_psutil = None
+
+
+def get_psutil():
+    """
+    Return the psutil module, or None if it is not installed. The import
+    is only tried once, when the memory of a kernel is first measured.
+    """
+    global _psutil
+    if _psutil is None:
+        try:
+            import psutil
+            _psutil = psutil
+        except ImportError:
+            _psutil = False
+    return _psutil or None
+
+
+def get_process_rss(pid):
+    """
+    Return the resident set size (in bytes) of the process with the given
+    PID, or None if it cannot be determined.
+
+    psutil is used when it is installed, otherwise we read /proc (Linux).
+    """
+    if pid is None:
+        return None
+    psutil = get_psutil()
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except Exception:
+            return None
+    try:
+        with open('/proc/%d/statm' % pid, 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def get_process_peak_rss(pid):
+    """
+    Return the peak resident set size (in bytes) of the process with the
+    given PID, or None if it cannot be determined (only Linux is supported).
+    """
+    if pid is None:
+        return None
+    try:
+        with open('/proc/%d/status' % pid, 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class KernelPool(object):
+    """
+    Session-wide pool of kernels.
+
+    The kernels are started in background threads, so their startup time
+    overlaps with the execution of the notebooks. Every IPyNbFile takes a
+    ready kernel with acquire() and gives it back with release(). Released
+    kernels are recycled according to the `recycle` policy:
+
+        'restart'   restart the kernel process in place (RunningKernel.restart)
+        'discard'   stop the kernel and start a new one
+        'reset'     reset the namespace of the kernel and keep the process
+                    (RunningKernel.reset_namespace), restarting it if the
+                    notebook left something that could not be undone
+
+    Independently of the policy, a kernel is discarded after `max_uses`
+    notebooks or when its resident memory exceeds `max_rss` megabytes.
+
+    The kernels are forked from `zygote` if one is given.
+    """
+    def __init__(self, size, recycle='restart', max_uses=None, max_rss=None,
+                 zygote=None):
+        self.recycle = recycle
+        self.max_uses = max_uses
+        self.max_rss = max_rss
+        self.zygote = zygote
+        self.closed = False
+
+        self._ready = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+        for i in range(size):
+            self._spawn(self._new_kernel)
+
+    def _spawn(self, start, *args):
+        """ Prepare a kernel in a background thread. """
+        thread = threading.Thread(target=self._prepare, args=(start,) + args)
+        thread.daemon = True
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            self._threads.append(thread)
+        thread.start()
+
+    def _prepare(self, start, *args):
+        try:
+            kernel = start(*args)
+        except Exception as e:
+            # Hand the error over to whoever is waiting for a kernel
+            kernel = e
+        self._ready.put(kernel)
+
+    def _restart(self, kernel):
+        kernel.restart()
+        if self.recycle == 'reset':
+            kernel.snapshot()
+        return kernel
+
+    def _reset(self, kernel):
+        try:
+            kernel.reset_namespace()
+        except (RuntimeError, Empty):
+            return self._restart(kernel)
+        return kernel
+
+    def _new_kernel(self):
+        kernel = RunningKernel(self.zygote)
+        if self.recycle == 'reset':
+            kernel.snapshot()
+        return kernel
+
+    def _replace(self, kernel):
+        kernel.stop()
+        return self._new_kernel()
+
+    def must_discard(self, kernel):
+        if self.max_uses is not None and kernel.uses >= self.max_uses:
+            return True
+        if self.max_rss is not None:
+            rss = kernel.rss()
+            if rss is not None and rss > self.max_rss * 1024 ** 2:
+                return True
+        return False
+
+    def acquire(self):
+        """ Return a ready kernel, waiting for one if necessary. """
+        kernel = self._ready.get()
+        if isinstance(kernel, Exception):
+            # Try again for the next notebook, the error may be transient
+            self._spawn(self._new_kernel)
+            raise kernel
+        return kernel
+
+    def release(self, kernel):
+        """ Give back a kernel after it ran a notebook. """
+        kernel.uses += 1
+        if self.closed:
+            kernel.stop()
+        elif self.recycle == 'discard' or self.must_discard(kernel):
+            self._spawn(self._replace, kernel)
+        elif self.recycle == 'reset':
+            self._spawn(self._reset, kernel)
+        else:
+            self._spawn(self._restart, kernel)
+
+    def close(self):
+        """ Wait for the kernels being prepared and stop all of them. """
+        self.closed = True
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join()
+        while True:
+            try:
+                kernel = self._ready.get_nowait()
+            except Empty:
+                break
+            if isinstance(kernel, RunningKernel):
+                kernel.stop()
+
+
+class NotebookRun(object):
+    """
+    Outputs of a notebook executed by a worker of the NotebookScheduler.
+
+    The worker stores the outputs of every cell with set_result() and the
+    IPyNbCell items wait for them with get_result(), in the main thread.
+    """
+    def __init__(self, cells):
+        self.cells = cells
+        self.finished = False
+        self._results = {}
+        # Why the cells that were not executed are skipped
+        self.skip_reason = 'notebook execution was cancelled'
+        self._condition = threading.Condition()
+
+    def set_result(self, cell, outs=None, error=None):
+        # The cells are the keys: their names (and node ids) are not unique
+        with self._condition:
+            self._results[cell] = (outs, error)
+            self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            self.finished = True
+            self._condition.notify_all()
+
+    def wait(self):
+        with self._condition:
+            while not self.finished:
+                self._condition.wait()
+
+    def get_result(self, cell):
+        """
+        Wait until the cell was executed and return its outputs, raising
+        the exception of the execution if there was one.
+        """
+        with self._condition:
+            while cell not in self._results and not self.finished:
+                self._condition.wait()
+            if cell not in self._results:
+                pytest.skip(self.skip_reason)
+            outs, error = self._results[cell]
+        if error is not None:
+            raise error
+        return outs
+
+
+class NotebookScheduler(object):
+    """
+    Execute whole notebooks concurrently in a pool of worker threads.
+
+    Every notebook runs in its own kernel (a separate process), so the
+    threads only wait on the kernel messages. The cells of a notebook are
+    executed in order by a single worker, and the results are collected
+    by the IPyNbCell items as they are run by pytest.
+    """
+    def __init__(self, workers):
+        self.cancelled = False
+        self._queue = Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            self._threads.append(thread)
+
+    def submit(self, nbfile, cells):
+        nbfile.background = NotebookRun(cells)
+        self._queue.put(nbfile)
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            nbfile = self._queue.get()
+            if nbfile is None:
+                break
+            nbfile.run_in_background(self)
+
+    def close(self):
+        self.cancelled = True
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            if thread.ident is not None:
+                thread.join()
+
+
 class IPyNbFile(pytest.File):
     def __init__(self, *args, **kwargs):
         super(IPyNbFile, self).__init__(*args, **kwargs)
         self.kernel = None  # will be initialised in setup()
 
-    def get_kernel_message(self, timeout=None):
-        return self.kernel.get_message(timeout=timeout)
+        # NotebookRun, when the notebook is executed by a NotebookScheduler
+        self.background = None
+
+        # The cells that will run in this session, in order (set when the
+        # collection finished)
+        self.selected_cells = None
+
+        # With --nb-cache-dir: key of the notebook, whether it passed in a
+        # previous run, and how many cells passed in this one
+        self.result_key = None
+        self.cached_pass = False
+        self.passed_cells = 0
+        self.ncells = 0
+
+        # With --nb-stop-on-error, why the remaining cells are skipped
+        self.skip_reason = None
+
+        # Durations of the phases of the notebook (see durations.py)
+        self.timings = {}
 
     # Read through the specified notebooks and load the data
     # (which is in json format)
     def collect(self):
-        with self.fspath.open() as f:
-            # self.nb = reads(f.read(), 'json')
-            self.nb = reads(f.read(), 4)
-
-            # Start the cell count
-            cell_num = 0
-
-            # Worksheets are NOT used anymore::
-            # Currently there is only 1 worksheet (it seems in newer versions
-            # of IPython, they are going to get rid of this option)
-            # For every worksheet, read every cell associated to it
-
-            for cell in self.nb.cells:
-                # Skip the cells that have text, headings or related stuff
-                # Only test code cells
-                if cell.cell_type == 'code':
-                    # If the code is a notebook magic cell, do not run
-                    # i.e. cell code starts with '%%'
-                    # Also ignore the cells that start with the
-                    # comment string PYTEST_VALIDATE_IGNORE_OUTPUT
-                    # NOTE: This actually skips execution, which probably isn't what we want!
-                    #       It is typically helpful to execute the cell (to make sure that at
-                    #       least the code doesn't fail) but then discard the result.
-                    if not (cell.source.startswith('%%') or
-                            cell.source.startswith(r'# PYTEST_VALIDATE_IGNORE_OUTPUT') or
-                            cell.source.startswith(r'#PYTEST_VALIDATE_IGNORE_OUTPUT')):
-
-                        yield IPyNbCell(self.name, self, cell_num, cell)
-
+        from .nbreader import read_notebook
+
+        with Timer(self.timings, 'read'):
+            with self.fspath.open('rb') as f:
+                # Only the sources and the compared outputs are kept: the
+                # large payloads that are not compared are replaced by their
+                # hash
+                self.nb, digest = read_notebook(f, HASHED_OUTPUTS,
+                                                NotebookNode)
+            if self.nb is None:
+                # Older versions of the format are converted by nbformat
+                with self.fspath.open() as f:
+                    # self.nb = reads(f.read(), 'json')
+                    self.nb = reads(f.read(), 4)
+
+        # The sanitized reference outputs only depend on the notebook
+        # and the sanitize patterns, they may be in the cache already
+        sanitizer = get_sanitizer(self.config)
+        key = digest + sanitizer.fingerprint
+        references = self.load_references(key)
+        new_references = {}
+
+        # (source, reference, options, images) of the cells, for the
+        # result cache
+        cells = []
+
+        # Start the cell count
+        cell_num = 0
+
+        # Worksheets are NOT used anymore::
+        # Currently there is only 1 worksheet (it seems in newer versions
+        # of IPython, they are going to get rid of this option)
+        # For every worksheet, read every cell associated to it
+
+        for index, cell in enumerate(self.nb.cells):
+            # Skip the cells that have text, headings or related stuff
+            # Only test code cells
+            if cell.cell_type == 'code':
+                # If the code is a notebook magic cell, do not run
+                # i.e. cell code starts with '%%'
+                # Also ignore the cells that start with the
+                # comment string PYTEST_VALIDATE_IGNORE_OUTPUT
+                # NOTE: This actually skips execution, which probably isn't what we want!
+                #       It is typically helpful to execute the cell (to make sure that at
+                #       least the code doesn't fail) but then discard the result.
+                if not (cell.source.startswith('%%') or
+                        cell.source.startswith(r'# PYTEST_VALIDATE_IGNORE_OUTPUT') or
+                        cell.source.startswith(r'#PYTEST_VALIDATE_IGNORE_OUTPUT')):
+
+                    if references is not None:
+                        reference = references[str(index)]
                     else:
-                        # Skipped cells will not be counted
-                        continue
+                        reference = get_output_digest(cell.outputs,
+                                                      sanitizer.sanitize)
+                        new_references[str(index)] = reference
+
+                    cells.append((cell.source, reference,
+                                  cell.metadata.get(METADATA_KEY, {}),
+                                  get_image_hashes(cell.outputs)))
+                    yield IPyNbCell(self.name, self, cell_num, cell,
+                                    reference, index)
 
-                # Update 'code' cell count
-                cell_num += 1
+                else:
+                    # Skipped cells will not be counted
+                    continue
+
+            # Update 'code' cell count
+            cell_num += 1
+
+        if references is None:
+            self.store_references(key, new_references)
+
+        result_cache = getattr(self.config, '_nb_result_cache', None)
+        if result_cache is not None:
+            self.result_key = result_cache.get_key(cells,
+                                                   sanitizer.fingerprint,
+                                                   self.result_options())
+            self.cached_pass = result_cache.has_passed(self.result_key)
+        self.ncells = len(cells)
+
+    def result_options(self):
+        """
+        The options of the session and of the notebook metadata that change
+        the result of the cells, for the result cache.
+        """
+        option = self.config.option
+        return {'options': dict((name, getattr(option, name))
+                                for name in RESULT_OPTIONS),
+                'metadata': self.nb.metadata.get(METADATA_KEY, {})}
+
+    def references_cache_key(self):
+        import hashlib
+
+        path = to_bytes(str(self.fspath))
+        return ('pytest_validate_nb/references/' +
+                hashlib.sha1(path).hexdigest())
+
+    def load_references(self, key):
+        """
+        Return the reference digests of the cells stored in the pytest
+        cache, if they were computed for the same notebook contents and
+        sanitize patterns (identified by `key`).
+        """
+        cache = getattr(self.config, 'cache', None)
+        if cache is None:
+            return None
+        entry = cache.get(self.references_cache_key(), None)
+        if entry is not None and entry.get('key') == key:
+            return entry['cells']
+        return None
+
+    def store_references(self, key, references):
+        cache = getattr(self.config, 'cache', None)
+        if cache is not None:
+            cache.set(self.references_cache_key(),
+                      {'key': key, 'cells': references})
 
     def setup(self):
         """
-        Start IPyton kernel and set up sanitize patterns.
+        Start the IPython kernel. The sanitize patterns of the session are
+        read when the notebook is collected (see get_sanitizer).
         """
         self.fixture_cell = None
-        self.kernel = RunningKernel()
-        self.setup_sanitize_patterns()
-
-    def get_sanitize_files(self):
+        durations = getattr(self.config, '_nb_durations', None)
+        if durations is not None:
+            durations.add(self)
+        if self.cached_pass:
+            # The cells are reported as passed without running them
+            return
+        with Timer(self.timings, 'setup'):
+            if self.background is None:
+                self.kernel = self.start_kernel()
+                self.submit_cells()
+
+    def start_kernel(self):
+        """ Take a kernel from the pool, or start a new one. """
+        with Timer(self.timings, 'kernel_start'):
+            pool = getattr(self.config, '_nb_kernel_pool', None)
+            if pool is not None:
+                kernel = pool.acquire()
+            else:
+                kernel = RunningKernel(getattr(self.config, '_nb_zygote',
+                                               None))
+                self.timings['kernel_boot'] = kernel.boot_time
+            # The peak memory of the notebook does not include the one of
+            # the notebooks run before by a pooled kernel
+            kernel.reset_peak_rss()
+            return kernel
+
+    def submit_cells(self):
+        """
+        With --nb-pipeline, queue all the selected cells in the kernel up
+        front. The messages of the cells are then sorted by request in the
+        background, and every IPyNbCell only waits for its own messages.
+        """
+        if not self.config.option.nb_pipeline or not self.selected_cells:
+            return
+        if any(cell.uses_helpers() or cell.measures_itself()
+               for cell in self.selected_cells):
+            # The profiler or tracemalloc are set up in the kernel before
+            # every cell, and the time and memory of a cell are only its
+            # own if it runs alone, so they are sent one by one
+            return
+        if not self.kernel.can_pipeline():
+            if not getattr(self.config, '_nb_pipeline_warned', False):
+                self.config._nb_pipeline_warned = True
+                warnings.warn('--nb-pipeline is ignored: the kernel client '
+                              'does not accept stop_on_error, the cells are '
+                              'sent one by one')
+            return
+        self.kernel.start_router()
+        for cell in self.selected_cells:
+            # Later cells have to run even if a cell fails, as they do
+            # when they are sent one by one
+            cell.msg_id = self.kernel.execute_cell_input(
+                cell.cell.source, allow_stdin=False, stop_on_error=False)
+
+    def resubmit_cells(self, cell):
         """
-        Return list of all sanitize files provided by the user on the command line.
+        Send again the pipelined cells queued after `cell`, which were lost
+        when the kernel was restarted.
+        """
+        if self.selected_cells is None or cell not in self.selected_cells:
+            return
+        for later in self.selected_cells[self.selected_cells.index(cell) + 1:]:
+            if later.msg_id is not None:
+                later.msg_id = self.kernel.execute_cell_input(
+                    later.cell.source, allow_stdin=False, stop_on_error=False)
+
+    def stop_kernel(self):
+        """ Give the kernel back to the pool, or stop it. """
+        if self.kernel is None:
+            return
+        with Timer(self.timings, 'kernel_stop'):
+            self.timings['kernel_peak_rss'] = self.kernel.peak_rss()
+            self.kernel.stop_router()
+            pool = getattr(self.config, '_nb_kernel_pool', None)
+            if pool is not None:
+                pool.release(self.kernel)
+            else:
+                self.kernel.stop()
+            self.kernel = None
 
-        N.B.: We only support one sanitize file at the moment, but
-              this is likely to change in the future
+    def run_in_background(self, scheduler):
+        """
+        Execute the scheduled cells in order (called from a worker thread
+        of the NotebookScheduler).
+        """
+        run = self.background
+        try:
+            if not scheduler.cancelled:
+                self.kernel = self.start_kernel()
+                self.submit_cells()
+            for cell in run.cells:
+                if scheduler.cancelled:
+                    break
+                try:
+                    run.set_result(cell, outs=cell.execute())
+                except Exception as e:
+                    run.set_result(cell, error=e)
+                if cell.must_stop():
+                    self.skip_reason = run.skip_reason = cell.stop_reason()
+                    break
+        except Exception as e:
+            # The kernel could not be started: every cell reports the error
+            for cell in run.cells:
+                run.set_result(cell, error=e)
+        finally:
+            try:
+                self.stop_kernel()
+            finally:
+                run.finish()
 
+    def stop_after(self, cell):
         """
-        if self.parent.config.option.sanitize_with is not None:
-            return [self.parent.config.option.sanitize_with]
-        else:
-            return []
+        Skip the cells after `cell`, which raised an error, and give the
+        kernel back straight away (--nb-stop-on-error).
+        """
+        self.skip_reason = cell.stop_reason()
+        self.stop_kernel()
 
-    def setup_sanitize_patterns(self):
+    def report_profile(self):
         """
-        Read sanitize patterns from config file (of one was provided on the command line).
+        Merge the profiles of the cells (--nb-profile) in one pstats file
+        for the notebook, and add its summary to the report of the last
+        cell.
         """
-        self.sanitize_patterns = {}
+        cells = self.selected_cells or []
+        fnames = [cell.profile_file() for cell in cells if cell.profiled]
+        stats = load_profile(fnames)
+        if stats is None:
+            return
+        fname = os.path.dirname(fnames[0]) + '.pstats'
+        stats.dump_stats(fname)
+        cells[-1].add_report_section(
+            'teardown', 'notebook profile',
+            format_profile(fname, self.config.option.nb_profile_top))
+
+    def write_back(self):
+        """
+        Write the execution time of the cells that ran to their metadata
+        (--nb-record-baseline), and the new outputs of the cells whose
+        outputs did not match (--nb-update-references).
+        """
+        times = {}
+        if self.config.option.nb_record_baseline:
+            for cell in self.selected_cells or []:
+                elapsed = cell.wall_time()
+                if elapsed is not None:
+                    times[cell.index] = round(elapsed, 3)
+        outputs = dict((cell.index, cell.new_outputs)
+                       for cell in self.selected_cells or []
+                       if cell.new_outputs is not None)
+        if not times and not outputs:
+            return
+
+        def update(nb):
+            if nb.get('nbformat') != 4:
+                # The cells of older formats were converted when read
+                return False
+            for index, elapsed in times.items():
+                metadata = nb['cells'][index].setdefault('metadata', {})
+                options = metadata.setdefault(METADATA_KEY, {})
+                options['baseline_time'] = elapsed
+            for index, (cell_outputs, count) in outputs.items():
+                nb['cells'][index]['outputs'] = cell_outputs
+                nb['cells'][index]['execution_count'] = count
+            return True
 
-        for fname in self.get_sanitize_files():
-            with open(fname, 'r') as f:
-                self.sanitize_patterns.update(get_sanitize_patterns(f.read()))
+        update_notebook(str(self.fspath), update)
 
     def teardown(self):
-        self.kernel.stop()
+        with Timer(self.timings, 'teardown'):
+            if self.background is not None:
+                # The worker gives the kernel back when the notebook is done
+                self.background.wait()
+            else:
+                self.stop_kernel()
+        self.report_profile()
+        self.write_back()
+
+        result_cache = getattr(self.config, '_nb_result_cache', None)
+        if (result_cache is not None and not self.cached_pass and
+                self.passed_cells == self.ncells):
+            result_cache.record_pass(self.result_key, str(self.fspath))
 
 
 class IPyNbCell(pytest.Item):
-    def __init__(self, name, parent, cell_num, cell):
+    def __init__(self, name, parent, cell_num, cell, reference=None,
+                 index=None):
         super(IPyNbCell, self).__init__(name, parent)
 
         # Store reference to parent IPynbFile so that we have access
@@ -208,8 +1674,43 @@ class IPyNbCell(pytest.Item):
         self.cell_num = cell_num
         self.cell = cell
 
+        # Position of the cell in the notebook (cell_num only counts the
+        # code cells that are tested)
+        self.index = index
+
+        # Sanitized reference outputs (see get_output_digest)
+        if reference is None:
+            reference = get_output_digest(cell.outputs,
+                                          get_sanitizer(self.config).sanitize)
+        self.reference = reference
+
         self.comparisons = None
 
+        # Content of the execute_reply of the last execution
+        self.execute_reply = None
+
+        # Request of the cell when it was queued by IPyNbFile.submit_cells()
+        self.msg_id = None
+
+        # Whether the outputs were compared while they arrived
+        self.streamed = False
+
+        # Whether the last execution was profiled (--nb-profile) and its
+        # memory traced (--nb-tracemalloc)
+        self.profiled = False
+        self.traced = False
+
+        # Peak resident memory of the kernel before the last execution
+        self.peak_rss_before = None
+
+        # With --nb-update-references, the outputs of the execution to be
+        # written to the notebook, and the execution count, if they did
+        # not match
+        self.new_outputs = None
+
+        # Durations of the phases of the cell (see durations.py)
+        self.timings = {}
+
     """ *****************************************************
         *****************  TESTING FUNCTIONS  ***************
         ***************************************************** """
@@ -230,102 +1731,64 @@ class IPyNbCell(pytest.Item):
         description = "cell %d" % self.cell_num
         return self.fspath, 0, description
 
-    def compare_outputs(self, test, ref, skip_compare=('metadata',
-                                                       'image/png',
-                                                       'traceback',
-                                                       'latex',
-                                                       'prompt_number',
-                                                       'stdout',
-                                                       'stream',
-                                                       'output_type',
-                                                       'name',
-                                                       'execution_count'
-                                                       )):
+    def get_option(self, name, default=None):
+        """
+        Return the option `name` of the plugin for this cell, looking in
+        the cell metadata first and then in the notebook metadata.
+        """
+        for metadata in (self.cell.metadata, self.parent.nb.metadata):
+            options = metadata.get(METADATA_KEY, {})
+            if name in options:
+                return options[name]
+        return default
+
+    def timeout_error(self, msg_id, timeout):
+        """
+        Stop the execution of a cell that timed out and return the error to
+        be raised. The kernel is interrupted, and restarted if it does not
+        stop within the grace period (--nb-interrupt-grace).
+        """
+        return NbCellError(self.cell_num,
+                           "Timeout of %g seconds exceeded, %s"
+                           % (timeout, self.stop_execution(msg_id)),
+                           self.cell.source,
+                           '')
+
+    def stop_execution(self, msg_id):
+        """
+        Interrupt the execution of the cell, restarting the kernel if it
+        does not stop within the grace period (--nb-interrupt-grace).
+        Returns what was done, for the error messages.
+        """
+        kernel = self.parent.kernel
+        grace = self.config.option.nb_interrupt_grace
+        if kernel.interrupt(msg_id, timeout=grace):
+            return "the kernel was interrupted"
+        kernel.restart()
+        self.parent.resubmit_cells(self)
+        return ("the kernel did not stop %g seconds after the "
+                "interrupt and was restarted" % grace)
+
+    def compare_outputs(self, test, ref):
+        """
+        Compare the outputs of the execution, `test`, with the digest of the
+        reference outputs, `ref` (see get_output_digest). The differences
+        are stored in self.comparisons.
+        """
         self.comparisons = []
 
-        # For every different key, we will store the outputs in a
-        # single string, in a dictionary with the same keys
-        # At the end, every dictionary entry will be compared
-        # We skip the unimportant keys in the 'skip_compare' list
-        #
-        # We concatenate the outputs because the ipython notebook produces
-        # them in a random number of dictionaries. So, it is easier
-        # to compare only one chunk of data
-        testing_outs, reference_outs = {}, {}
-
-        # Check the references (embedded notebook outputs)
-        # and start appendind the outputs for every
-        # different key. The entries of every output have the structure:
-        #
-        # {'output_type': 'stream', 'stream': 'stdout',
-        #  'text': "The time is: 11:44:21\nToday's date is: 13/03/15\n"}
-        #
-        # We discard the keys from the skip_compare list
-        for reference in ref:
-            for key in reference.keys():
-                if key not in skip_compare:
-
-                    # In the EXECUTION, we already processed the display_data
-                    # (or execute_count)
-                    # kind of dictionary entries. display_data has a 'data'
-                    # sub dictionary which contains the relevant information
-                    # about the Figure: 'text/plain', 'image/png', ...
-                    #
-                    # EXAMPLES:
-                    #
-                    # display_data type:
-                    # {'output_type': 'display_data', 'image/png': 'iVBORw0...
-                    #  'text/plain': <matplotlib.figure.Figure at 0x7f9ca97cc890>
-                    #  'metadata': {} }
-                    #
-                    #
-                    # Hence, we look into these sub dictionary entries and
-                    # append them to the corresponding dictionary entry
-                    # in the reference outputs
-                    #
-                    if key == 'data':
-                        for data_key in reference[key].keys():
-                            # Filter the keys in the SUB-dictionary again
-                            if data_key not in skip_compare:
-                                try:
-                                    reference_outs[data_key] += self.sanitize(reference[key][data_key])
-                                except:
-                                    reference_outs[data_key] = self.sanitize(reference[key][data_key])
-
-
-                    # NOTICE: that execute_result (similar for figures than
-                    # display_data but without the png or picture hex)
-                    # has an 'execution_count' key
-                    # which we skip because is not relevant for now.
-                    # We could use this in the future if we wanted executions
-                    # in the same order than the reference
-                    #
-                    # execute_result type:
-                    # {'output_type': 'execute_result', 'execution_count': 9,
-                    #  'text/plain': '<matplotlib.image.AxesImage at 0x7f9ca8f058d0>',
-                    #  'metadata': {}}
-
-                    # Otherwise, just create a normal dictionary entry from
-                    # one of the keys of the dictionary
-                    else:
-                        # Create the dictionary entries on the fly, from the
-                        # existing ones to be compared
-                        try:
-                            reference_outs[key] += self.sanitize(reference[key])
-                        except:
-                            reference_outs[key] = self.sanitize(reference[key])
-
-        # the same for the testing outputs (the cells that are boing executed)
-        # display_data cells were already processed! (see the execution loop)
-        for testing in test:
-            for key in testing.keys():
-                # For debugging:
-                # print 'TESTING:', key, '---', testing[key]
-                if key not in skip_compare:
-                    try:
-                        testing_outs[key] += self.sanitize(testing[key])
-                    except:
-                        testing_outs[key] = self.sanitize(testing[key])
+        # The reference digest was built when the notebook was collected,
+        # we only process the testing outputs (the cells that are being
+        # executed). display_data cells were already processed! (see the
+        # execution loop)
+        testing_outs = get_output_digest(test, self.sanitize)
+        reference_outs = ref
+
+        # With a tolerance, the numbers of the text outputs do not have to
+        # be identical (see numeric.py)
+        rtol = self.get_option('rtol', self.config.option.nb_rtol)
+        atol = self.get_option('atol', self.config.option.nb_atol)
+        numeric = rtol is not None or atol is not None
 
         for key in reference_outs.keys():
             # For debugging:
@@ -347,16 +1810,26 @@ class IPyNbCell(pytest.Item):
                 # print testing_outs[key]
                 # print reference_outs[key]
 
+                difference = ''
+                if numeric and key in NUMERIC_COMPARE:
+                    difference = compare_numbers(testing_outs[str(key)],
+                                                 reference_outs[key],
+                                                 float(rtol or 0),
+                                                 float(atol or 0))
+                    if difference is None:
+                        continue
+                    difference = ' (%s)' % difference
+
                 self.comparisons.append(bcolors.OKBLUE
-                                        + " mismatch '%s'\n" % key
+                                        + " mismatch '%s'%s\n"
+                                        % (key, difference)
                                         + bcolors.FAIL
-                                        + "<<<<<<<<<<<< Reference output from ipynb file:"
-                                        + bcolors.ENDC)
-                self.comparisons.append(reference_outs[key])
-                self.comparisons.append(bcolors.FAIL
-                                        + '============ disagrees with newly computed (test) output:  '
+                                        + "<<<<<<<<<<<< Reference output from ipynb file (-) "
+                                          "vs newly computed (test) output (+):"
                                         + bcolors.ENDC)
-                self.comparisons.append(testing_outs[str(key)])
+                self.comparisons.extend(self.diff_outputs(key,
+                                                          reference_outs[key],
+                                                          testing_outs[str(key)]))
                 self.comparisons.append(bcolors.FAIL
                                         + '>>>>>>>>>>>>'
                                         + bcolors.ENDC)
@@ -370,6 +1843,90 @@ class IPyNbCell(pytest.Item):
                 return False
         return True
 
+    def diff_outputs(self, key, ref, test):
+        """
+        Return the lines reporting the differences between the reference
+        and the test versions of the output `key`: only the changed lines
+        and their context (see diff.py), up to --nb-diff-max-lines lines.
+        With --nb-diff-dir, both versions are also written to files.
+        """
+        ref, test = ('%s' % (ref,), '%s' % (test,))
+        max_lines = self.config.option.nb_diff_max_lines or None
+        lines = []
+        for line in unified_diff(ref, test, max_lines=max_lines):
+            if line.startswith('-'):
+                line = bcolors.FAIL + line + bcolors.ENDC
+            elif line.startswith('+'):
+                line = bcolors.OKGREEN + line + bcolors.ENDC
+            lines.append(line)
+        if not lines:
+            lines.append('(the outputs only differ in their line endings)')
+
+        diff_dir = self.config.option.nb_diff_dir
+        if diff_dir:
+            if not os.path.isdir(diff_dir):
+                os.makedirs(diff_dir)
+            name = re.sub(r'[^\w.-]+', '_', '%s-cell%d-%s'
+                          % (self.parent.nodeid, self.cell_num, key))
+            for suffix, text in (('reference', ref), ('test', test)):
+                fname = os.path.join(diff_dir, '%s.%s.txt' % (name, suffix))
+                with open(fname, 'wb') as f:
+                    f.write(to_bytes(text))
+            lines.append('Full outputs: %s.{reference,test}.txt'
+                         % os.path.join(diff_dir, name))
+        return lines
+
+    def compare_images(self, outs):
+        """
+        Compare the image/png outputs of the execution with the ones stored
+        in the notebook (see images.compare_png). The differences are
+        stored in self.comparisons.
+        """
+        self.comparisons = []
+        test_images = [out['image/png'] for out in outs if 'image/png' in out]
+        ref_images = [out.data['image/png'] for out in self.cell.outputs
+                      if 'image/png' in out.get('data', {})]
+        if len(test_images) != len(ref_images):
+            self.comparisons.append(bcolors.FAIL
+                                    + "number of images: TESTING %d != "
+                                      "REFERENCE %d"
+                                    % (len(test_images), len(ref_images))
+                                    + bcolors.ENDC)
+            return False
+
+        pixel_tol = self.get_option('image_pixel_tol',
+                                    self.config.option.nb_image_pixel_tol)
+        rms_tol = self.get_option('image_rms_tol',
+                                  self.config.option.nb_image_rms_tol)
+        hash_distance = self.get_option(
+            'image_hash_distance', self.config.option.nb_image_hash_distance)
+        reference_cell = []
+
+        from .nbreader import read_cell
+        from .images import compare_png
+
+        def load_ref(i):
+            # The notebook was read without the images, read them (once)
+            # only when they have to be decoded
+            if not reference_cell:
+                with self.parent.fspath.open('rb') as f:
+                    reference_cell.append(read_cell(f, self.index))
+            outputs = reference_cell[0]['outputs']
+            return [out['data']['image/png'] for out in outputs
+                    if 'image/png' in out.get('data', {})][i]
+
+        for i, (test, ref) in enumerate(zip(test_images, ref_images)):
+            difference = compare_png(test, ref, pixel_tol, rms_tol,
+                                     load_ref=lambda: load_ref(i),
+                                     max_hash_distance=hash_distance)
+            if difference is not None:
+                self.comparisons.append(bcolors.OKBLUE
+                                        + " mismatch 'image/png' (image %d): "
+                                        % (i + 1)
+                                        + bcolors.FAIL + difference
+                                        + bcolors.ENDC)
+                return False
+        return True
 
     """ *****************************************************
         ***************************************************** """
@@ -380,23 +1937,85 @@ class IPyNbCell(pytest.Item):
         It is very common for ipython notebooks to run through assuming a
         single kernel.
         """
-        # Execute the code from the current cell and get the msg_id
-        # of the shell process.
-        msg_id = self.parent.kernel.execute_cell_input(
-            self.cell.source, allow_stdin=False)
+        if self.parent.cached_pass:
+            # Passed in a previous run with the same code and outputs
+            return
+        try:
+            self.run_and_check()
+        finally:
+            if self.profiled:
+                self.add_report_section(
+                    'call', 'profile',
+                    format_profile(self.profile_file(),
+                                   self.config.option.nb_profile_top))
+
+    def run_and_check(self):
+        if self.parent.background is not None:
+            # The notebook is executed by a worker of the NotebookScheduler,
+            # we only have to wait for the outputs of this cell
+            outs = self.parent.background.get_result(self)
+        else:
+            if self.parent.skip_reason is not None:
+                pytest.skip(self.parent.skip_reason)
+            try:
+                outs = self.execute()
+            finally:
+                if self.must_stop():
+                    self.parent.stop_after(self)
+
+        if self.must_stop():
+            # The error stopped the notebook, it is the one to report
+            raise NbCellError(self.cell_num,
+                              "%s: %s" % (self.execute_reply.get('ename'),
+                                          self.execute_reply.get('evalue')),
+                              self.cell.source,
+                              '\n' + '\n'.join(
+                                  self.execute_reply.get('traceback', [])))
+
+        with Timer(self.timings, 'compare'):
+            self.check_outputs(outs)
+        self.check_memory()
+        self.check_time()
+        self.parent.passed_cells += 1
+
+    def execute(self):
+        """
+        Execute the cell in the kernel of the parent IPyNbFile and return
+        the list of outputs it produced.
+
+        The end of the cell is detected with the messages of its own
+        execute_request: the 'idle' status in the iopub channel and the
+        execute_reply in the shell channel.
+        """
+        kernel = self.parent.kernel
+        self.timings['messages'] = 0
 
         # Time for the reply of the cell execution
-        timeout = 2000
+        timeout = float(self.get_option('timeout',
+                                        self.config.option.nb_cell_timeout))
+
+        if self.msg_id is None:
+            self.prepare_kernel(timeout)
+        memory = (kernel.rss(), kernel.peak_rss())
+        start = timer()
+
+        # Execute the code from the current cell and get the msg_id
+        # of the shell process. With --nb-pipeline the cell was already
+        # sent to the kernel by IPyNbFile.submit_cells()
+        if self.msg_id is not None:
+            msg_id, self.msg_id = self.msg_id, None
+        else:
+            msg_id = kernel.execute_cell_input(self.cell.source,
+                                               allow_stdin=False)
+        deadline = time.time() + timeout
 
         # This list stores the output information for the entire cell
         outs = []
 
-        # Wait for the execution reply (we can see this in the msg_type)
-        # This execution produces a dictionary where a status string can be
-        # obtained: 'ok' OR 'error' OR 'abort'
-        # We can also get how many cells have been executed
-        # until here, with the 'execution_count' entry
-        # self.parent.kernel.kc.get_shell_msg(timeout=timeout)
+        # With --nb-stream-compare the outputs are compared as they arrive
+        # and not stored (except the images, compared at the end)
+        comparator = self.stream_comparator()
+        self.streamed = comparator is not None
 
         while True:
             """
@@ -406,17 +2025,16 @@ class IPyNbCell(pytest.Item):
             until we reach the end of the cell.
             """
             try:
-                # Get one message at a time, per code block inside the cell
-                msg = self.parent.get_kernel_message(timeout=1.)
+                # Get one message at a time, per code block inside the cell.
+                # Messages produced by other requests (e.g. late outputs
+                # from a previous cell) do not belong to this cell and are
+                # not returned
+                msg = kernel.get_cell_message(
+                    msg_id, timeout=max(deadline - time.time(), 0))
 
             except Empty:
-                # This is not working: ! The code will not be checked
-                # if the time is out (when the cell stops to be executed?)
-                # raise NbCellError("Timeout of %d seconds exceeded"
-                #                      " executing cell: %s" (timeout,
-                #                                             self.cell.input))
-                # Just break the loop when the output is empty
-                break
+                raise self.timeout_error(msg_id, timeout)
+            self.timings['messages'] += 1
 
             """
             Now that we have the output from a piece of code
@@ -426,8 +2044,6 @@ class IPyNbCell(pytest.Item):
             the notebook was executed)
             """
 
-            # print msg
-
             # Firstly, get the msg type from the cell to know if
             # the output comes from a code
             # It seems that the type 'stream' is irrelevant
@@ -439,6 +2055,11 @@ class IPyNbCell(pytest.Item):
             # being executed at any given time, these messages contain a
             # re-broadcast of the code portion of an execute_request,
             # along with the execution_count.
+            #
+            # When the kernel starts to execute code, it will enter the 'busy'
+            # state and when it finishes, it will enter the 'idle' state.
+            # The 'idle' status of our request is the last iopub message
+            # of the cell.
             if msg_type == 'status':
                 if reply['execution_state'] == 'idle':
                     break
@@ -449,46 +2070,14 @@ class IPyNbCell(pytest.Item):
             elif msg_type.startswith('comm'):
                 continue
             elif msg_type == 'execute_reply':
-                # print msg
                 continue
-            # If there is no more output, continue with the executions
-            # (it will break if it is empty, with the previous statements)
-            #
-            # REF:
-            # This message type is used to clear the output that is
-            # visible on the frontend
-            # elif msg_type == 'clear_output':
-            #     outs = []
-            #     continue
-
-            # I added the msg_type 'idle' condition (when the cell stops)
-            # so we get a complete cell output
-            # REF:
-            # When the kernel starts to execute code, it will enter the 'busy'
-            # state and when it finishes, it will enter the 'idle' state.
-            # The kernel will publish state 'starting' exactly
-            # once at process startup.
-            # elif (msg_type == 'clear_output'
-            #       and msg_type['execution_state'] == 'idle'):
-            #     outs = []
-            #     continue
-
-            # WE COULD ADD HERE a condition for the 'error' message type
-            # Making the test to fail
 
             """
             Now we get the reply from the piece of code executed
             and analyse the outputs
             """
-            reply = msg['content']
             out = NotebookNode(output_type=msg_type)
 
-            # print '---------------------------- CELL ----------------------'
-            # print msg_type
-            # print reply
-            # print '---------------------------- CELL ORIGINAL----------------'
-            # print self.cell.outputs
-
             # Now check what type of output it is
             if msg_type == 'stream':
                 out.stream = reply['name']
@@ -514,36 +2103,269 @@ class IPyNbCell(pytest.Item):
             # We NO longer replace 'image/png' by 'png' since the last version
             # of the notebook format is more consistent. We also DO NOT
             # replace any .xml string, it's not neccesary
-
-            # elif msg_type in ('display_data', 'execute_result'):
             elif msg_type in ('display_data', 'execute_result'):
                 out['metadata'] = reply['metadata']
-                for mime, data in reply['data'].iteritems():
-                # This could be useful for reference or backward compatibility
-                #     attr = mime.split('/')[-1].lower()
-                #     attr = attr.replace('+xml', '').replace('plain', 'text')
-                #     setattr(out, attr, data)
-
                 # Return the relevant entries from data:
                 # plain/text, image/png, execution_count, etc
-                # We coul use a mime types list for this (MAYBE)
+                for mime, data in reply['data'].items():
                     setattr(out, mime, data)
 
-                # if msg_type == 'execute_result':
-                #     out.prompt_number = reply['execution_count']
-
             else:
                 print("unhandled iopub msg:", msg_type)
 
+            if comparator is not None:
+                if comparator.mismatch is None and not comparator.feed(out):
+                    if self.config.option.nb_stream_interrupt:
+                        # Do not wait for the rest of the cell
+                        recovery = self.stop_execution(msg_id)
+                        raise self.stream_error(comparator, recovery)
+                if 'image/png' in out:
+                    outs.append(NotebookNode(output_type=msg_type,
+                                             **{'image/png': out['image/png']}))
+                continue
+
             outs.append(out)
 
         """
-        This message is the last message of the cell, which contains no output.
-        It only indicates whether the entire cell ran successfully or if there
-        was an error.
+        The execute_reply is the last message of the cell, which contains
+        no output. It only indicates whether the entire cell ran successfully
+        or if there was an error: 'ok' OR 'error' OR 'abort'
+        """
+        self.timings['execute'] = timer() - start
+        try:
+            with Timer(self.timings, 'drain'):
+                self.execute_reply = kernel.get_reply(
+                    msg_id, timeout=max(deadline - time.time(), 0))['content']
+        except Empty:
+            raise self.timeout_error(msg_id, timeout)
+        kernel.forget(msg_id)
+        self.measure_memory(memory, max(deadline - time.time(), 0))
+
+        if comparator is not None and not comparator.finish():
+            raise self.stream_error(comparator)
+
+        return outs
+
+    def profile_file(self):
+        """
+        The pstats file of the cell if it is profiled (--nb-profile), in a
+        directory per notebook, else None.
+        """
+        if not self.get_option('profile', self.config.option.nb_profile):
+            return None
+        name = re.sub(r'[^\w.-]+', '_', self.parent.nodeid)
+        return os.path.join(os.path.abspath(self.config.option.nb_profile_dir),
+                            name, 'cell%d.pstats' % self.cell_num)
+
+    def traces_memory(self):
+        """ Whether the memory allocated by the cell is traced. """
+        return bool(self.get_option('tracemalloc',
+                                    self.config.option.nb_tracemalloc) or
+                    self.get_option('max_traced_peak') is not None)
+
+    def uses_helpers(self):
+        """ Whether the kernel has to be set up before running the cell. """
+        return self.profile_file() is not None or self.traces_memory()
+
+    def measures_itself(self):
+        """
+        Whether the time or the memory of the cell are checked or recorded
+        (a time budget, a memory limit or --nb-record-baseline), which
+        needs the cell to run alone in the kernel.
+        """
+        if self.config.option.nb_record_baseline:
+            return True
+        if self.time_budget()[0] is not None:
+            return True
+        return any(self.get_option(option) is not None
+                   for option, measure, description in MEMORY_LIMITS)
+
+    def prepare_kernel(self, timeout):
+        """
+        Set up the kernel to trace and profile the next execution, which
+        has to be the one of this cell.
+        """
+        self.traced = self.traces_memory()
+        if self.traced:
+            self.parent.kernel.run_helper('trace_next_cell()',
+                                          timeout=timeout)
+        self.start_profile(timeout)
+
+    def start_profile(self, timeout):
+        fname = self.profile_file()
+        self.profiled = fname is not None
+        if not self.profiled:
+            return
+        if os.path.exists(fname):
+            os.remove(fname)
+        elif not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        self.parent.kernel.run_helper('profile_next_cell(%r)' % fname,
+                                      timeout=timeout)
+
+    def measure_memory(self, before, timeout):
+        """
+        Record the memory of the kernel after the execution: its resident
+        memory, its growth during the cell, the peak of the notebook, and
+        the peak allocated by the cell with tracemalloc. `before` is the
+        resident memory and the peak before the execution.
         """
-        # reply = msg['content']
+        kernel = self.parent.kernel
+        rss_before, self.peak_rss_before = before
+        rss = kernel.rss()
+        self.timings['rss'] = rss
+        if rss is not None and rss_before is not None:
+            self.timings['rss_growth'] = rss - rss_before
+        self.timings['peak_rss'] = kernel.peak_rss()
+        if self.traced:
+            peak = kernel.helper_value('traced_peak', timeout=timeout)
+            if peak != 'None':
+                self.timings['traced_peak'] = int(peak)
+
+    def check_memory(self):
+        """
+        Raise NbCellError if the memory used by the cell is above the limits
+        (in MB) of the cell or notebook metadata. The limits cannot be
+        checked if the memory of the kernel is not known.
+        """
+        errors = []
+        for option, measure, description in MEMORY_LIMITS:
+            limit = self.get_option(option)
+            value = self.timings.get(measure)
+            if limit is None or value is None:
+                continue
+            limit_bytes = float(limit) * 1024 ** 2
+            if (measure == 'peak_rss' and self.peak_rss_before is not None and
+                    self.peak_rss_before > limit_bytes):
+                # Only the cell that went over the limit fails
+                continue
+            if value > limit_bytes:
+                errors.append('%s: %.1f MB, above the limit of %g MB ("%s")'
+                              % (description, value / 1024. ** 2,
+                                 float(limit), option))
+        if errors:
+            raise NbCellError(self.cell_num,
+                              "Memory limit exceeded",
+                              self.cell.source,
+                              '\n' + '\n'.join(errors))
+
+    def wall_time(self):
+        """ Execution time of the cell, or None if it did not finish. """
+        if 'drain' not in self.timings:
+            return None
+        return self.timings['execute'] + self.timings['drain']
 
+    def time_budget(self):
+        """
+        Return the time budget of the cell in seconds and its description,
+        or (None, None): "max_time" seconds, or "max_time_ratio" times the
+        "baseline_time" recorded with --nb-record-baseline (the smallest
+        one if both are set).
+        """
+        budgets = []
+        max_time = self.get_option('max_time')
+        if max_time is not None:
+            budgets.append((float(max_time), '"max_time"'))
+        ratio = self.get_option('max_time_ratio')
+        baseline = self.cell.metadata.get(METADATA_KEY, {}).get(
+            'baseline_time')
+        if ratio is not None and baseline is not None:
+            budgets.append((float(ratio) * baseline,
+                            '%g x the baseline of %.3fs'
+                            % (float(ratio), baseline)))
+        if not budgets:
+            return None, None
+        return min(budgets)
+
+    def check_time(self):
+        """
+        Fail (or warn, see --nb-budget-action) if the cell took longer than
+        its time budget.
+        """
+        if self.config.option.nb_record_baseline:
+            return
+        elapsed = self.wall_time()
+        budget, description = self.time_budget()
+        if budget is None or elapsed is None or elapsed <= budget:
+            return
+        msg = ('cell took %.3fs, above its time budget of %.3fs (%s)'
+               % (elapsed, budget, description))
+        action = self.get_option('budget_action',
+                                 self.config.option.nb_budget_action)
+        if action == 'warn':
+            warnings.warn('%s::cell %d: %s'
+                          % (self.parent.nodeid, self.cell_num, msg))
+            return
+        raise NbCellError(self.cell_num,
+                          "Time budget exceeded",
+                          self.cell.source,
+                          '\n' + msg)
+
+    def must_stop(self):
+        """
+        Whether the notebook must stop after this cell (--nb-stop-on-error):
+        its execution raised an error, and the stored outputs of the cell
+        do not have one (i.e. the error is not expected).
+        """
+        if (self.execute_reply is None or
+                self.execute_reply.get('status') != 'error'):
+            return False
+        if not self.get_option('stop_on_error',
+                               self.config.option.nb_stop_on_error):
+            return False
+        return not any(out.get('output_type') == 'error'
+                       for out in self.cell.outputs)
+
+    def stop_reason(self):
+        return ('cell %d raised %s: the rest of the notebook was skipped'
+                % (self.cell_num, self.execute_reply.get('ename', 'an error')))
+
+    def stream_comparator(self):
+        """
+        Return the StreamComparator for the outputs of the cell, or None if
+        they are compared once the cell finished.
+        """
+        if not self.get_option('stream_compare',
+                               self.config.option.nb_stream_compare):
+            return None
+        # The outputs are needed to update the references
+        if self.config.option.nb_update_references:
+            return None
+        # The numbers are compared with a tolerance on the whole outputs
+        if (self.get_option('rtol', self.config.option.nb_rtol) is not None or
+                self.get_option('atol', self.config.option.nb_atol) is not None):
+            return None
+        return StreamComparator(self.reference, self.sanitize, SKIP_COMPARE)
+
+    def stream_error(self, comparator, recovery=None):
+        """ Error of a mismatch found by the StreamComparator. """
+        key, line, ref_line, test_line = comparator.mismatch
+        if line is None and ref_line is None:
+            comparisons = [bcolors.FAIL + "missing key: '%s'" % key
+                           + bcolors.ENDC]
+        else:
+            where = " at line %d" % line if line is not None else ""
+            comparisons = [bcolors.OKBLUE + " mismatch '%s'%s" % (key, where)
+                           + bcolors.ENDC]
+            if ref_line is not None:
+                comparisons.append(bcolors.FAIL + '-' + ref_line
+                                   + bcolors.ENDC)
+            if test_line is not None:
+                comparisons.append(bcolors.OKGREEN + '+' + test_line
+                                   + bcolors.ENDC)
+        if recovery is not None:
+            comparisons.append("The cell was stopped: %s" % recovery)
+        self.comparisons = comparisons
+        return NbCellError(self.cell_num,
+                           "Error with cell",
+                           self.cell.source,
+                           '\n'.join(comparisons))
+
+    def check_outputs(self, outs):
+        """
+        Compare the outputs of the execution with the ones stored in the
+        notebook, raising NbCellError if they do not match.
+        """
         failed = False
 
         # THIS COMPARISON IS ONLY WHEN THE OUTPUT DICTIONARIES
@@ -562,7 +2384,15 @@ class IPyNbCell(pytest.Item):
         # If the outputs are the same, compare them line by line
         # else:
         # for out, ref in zip(outs, self.cell.outputs):
-        if not self.compare_outputs(outs, self.cell.outputs):
+        # With --nb-stream-compare the text outputs were already compared
+        # during the execution, but not the images
+        if not self.streamed and not self.compare_outputs(outs,
+                                                          self.reference):
+            failed = True
+        elif (self.get_option('compare_images',
+                              self.config.option.nb_compare_images) and
+                not self.compare_images(outs)):
+            # The images are only decoded when the text outputs match
             failed = True
 
         # if reply['status'] == 'error':
@@ -577,6 +2407,12 @@ class IPyNbCell(pytest.Item):
             matches the outputs in the existing notebook.
             This code is taken from [REF].
             """
+            if self.config.option.nb_update_references:
+                reply = self.execute_reply or {}
+                self.new_outputs = (nbformat_outputs(outs, reply),
+                                    reply.get('execution_count'))
+                self.comparisons.append("The outputs stored in the notebook "
+                                        "are updated (--nb-update-references)")
             raise NbCellError(self.cell_num,
                               # Still needs correction. We could
                               # add a description
@@ -591,9 +2427,6 @@ class IPyNbCell(pytest.Item):
         fix universal newlines, strip trailing newlines,
         and normalize likely random values (memory addresses and UUIDs)
         """
-        if not isinstance(s, basestring):
-            return s
-
         """
         re.sub matches a regex and replaces it with another. It
         is used to find finmag stamps (Time and date followed by INFO,
@@ -604,28 +2437,12 @@ class IPyNbCell(pytest.Item):
         is passed when py.test is called. Otherwise, the strings
         are not processed
         """
-        for regex, replace in self.parent.sanitize_patterns.iteritems():
-            s = re.sub(regex, replace, s)
+        start = timer()
+        # Not the sanitizer of the parent: with --nb-workers the cells are
+        # executed (and their outputs streamed) before the setup of the
+        # notebook
+        s = get_sanitizer(self.config).sanitize(s)
+        self.timings['sanitize'] = (self.timings.get('sanitize', 0) +
+                                    timer() - start)
         return s
 
-
-def get_sanitize_patterns(string):
-    """
-    *Arguments*
-
-    string:  str
-
-        String containing a list of regex-replace pairs as would be
-        read from a sanitize config file.
-
-    *Returns*
-
-    A dictionary of regex-replace pairs. If the input string contains
-    the same regex multiple times, the last one will take effect.
-
-    """
-    matches = re.findall('^regex: (.*)$\n^replace: (.*)$',
-                         string,
-                         flags=re.MULTILINE)
-    pats = {key: val for (key, val) in matches}
-    return pats
@@ -0,0 +1,125 @@
+"""
+Sanitizing of the notebook outputs before they are compared.
+
+The regex-replace pairs are read from the files passed with --sanitize-with,
+compiled once per session and applied in the order of the files.
+
+"""
+
+import re
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    OrderedDict = dict
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def get_sanitize_patterns(string):
+    """
+    *Arguments*
+
+    string:  str
+
+        String containing a list of regex-replace pairs as would be
+        read from a sanitize config file.
+
+    *Returns*
+
+    An ordered dictionary of regex-replace pairs, in the order in which
+    they appear in the string. If the input string contains the same regex
+    multiple times, the last one will take effect.
+
+    """
+    matches = re.findall('^regex: (.*)$\n^replace: (.*)$',
+                         string,
+                         flags=re.MULTILINE)
+    pats = OrderedDict()
+    for (key, val) in matches:
+        pats[key] = val
+    return pats
+
+
+class Sanitizer(object):
+    """
+    Apply a list of regex-replace pairs to the outputs of the cells.
+
+    The regular expressions are compiled once and applied one after the
+    other, in order. With `single_pass=True` they are merged into a single
+    alternation, so every string is scanned only once. This is only done
+    when it is possible (no groups in the patterns, no escapes or group
+    references in the replacements and no global inline flags), and it
+    differs from the sequential application in two corner cases: at a given
+    position the first pattern that matches wins, and the replaced text is
+    not scanned again by the following patterns.
+
+    Note that a single pass is not always faster: the re module searches
+    quickly for the literal prefix of a single pattern, which is lost in the
+    alternation, and calls back into Python for every match (see
+    benchmarks/bench_sanitize.py).
+    """
+    def __init__(self, patterns, single_pass=False):
+        self.patterns = [(re.compile(regex), replace)
+                         for regex, replace in patterns.items()]
+        self.merged = None
+        if single_pass:
+            self.merged = self.merge(self.patterns)
+
+        # Identifies the patterns, e.g. for caching sanitized outputs
+        import hashlib
+        self.fingerprint = hashlib.sha1(repr(
+            ([(regex.pattern, replace) for regex, replace in self.patterns],
+             self.merged is not None)).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def merge(patterns):
+        """
+        Return the single compiled alternation equivalent to `patterns`,
+        or None if they cannot be merged.
+        """
+        if not patterns:
+            return None
+        for regex, replace in patterns:
+            if (regex.groups or '\\' in replace or
+                    regex.flags & ~re.UNICODE):
+                return None
+        try:
+            # The empty group at the end of every alternative tells which
+            # one matched. Groups around the alternatives would be simpler,
+            # but they prevent the re module from skipping quickly to the
+            # positions where one of the patterns can start
+            return re.compile('|'.join('(?:%s)()' % regex.pattern
+                                       for regex, replace in patterns))
+        except re.error:
+            return None
+
+    @classmethod
+    def from_files(cls, fnames, single_pass=False):
+        patterns = OrderedDict()
+        for fname in fnames:
+            with open(fname, 'r') as f:
+                patterns.update(get_sanitize_patterns(f.read()))
+        return cls(patterns, single_pass=single_pass)
+
+    def _replace(self, match):
+        # Every alternative has a single (empty) group, so the index of the
+        # last matched group tells which pattern matched
+        return self.patterns[match.lastindex - 1][1]
+
+    def sanitize(self, s):
+        """
+        Return the sanitized version of `s` (non-string values are
+        returned unchanged).
+        """
+        if not isinstance(s, string_types):
+            return s
+        if self.merged is not None:
+            return self.merged.sub(self._replace, s)
+        for regex, replace in self.patterns:
+            s = regex.sub(replace, s)
+        return s
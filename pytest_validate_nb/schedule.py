@@ -0,0 +1,145 @@
+"""
+Distribution of the notebooks between CI nodes (--nb-shard), and their
+order in a session (--nb-order).
+
+The notebooks are assigned to the shards with the longest processing time
+first rule: from the longest to the shortest, every notebook goes to the
+shard with the least work so far. The longest run of a shard is then at
+most 4/3 of the optimal one, and usually close to total/n.
+
+The duration of a notebook is the one recorded in earlier runs: the
+--nb-durations-json file given with --nb-shard-durations, or else (only to
+order the notebooks) the durations that every session stores in the pytest
+cache. The cache of a CI node only has the notebooks that node ran, so the
+shards are never balanced with it: the nodes would not compute the same
+shards. Notebooks without history are estimated from their number of cells,
+with the average time per cell of the notebooks that have one (or one second
+per cell).
+
+With several workers (--nb-workers), the longest notebooks are started
+first, so that a long notebook does not start last and run alone while the
+other workers are idle.
+
+"""
+
+import argparse
+import json
+
+# Key of the recorded durations in the pytest cache
+HISTORY_KEY = 'pytest_validate_nb/durations'
+
+
+def parse_shard(value):
+    """ Parse the 'i/n' argument of --nb-shard into (i, n). """
+    try:
+        i, n = [int(part) for part in value.split('/')]
+    except ValueError:
+        i = n = 0
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError(
+            "expected i/n with 1 <= i <= n, e.g. 2/4, got %r" % value)
+    return i, n
+
+
+def complete_totals(records):
+    """
+    Durations of the notebooks of Durations.records() that ran all their
+    cells, by notebook.
+    """
+    return dict((record['notebook'], record['total'])
+                for record in records if record.get('complete'))
+
+
+def load_history(cache=None, fname=None):
+    """
+    Recorded durations of the notebooks: from the JSON file of
+    --nb-durations-json `fname` if given, else from the pytest `cache`.
+    """
+    if fname is not None:
+        with open(fname, 'r') as f:
+            return complete_totals(json.load(f)['notebooks'])
+    if cache is None:
+        return {}
+    return cache.get(HISTORY_KEY, {})
+
+
+def load_shard_history(fname=None):
+    """
+    Recorded durations used to balance the shards: the ones of the file
+    `fname` if given, else none (the notebooks are estimated from their
+    number of cells). The pytest cache is not used, since every node only
+    records the notebooks it ran.
+    """
+    if fname is None:
+        return {}
+    return load_history(fname=fname)
+
+
+def record_history(cache, records):
+    """ Store the durations of the notebooks that ran in the cache. """
+    totals = complete_totals(records)
+    if totals:
+        history = cache.get(HISTORY_KEY, {})
+        history.update(totals)
+        cache.set(HISTORY_KEY, history)
+
+
+def estimate_durations(notebooks, history):
+    """
+    Duration of the notebooks, given as {name: number of cells}, from the
+    `history` or else from their number of cells.
+    """
+    known = [(history[name], n) for name, n in notebooks.items()
+             if name in history]
+    known_cells = sum(n for duration, n in known)
+    per_cell = 1.
+    if known_cells:
+        per_cell = sum(duration for duration, n in known) / known_cells
+    return dict((name, history[name] if name in history else per_cell * n)
+                for name, n in notebooks.items())
+
+
+def assign_shards(durations, n):
+    """
+    Assign the notebooks, given as {name: duration}, to `n` shards with the
+    longest processing time first rule. Returns the list of names of every
+    shard. Ties are broken by name, so every node computes the same shards.
+    """
+    shards = [[] for i in range(n)]
+    loads = [0.] * n
+    for name in sorted(durations, key=lambda name: (-durations[name], name)):
+        shard = loads.index(min(loads))
+        shards[shard].append(name)
+        loads[shard] += durations[name]
+    return shards
+
+
+def longest_first(items, group, durations):
+    """
+    Reorder `items` so that the groups of items (e.g. the cells of a
+    notebook) with the longest `durations` come first. `group(item)` is the
+    name of the group of an item, or None for the items that are not
+    reordered, which keep their position. The items of a group keep their
+    order, and so do the groups with the same duration.
+    """
+    groups = {}
+    slots = []
+    for item in items:
+        name = group(item)
+        if name is None:
+            slots.append([item])
+        elif name in groups:
+            groups[name].append(item)
+        else:
+            groups[name] = [item]
+            slots.append(name)
+
+    names = [slot for slot in slots if not isinstance(slot, list)]
+    ordered = iter(sorted(names, key=lambda name: -durations.get(name, 0)))
+    result = []
+    for slot in slots:
+        if isinstance(slot, list):
+            result.extend(slot)
+        else:
+            result.extend(groups[next(ordered)])
+    return result
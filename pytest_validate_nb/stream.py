@@ -0,0 +1,115 @@
+"""
+Comparison of the outputs of a cell while they arrive (--nb-stream-compare).
+
+The outputs of an execution are compared with the digest of the reference
+outputs (see plugin.get_output_digest), where the values of every key are
+sanitized and concatenated. Since the outputs only ever append to these
+strings, every new chunk must continue the part of the reference matched so
+far: the first chunk that does not is a mismatch that cannot be undone, and
+the cell can fail right away. Only the position in every reference string
+is kept, so the memory does not grow with the size of the outputs.
+
+"""
+
+import os
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class StreamComparator(object):
+    """
+    Compare the outputs fed one by one with the `reference` digest. As in
+    the comparison of the whole outputs, the keys that are not in the
+    reference are ignored, and the non-string values are compared with the
+    last value of the key.
+
+    After a mismatch, `mismatch` is (key, line number, reference line,
+    test line), where the lines may be None.
+    """
+    def __init__(self, reference, sanitize, skip_compare=()):
+        self.reference = reference
+        self.sanitize = sanitize
+        self.skip_compare = skip_compare
+
+        # Length of the matched part of the reference strings
+        self.positions = {}
+        # Last values of the keys whose reference is not a string
+        self.last = {}
+        self.mismatch = None
+
+    def feed(self, output):
+        """
+        Compare a new output, returning False if it does not match.
+        """
+        for key, value in output.items():
+            if key in self.skip_compare:
+                continue
+            if key == 'data':
+                for data_key, data_value in value.items():
+                    if data_key not in self.skip_compare:
+                        self._feed(data_key, data_value)
+            else:
+                self._feed(key, value)
+        return self.mismatch is None
+
+    def _feed(self, key, value):
+        if self.mismatch is not None or key not in self.reference:
+            return
+        ref = self.reference[key]
+        value = self.sanitize(value)
+        if not isinstance(ref, string_types):
+            self.last[key] = value
+            return
+
+        pos = self.positions.get(key, 0)
+        if not isinstance(value, string_types):
+            self._diverged(key, ref, pos, '')
+        elif ref.startswith(value, pos):
+            self.positions[key] = pos + len(value)
+        else:
+            self._diverged(key, ref, pos, value)
+
+    def _diverged(self, key, ref, pos, chunk):
+        # Position of the first different character, and its line
+        at = pos + len(os.path.commonprefix([ref[pos:pos + len(chunk)],
+                                             chunk]))
+        start = ref.rfind('\n', 0, at) + 1
+        end = ref.find('\n', at)
+        ref_line = ref[start:end if end >= 0 else len(ref)]
+        if at == len(ref):
+            # The output is longer than the reference
+            ref_line = None
+
+        # The test line starts in the matched part of the reference when the
+        # chunk does not start a new line
+        end = chunk.find('\n', at - pos)
+        test_line = (ref[start:pos] +
+                     chunk[max(start - pos, 0):end if end >= 0 else len(chunk)])
+        self.mismatch = (key, ref.count('\n', 0, at) + 1, ref_line, test_line)
+
+    def finish(self):
+        """
+        Check, at the end of the execution, that all the reference outputs
+        were produced. Returns False if the outputs do not match.
+        """
+        for key, ref in self.reference.items():
+            if self.mismatch is not None:
+                break
+            if isinstance(ref, string_types):
+                pos = self.positions.get(key)
+                if pos is None:
+                    self.mismatch = (key, None, None, None)
+                elif pos < len(ref):
+                    # The output is shorter than the reference
+                    self._diverged(key, ref, pos, '')
+                    key, line, ref_line, test_line = self.mismatch
+                    self.mismatch = (key, line, ref_line,
+                                     test_line if test_line else None)
+            elif key not in self.last:
+                self.mismatch = (key, None, None, None)
+            elif self.last[key] != ref:
+                self.mismatch = (key, None, repr(ref), repr(self.last[key]))
+        return self.mismatch is None
@@ -0,0 +1,156 @@
+"""
+Fork-server ("zygote") kernel provider (--nb-zygote).
+
+Starting a kernel means starting a Python process, importing the kernel and,
+in the first cells of most notebooks, importing the same heavy packages again.
+The zygote is a process that imports the kernel and runs a preload cell once;
+every kernel is then a fork of it, so it starts with those modules already
+imported. Each forked kernel gets its own ports and connection file from its
+kernel manager, exactly like a kernel started as a new process.
+
+Only available where os.fork exists (Linux, macOS).
+
+"""
+
+import errno
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+
+class ForkedKernel(object):
+    """
+    Handle of a kernel forked by the zygote, with the subset of the Popen
+    interface used by the kernel manager. The kernel is a child of the
+    zygote (which reaps it), not of this process.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+                self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.poll() is None:
+            if timeout is not None and time.time() > deadline:
+                break
+            time.sleep(0.01)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.poll() is None:
+            os.kill(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+_kernel_manager_class = None
+_kernel_manager_lock = threading.Lock()
+
+
+def get_kernel_manager_class():
+    """
+    Return the class of the kernel managers launching their kernel (also
+    when it is restarted) by forking the zygote instead of starting a new
+    process. It derives from the KernelManager of IPython, which is
+    imported by plugin.import_ipython (with its swap of sys.stdin), so the
+    class is only defined the first time it is needed.
+    """
+    global _kernel_manager_class
+    with _kernel_manager_lock:
+        if _kernel_manager_class is None:
+            from . import plugin
+            plugin.import_ipython()
+
+            class ZygoteKernelManager(plugin.KernelManager):
+                zygote = None
+
+                def _launch_kernel(self, kernel_cmd, **kw):
+                    # kernel_cmd is [python, -m, <kernel module>, -f,
+                    # <connection file>, <extra arguments>]: the forked
+                    # kernel only needs the arguments
+                    return self.zygote.fork(
+                        kernel_cmd[kernel_cmd.index('-f'):])
+
+            _kernel_manager_class = ZygoteKernelManager
+    return _kernel_manager_class
+
+
+class Zygote(object):
+    """
+    Start the zygote process and run the `preload` code in it.
+    """
+    def __init__(self, preload=''):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('--nb-zygote needs os.fork')
+
+        server = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '_zygote_server.py')
+        self.process = subprocess.Popen([sys.executable, server],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True)
+        # Commands and answers must not be mixed between threads
+        self._lock = threading.Lock()
+
+        answer = self._request(preload=preload)
+        if 'error' in answer:
+            self.close()
+            raise RuntimeError('The zygote preload code failed:\n' +
+                               answer['error'])
+
+    def _request(self, **command):
+        with self._lock:
+            self.process.stdin.write(json.dumps(command) + '\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError('The zygote process died')
+        return json.loads(line)
+
+    def fork(self, argv):
+        """ Fork a kernel started with the given arguments. """
+        return ForkedKernel(self._request(fork=argv)['pid'])
+
+    def start_new_kernel(self, startup_timeout=60, **kwargs):
+        """
+        Same as IPython.kernel.manager.start_new_kernel, but forking the
+        kernel from the zygote.
+        """
+        km = get_kernel_manager_class()()
+        km.zygote = self
+        km.start_kernel(**kwargs)
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=startup_timeout)
+        except TypeError:
+            # Older clients do not take a timeout
+            kc.wait_for_ready()
+        except RuntimeError:
+            kc.stop_channels()
+            km.shutdown_kernel()
+            raise
+        return km, kc
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
@@ -1,6 +1,11 @@
 import sys
 sys.path.append('..')
+import os
+import subprocess
 import textwrap
+import threading
+import time
+import pytest
 from pytest_validate_nb.plugin import *
 
 
@@ -22,3 +27,1155 @@ def test_get_sanitize_patterns():
     assert patterns == {'foo': 'bar2',
                        'quux': '42',
                        }
+
+
+def test_sanitizer_keeps_file_order():
+    patterns = get_sanitize_patterns(textwrap.dedent(r"""
+        regex: \d\d:\d\d:\d\d
+        replace: TIMESTAMP
+
+        regex: \d\d:\d\d
+        replace: SHORT-TIMESTAMP
+        """))
+
+    sanitizer = Sanitizer(patterns)
+    assert sanitizer.sanitize('at 12:34:56') == 'at TIMESTAMP'
+    assert sanitizer.sanitize('at 12:34') == 'at SHORT-TIMESTAMP'
+    assert sanitizer.sanitize(42) == 42
+
+
+def test_sanitizer_single_pass():
+    patterns = get_sanitize_patterns(textwrap.dedent(r"""
+        regex: \d\d\d\d-\d\d-\d\d
+        replace: DATESTAMP
+
+        regex: 0x[0-9a-fA-F]+
+        replace: MEMORY_ADDRESS
+        """))
+    text = 'object at 0x7f3a2c on 2015-04-08\n' * 3
+
+    assert Sanitizer(patterns, single_pass=True).merged is not None
+    assert (Sanitizer(patterns, single_pass=True).sanitize(text) ==
+            Sanitizer(patterns).sanitize(text))
+
+    # Patterns with groups are applied one by one
+    patterns['(a)(b)'] = r'\2\1'
+    assert Sanitizer(patterns, single_pass=True).merged is None
+
+
+def test_get_output_digest():
+    sanitizer = Sanitizer({'0x[0-9a-f]+': 'ADDRESS'})
+
+    # Outputs stored in the notebook keep the mime types in 'data'
+    reference = [{'output_type': 'stream', 'name': 'stdout',
+                  'text': 'first\n'},
+                 {'output_type': 'stream', 'name': 'stdout',
+                  'text': 'second\n'},
+                 {'output_type': 'display_data', 'metadata': {},
+                  'data': {'text/plain': '<Figure at 0x7f9ca97cc890>',
+                           'image/png': 'iVBORw0'}}]
+    # Outputs of the execution have them at the top level
+    test = [{'output_type': 'stream', 'stream': 'stdout',
+             'text': 'first\nsecond\n'},
+            {'output_type': 'display_data', 'metadata': {},
+             'text/plain': '<Figure at 0x7f0000000000>',
+             'image/png': 'iVBORw1'}]
+
+    digest = get_output_digest(reference, sanitizer.sanitize)
+    assert digest == {'text': 'first\nsecond\n',
+                      'text/plain': '<Figure at ADDRESS>'}
+    assert get_output_digest(test, sanitizer.sanitize) == digest
+
+
+def test_plugin_does_not_import_ipython():
+    # The plugin is loaded by every py.test run, with or without --ipynb
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    # The modules only needed with notebooks are not imported either
+    modules = ['IPython', 'numpy', 'ijson', 'pstats',
+               'pytest_validate_nb.nbreader']
+    code = ("import sys\n"
+            "import pytest_validate_nb.plugin, pytest_validate_nb.zygote\n"
+            "print([name for name in %r if name in sys.modules])" % modules)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert output.strip() == b'[]'
+
+
+def test_read_notebook_hashes_payloads():
+    import io
+    import json
+    from pytest_validate_nb import nbreader
+
+    nb = {'cells': [{'cell_type': 'markdown', 'metadata': {},
+                     'source': ['# Title\n', 'text']},
+                    {'cell_type': 'code', 'execution_count': 1,
+                     'metadata': {'pytest_validate_nb': {'timeout': 2.5}},
+                     'source': ['plot(x)\n', 'x'],
+                     'outputs': [{'output_type': 'display_data',
+                                  'metadata': {},
+                                  'data': {'image/png': 'iVBORw0\n',
+                                           'text/plain': ['<Figure>']}}]}],
+          'metadata': {}, 'nbformat': 4, 'nbformat_minor': 0}
+    contents = json.dumps(nb, sort_keys=True).encode('utf-8')
+
+    results = [nbreader.read_notebook(io.BytesIO(contents), ['image/png'])]
+    ijson, nbreader.ijson = nbreader.ijson, None
+    try:
+        results.append(nbreader.read_notebook(io.BytesIO(contents),
+                                              ['image/png']))
+    finally:
+        nbreader.ijson = ijson
+
+    for read_nb, digest in results:
+        markdown, code = read_nb['cells']
+        assert markdown['source'] == ''
+        assert code['source'] == 'plot(x)\nx'
+        assert code['metadata']['pytest_validate_nb']['timeout'] == 2.5
+        data = code['outputs'][0]['data']
+        assert data['text/plain'] == '<Figure>'
+        assert data['image/png'].startswith(nbreader.HASH_PREFIX)
+    assert results[0] == results[1]
+
+
+def test_compare_png_identical_payloads():
+    from pytest_validate_nb.images import compare_png, payload_hash
+
+    # Identical images are recognised without decoding them (PIL and
+    # NumPy are not needed)
+    png = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk\n'
+    assert compare_png(png, payload_hash(png)) is None
+    assert compare_png(png, png.rstrip('\n')) is None
+
+
+def test_compare_numbers():
+    from pytest_validate_nb.numeric import compare_numbers, split_numbers
+
+    assert split_numbers('x = [ 1.5  -2.e-03]') == ('x = [ \0 \0]',
+                                                     [1.5, -0.002])
+
+    ref = 'energy: [ 1.00000000e+00   2.50000001e-03]\nconverged: True\n'
+    test = 'energy: [ 1.00000001e+00   2.5e-03]\nconverged: True\n'
+    assert compare_numbers(test, ref, rtol=1e-6) is None
+    assert compare_numbers(test, ref, rtol=1e-9) is not None
+    assert compare_numbers(test.replace('True', 'False'), ref,
+                           rtol=1) is not None
+    assert compare_numbers('nan inf', 'nan inf') is None
+    assert compare_numbers('-inf, 1.5.', '-inf, 1.6.', rtol=0.1) is None
+
+    # Only whole numbers, not the digits of identifiers, hex numbers,
+    # versions or dates
+    for test, ref in [('x1 = 5', 'x2 = 5'), ('step1', 'step2'),
+                      ('0x7f3a', '0x7f3b'), ('version 1.2.3', 'version 1.2.4'),
+                      ('2015-04-08', '2015-04-09'), ('1e5x', '1e6x')]:
+        assert compare_numbers(test, ref, rtol=0.6) is not None
+    assert split_numbers('x1 = 5, y=-2') == ('x1 = \0, y=\0', [5, -2])
+
+
+def test_unified_diff():
+    from pytest_validate_nb.diff import unified_diff
+
+    ref = '\n'.join('line %d' % i for i in range(100))
+    lines = ref.split('\n')
+    lines[10] = 'changed'
+    del lines[50]
+    test = '\n'.join(lines)
+
+    assert unified_diff(ref, test) == [
+        '@@ -8,7 +8,7 @@',
+        ' line 7', ' line 8', ' line 9',
+        '-line 10', '+changed',
+        ' line 11', ' line 12', ' line 13',
+        '@@ -48,7 +48,6 @@',
+        ' line 47', ' line 48', ' line 49',
+        '-line 50',
+        ' line 51', ' line 52', ' line 53']
+    assert unified_diff(ref, ref) == []
+
+    capped = unified_diff(ref, test, max_lines=4)
+    assert capped[:4] == ['@@ -8,7 +8,7 @@', ' line 7', ' line 8', ' line 9']
+    assert capped[4] == '... (13 more lines of the diff omitted)'
+
+
+def test_stream_comparator():
+    from pytest_validate_nb.stream import StreamComparator
+
+    reference = {'text': 'line 0\nline 1\nline 2\n', 'text/plain': '42'}
+
+    comparator = StreamComparator(reference, lambda s: s, SKIP_COMPARE)
+    assert comparator.feed({'output_type': 'stream', 'text': 'line 0\nli'})
+    assert comparator.feed({'output_type': 'stream', 'text': 'ne 1\n'})
+    assert not comparator.finish()
+    assert comparator.mismatch == ('text', 3, 'line 2', None)
+
+    comparator = StreamComparator(reference, lambda s: s, SKIP_COMPARE)
+    assert comparator.feed({'output_type': 'stream', 'text': 'line 0\nli'})
+    assert not comparator.feed({'output_type': 'stream',
+                                'text': 'ne 1\nline 3\nline 4\n'})
+    assert comparator.mismatch == ('text', 3, 'line 2', 'line 3')
+
+    comparator = StreamComparator(reference, lambda s: s, SKIP_COMPARE)
+    assert comparator.feed({'output_type': 'stream',
+                            'text': 'line 0\nline 1\nline 2\n'})
+    assert not comparator.finish()
+    assert comparator.mismatch == ('text/plain', None, None, None)
+
+    comparator = StreamComparator(reference, lambda s: s, SKIP_COMPARE)
+    for chunk in ('line 0\n', 'line 1\nline ', '2\n'):
+        assert comparator.feed({'output_type': 'stream', 'text': chunk})
+    assert comparator.feed({'output_type': 'execute_result',
+                            'text/plain': '42'})
+    assert comparator.finish()
+
+
+def test_update_notebook(tmpdir):
+    import json
+    from pytest_validate_nb.nbwriter import update_notebook
+
+    nb = {'cells': [{'cell_type': 'code', 'execution_count': 1,
+                     'id': 'a1b2', 'metadata': {'tags': ['x']},
+                     'source': ['print(1)\n', u'print("caf\xe9")'],
+                     'outputs': []}],
+          'metadata': {}, 'nbformat': 4, 'nbformat_minor': 5}
+    fname = tmpdir.join('nb.ipynb')
+    fname.write(json.dumps(nb))
+
+    def update(nb):
+        nb['cells'][0]['metadata']['pytest_validate_nb'] = {'x': 1}
+        return True
+
+    assert update_notebook(str(fname), update)
+    assert not update_notebook(str(fname), lambda nb: False)
+    assert tmpdir.listdir() == [fname]
+
+    contents = fname.read_text('utf-8')
+    assert contents.startswith('{\n "cells": [\n')
+    assert contents.endswith('}\n')
+    nb['cells'][0]['metadata']['pytest_validate_nb'] = {'x': 1}
+    assert json.loads(contents) == nb
+
+
+def test_nbformat_outputs():
+    from pytest_validate_nb.nbwriter import nbformat_outputs
+
+    outs = [{'output_type': 'stream', 'stream': 'stdout', 'text': 'a\n'},
+            {'output_type': 'stream', 'stream': 'stdout', 'text': 'b\nc'},
+            {'output_type': 'execute_result', 'metadata': {},
+             'text/plain': '42', 'image/png': 'iVBORw0'}]
+    reply = {'status': 'error', 'execution_count': 3, 'ename': 'ValueError',
+             'evalue': 'x', 'traceback': ['line']}
+
+    assert nbformat_outputs(outs, reply) == [
+        {'output_type': 'stream', 'name': 'stdout',
+         'text': ['a\n', 'b\n', 'c']},
+        {'output_type': 'execute_result', 'execution_count': 3,
+         'metadata': {}, 'data': {'text/plain': ['42'],
+                                  'image/png': 'iVBORw0'}},
+        {'output_type': 'error', 'ename': 'ValueError', 'evalue': 'x',
+         'traceback': ['line']}]
+    assert nbformat_outputs(outs + [{'output_type': 'clear_output'}],
+                            {'status': 'ok'}) == []
+
+
+def test_assign_shards():
+    from pytest_validate_nb.schedule import (parse_shard, estimate_durations,
+                                             assign_shards)
+
+    assert parse_shard('2/3') == (2, 3)
+    for value in ('0/2', '3/2', '1', 'a/b'):
+        with pytest.raises(Exception):
+            parse_shard(value)
+
+    # 'c' and 'd' have no history: 2 and 1 cells at 3s per cell
+    durations = estimate_durations({'a': 10, 'b': 2, 'c': 2, 'd': 1},
+                                   {'a': 30., 'b': 6., 'x': 100.})
+    assert durations == {'a': 30., 'b': 6., 'c': 6., 'd': 3.}
+    assert estimate_durations({'a': 4}, {}) == {'a': 4.}
+
+    durations = {'a': 8., 'b': 7., 'c': 6., 'd': 5., 'e': 4., 'f': 2.}
+    shards = assign_shards(durations, 2)
+    assert shards == [['a', 'd', 'e'], ['b', 'c', 'f']]
+    assert sorted(sum(shards, [])) == sorted(durations)
+    assert assign_shards(durations, 4)[2:] == [['c', 'f'], ['d', 'e']]
+
+
+def test_longest_first():
+    from pytest_validate_nb.schedule import longest_first
+
+    items = ['a0', 'test_x', 'a1', 'b0', 'c0', 'c1', 'test_y']
+    group = lambda item: None if item.startswith('test') else item[0]
+    assert longest_first(items, group, {'a': 1., 'b': 5., 'c': 5.}) == [
+        'b0', 'test_x', 'c0', 'c1', 'a0', 'a1', 'test_y']
+
+
+class FakeKernel(RunningKernel):
+    """ Kernel that only counts what the KernelPool does with it. """
+    def __init__(self, rss=0):
+        self.uses = 0
+        self.restarts = 0
+        self.snapshots = 0
+        self.stopped = False
+        self.leaked = False
+        self._rss = rss
+
+    def rss(self):
+        return self._rss
+
+    def restart(self):
+        self.restarts += 1
+        self.leaked = False
+
+    def snapshot(self):
+        self.snapshots += 1
+
+    def reset_namespace(self):
+        if self.leaked:
+            raise RuntimeError('the notebook left 1 threads')
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakeKernelPool(KernelPool):
+    def __init__(self, size, rss=0, **kwargs):
+        self.started = []
+        self.rss = rss
+        super(FakeKernelPool, self).__init__(size, **kwargs)
+
+    def _new_kernel(self):
+        kernel = FakeKernel(self.rss)
+        if self.recycle == 'reset':
+            kernel.snapshot()
+        self.started.append(kernel)
+        return kernel
+
+
+def test_kernel_pool_recycles_kernels():
+    pool = FakeKernelPool(1, max_uses=2)
+    kernel = pool.acquire()
+    pool.release(kernel)
+    assert pool.acquire() is kernel
+    assert kernel.restarts == 1
+
+    # Discarded after max_uses notebooks
+    pool.release(kernel)
+    new_kernel = pool.acquire()
+    assert new_kernel is not kernel
+    assert kernel.stopped and kernel.restarts == 1
+    assert len(pool.started) == 2
+
+    pool.release(new_kernel)
+    pool.close()
+    assert new_kernel.stopped
+
+    # Discarded when its memory is above max_rss (in MB)
+    pool = FakeKernelPool(1, rss=2 * 1024 ** 2, max_rss=1.5)
+    kernel = pool.acquire()
+    pool.release(kernel)
+    assert pool.acquire() is not kernel and kernel.stopped
+    pool.close()
+
+    pool = FakeKernelPool(1, recycle='discard')
+    kernel = pool.acquire()
+    pool.release(kernel)
+    assert pool.acquire() is not kernel and kernel.stopped
+    pool.close()
+
+
+def test_kernel_pool_reset():
+    pool = FakeKernelPool(1, recycle='reset')
+    kernel = pool.acquire()
+    assert kernel.snapshots == 1
+
+    # The namespace is reset without restarting the kernel
+    pool.release(kernel)
+    assert pool.acquire() is kernel
+    assert kernel.restarts == 0
+
+    # Restarted (and its fresh state remembered again) after a leak
+    kernel.leaked = True
+    pool.release(kernel)
+    assert pool.acquire() is kernel
+    assert kernel.restarts == 1 and kernel.snapshots == 2
+    pool.close()
+
+
+def test_kernel_pool_start_error():
+    class FailingPool(FakeKernelPool):
+        failures = 1
+
+        def _new_kernel(self):
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError('no kernel')
+            return super(FailingPool, self)._new_kernel()
+
+    pool = FailingPool(1)
+    # The error is raised by acquire(), and another kernel is started
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    assert isinstance(pool.acquire(), FakeKernel)
+    pool.close()
+
+
+class FakeCell(object):
+    """ Cell returning `outs`, or raising `error`, when executed. """
+    def __init__(self, name, outs=None, error=None, stops=False):
+        self.name = name
+        self.outs = outs
+        self.error = error
+        self.stops = stops
+        self.executed = False
+
+    def execute(self):
+        self.executed = True
+        if self.error is not None:
+            raise self.error
+        return self.outs
+
+    def must_stop(self):
+        return self.stops
+
+    def stop_reason(self):
+        return 'cell %s raised an error' % self.name
+
+
+class FakeNotebook(object):
+    """ IPyNbFile executed in the background without a kernel. """
+    run_in_background = IPyNbFile.__dict__['run_in_background']
+
+    def __init__(self, cells):
+        self.cells = cells
+        self.kernel = None
+        self.skip_reason = None
+        self.stopped = False
+
+    def start_kernel(self):
+        return 'kernel'
+
+    def submit_cells(self):
+        pass
+
+    def stop_kernel(self):
+        self.stopped = True
+
+
+def test_notebook_run_results():
+    # Cells with the same name (and node id) are different cells
+    cells = [FakeCell('cell'), FakeCell('cell')]
+    run = NotebookRun(cells)
+    error = RuntimeError('kernel died')
+
+    def work():
+        run.set_result(cells[1], error=error)
+        run.set_result(cells[0], outs=['first'])
+        run.finish()
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    assert run.get_result(cells[0]) == ['first']
+    with pytest.raises(RuntimeError) as excinfo:
+        run.get_result(cells[1])
+    assert excinfo.value is error
+    thread.join()
+
+    # The cells that were not executed are skipped
+    with pytest.raises(pytest.skip.Exception):
+        run.get_result(FakeCell('cell'))
+
+
+def test_notebook_scheduler():
+    error = ValueError('x')
+    cells = [FakeCell(0, outs=['0']), FakeCell(1, error=error),
+             FakeCell(2, outs=['2'], stops=True), FakeCell(3, outs=['3'])]
+    nbfile = FakeNotebook(cells)
+    other = FakeNotebook([FakeCell(0, outs=['other'])])
+
+    scheduler = NotebookScheduler(2)
+    scheduler.submit(nbfile, cells)
+    scheduler.submit(other, other.cells)
+    scheduler.start()
+
+    run = nbfile.background
+    assert run.get_result(cells[0]) == ['0']
+    with pytest.raises(ValueError):
+        run.get_result(cells[1])
+    assert run.get_result(cells[2]) == ['2']
+    # The cells after the error are skipped with its description
+    with pytest.raises(pytest.skip.Exception) as excinfo:
+        run.get_result(cells[3])
+    assert 'cell 2 raised an error' in str(excinfo.value)
+    assert not cells[3].executed
+    run.wait()
+    assert nbfile.stopped and nbfile.skip_reason == run.skip_reason
+    assert other.background.get_result(other.cells[0]) == ['other']
+
+    scheduler.close()
+    assert not any(thread.is_alive() for thread in scheduler._threads)
+
+
+def test_notebook_scheduler_cancelled():
+    cells = [FakeCell(0, outs=['0'])]
+    nbfile = FakeNotebook(cells)
+    scheduler = NotebookScheduler(1)
+    scheduler.submit(nbfile, cells)
+    # Closed before the workers started (e.g. after -x): nothing runs
+    scheduler.close()
+    scheduler.start()
+    nbfile.background.wait()
+    assert not cells[0].executed
+    with pytest.raises(pytest.skip.Exception):
+        nbfile.background.get_result(cells[0])
+    for thread in scheduler._threads:
+        thread.join()
+
+
+def test_message_router():
+    try:
+        from Queue import Queue
+    except ImportError:
+        from queue import Queue
+    channel = Queue()
+
+    def get_message(timeout=None):
+        return channel.get(timeout=timeout)
+
+    def message(msg_id, n):
+        return {'parent_header': {'msg_id': msg_id}, 'n': n}
+
+    def wait_orphan(msg_id):
+        for i in range(1000):
+            with router._lock:
+                if msg_id in router._orphans:
+                    return
+            time.sleep(0.01)
+        raise AssertionError('%s was not read' % msg_id)
+
+    router = MessageRouter(get_message)
+    try:
+        # Messages arriving before their request is expected are adopted
+        channel.put(message('a', 1))
+        wait_orphan('a')
+        router.expect('a')
+        channel.put(message('b', 1))
+        channel.put(message('a', 2))
+        assert router.get('a', timeout=5)['n'] == 1
+        assert router.get('a', timeout=5)['n'] == 2
+        wait_orphan('b')
+
+        # Discarded requests are not kept anymore
+        router.discard('a')
+        with pytest.raises(KeyError):
+            router.get('a', timeout=0)
+        channel.put(message('a', 3))
+        wait_orphan('a')
+
+        # Only the latest orphans are kept
+        router.max_orphans = 2
+        channel.put(message('c', 1))
+        wait_orphan('c')
+        assert sorted(router._orphans) == ['a', 'c']
+        router.expect('b')
+        with pytest.raises(Empty):
+            router.get('b', timeout=0.1)
+    finally:
+        router.stop()
+
+
+def test_can_pipeline():
+    class Client(object):
+        def execute(self, code, silent=False, store_history=True,
+                    user_expressions=None, allow_stdin=None):
+            pass
+
+    class RecentClient(object):
+        def execute(self, code, silent=False, store_history=True,
+                    user_expressions=None, allow_stdin=None,
+                    stop_on_error=True):
+            pass
+
+    def blocking(method):
+        def wrapped(self, *args, **kwargs):
+            return method(self, *args, **kwargs)
+        return wrapped
+
+    class BlockingClient(RecentClient):
+        execute = blocking(RecentClient.__dict__['execute'])
+
+    class OldBlockingClient(Client):
+        execute = blocking(Client.__dict__['execute'])
+
+    kernel = RunningKernel.__new__(RunningKernel)
+    for client, expected in ((Client, False), (RecentClient, True),
+                             (BlockingClient, True),
+                             (OldBlockingClient, False)):
+        kernel.kc = client()
+        assert kernel.can_pipeline() == expected
+
+
+def test_result_cache_key(tmpdir):
+    from pytest_validate_nb.cache import ResultCache
+    from pytest_validate_nb.images import payload_hash
+
+    png = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk\n'
+    outputs = [{'output_type': 'display_data', 'metadata': {},
+                'data': {'image/png': png, 'text/plain': '<Figure>'}}]
+    hashes = get_image_hashes(outputs)
+    assert hashes == [payload_hash(png)]
+    # The same hashes when the notebook was read with the images hashed
+    outputs[0]['data']['image/png'] = hashes[0]
+    assert get_image_hashes(outputs) == hashes
+
+    cache = ResultCache(str(tmpdir))
+    cells = [('x = 1', {'text/plain': '1'}, {}, [])]
+    options = {'options': {'nb_rtol': None}, 'metadata': {}}
+    key = cache.get_key(cells, 'patterns', options)
+    assert key == cache.get_key(list(cells), 'patterns', dict(options))
+
+    different = [
+        ([('x = 1', {'text/plain': '1'}, {}, hashes)], options),
+        ([('x = 1', {'text/plain': '1'}, {'rtol': 1e-2}, [])], options),
+        (cells, {'options': {'nb_rtol': 1e-2}, 'metadata': {}}),
+        (cells, {'options': {'nb_rtol': None}, 'metadata': {'atol': 1}})]
+    for other_cells, other_options in different:
+        assert cache.get_key(other_cells, 'patterns', other_options) != key
+
+
+def test_read_notebook_large_payload():
+    import io
+    import json
+    from pytest_validate_nb import nbreader
+
+    # A single string of 16 MB, as the images are often stored
+    png = 'iVBORw0K' * (2 << 20)
+    nb = {'cells': [{'cell_type': 'code', 'execution_count': 1,
+                     'metadata': {}, 'source': 'plot()',
+                     'outputs': [{'output_type': 'display_data',
+                                  'metadata': {},
+                                  'data': {'image/png': png}}]}],
+          'metadata': {}, 'nbformat': 4, 'nbformat_minor': 0}
+    contents = json.dumps(nb).encode('utf-8')
+
+    start = time.time()
+    json.loads(contents.decode('utf-8'))
+    json_time = time.time() - start
+
+    start = time.time()
+    read_nb, digest = nbreader.read_notebook(io.BytesIO(contents),
+                                             ['image/png'])
+    elapsed = time.time() - start
+    assert read_nb['cells'][0]['outputs'][0]['data']['image/png'] == (
+        nbreader.HASH_PREFIX + nbreader.hash_strings(png).hexdigest())
+    # In a time comparable to json
+    assert elapsed < 10 * json_time + 1
+
+    # The payload is hashed in blocks, and never reaches ijson
+    chunks = list(nbreader.filter_payloads(io.BytesIO(contents),
+                                           ['image/png']))
+    assert max(len(chunk) for chunk in chunks) <= 2 * nbreader.MIN_BUF_SIZE
+    filtered = json.loads(b''.join(chunks).decode('utf-8'))
+    assert filtered['cells'][0]['outputs'] == read_nb['cells'][0]['outputs']
+
+    f = io.BytesIO(contents)
+    assert nbreader.read_cell(f, 0)['outputs'][0]['data']['image/png'] == png
+
+
+def test_filter_payloads():
+    import io
+    import json
+    from pytest_validate_nb import nbreader
+
+    # Escape sequences (e.g. the newlines of older images, or a surrogate
+    # pair), and a key in a string, cut by blocks of every size
+    png = u'iVBO\nRw0K\n\\n"\u00e9\U0001f600/' * 10
+    nb = {'cells': [{'source': u'"image/png": "%s"' % png, 'outputs': [
+        {'data': {'image/png': png, 'text/plain': png}},
+        {'data': {'image/png': 'short'}},
+        {'data': {'image/png': [png, png]}}]}]}
+    hashed = nbreader.HASH_PREFIX + nbreader.hash_strings(png).hexdigest()
+    expected = json.loads(json.dumps(nb))
+    expected['cells'][0]['outputs'][0]['data']['image/png'] = hashed
+
+    for ensure_ascii in (True, False):
+        contents = json.dumps(nb, ensure_ascii=ensure_ascii).encode('utf-8')
+        for block_size in (1, 2, 5, 13, 64, 1 << 16):
+            chunks = nbreader.filter_payloads(io.BytesIO(contents),
+                                              ['image/png'], 100, block_size)
+            filtered = b''.join(chunks).decode('utf-8')
+            assert json.loads(filtered) == expected
+
+
+def test_compare_png_nearly_uniform():
+    pytest.importorskip('PIL')
+    numpy = pytest.importorskip('numpy')
+    import base64
+    import io
+    from PIL import Image
+    from pytest_validate_nb.images import (compare_png, decode_png, dhash,
+                                           hash_distance)
+
+    def encode(pixels):
+        f = io.BytesIO()
+        Image.fromarray(pixels.astype(numpy.uint8)).save(f, 'PNG')
+        return base64.b64encode(f.getvalue()).decode('ascii')
+
+    # A flat image, and one whose columns of 10 pixels alternate between
+    # two levels: at the scale of the dHash they look like stripes
+    ref = numpy.full((80, 90), 200)
+    test = ref + (numpy.arange(90) // 10 % 2 == 0)
+    test, ref = encode(test), encode(ref)
+    distance = hash_distance(dhash(decode_png(test)), dhash(decode_png(ref)))
+    assert distance > 16
+
+    # The tolerances decide, unless a hash distance is given
+    assert compare_png(test, ref, pixel_tol=1) is None
+    assert compare_png(test, ref) is not None
+    assert compare_png(test, ref, pixel_tol=1,
+                       max_hash_distance=16) is not None
+
+
+class FakeOptions(object):
+    sanitize_with = None
+    sanitize_single_pass = False
+    nb_compare_images = True
+    nb_update_references = False
+
+
+class FakeConfig(object):
+    option = FakeOptions()
+
+
+class FakeCheckedCell(object):
+    """ IPyNbCell checking outputs without a kernel nor a notebook. """
+    check_outputs = IPyNbCell.__dict__['check_outputs']
+    sanitize = IPyNbCell.__dict__['sanitize']
+
+    def __init__(self, streamed, images_match):
+        self.config = FakeConfig()
+        self.parent = object()
+        self.streamed = streamed
+        self.images_match = images_match
+        self.compared = []
+        self.comparisons = []
+        self.cell_num = 0
+        self.cell = FakeCell('plot()')
+        self.cell.source = 'plot()'
+        self.reference = {}
+        self.timings = {}
+
+    def get_option(self, name, default=None):
+        return default
+
+    def compare_outputs(self, outs, reference):
+        self.compared.append('text')
+        return True
+
+    def compare_images(self, outs):
+        self.compared.append('images')
+        return self.images_match
+
+
+def test_check_outputs_streamed_images():
+    outs = [{'output_type': 'display_data', 'image/png': 'iVBORw1'}]
+
+    # The images are still compared when the text was streamed
+    cell = FakeCheckedCell(streamed=True, images_match=False)
+    with pytest.raises(NbCellError):
+        cell.check_outputs(outs)
+    assert cell.compared == ['images']
+
+    cell = FakeCheckedCell(streamed=True, images_match=True)
+    cell.check_outputs(outs)
+    assert cell.compared == ['images']
+
+    cell = FakeCheckedCell(streamed=False, images_match=True)
+    cell.check_outputs(outs)
+    assert cell.compared == ['text', 'images']
+
+
+def test_sanitize_before_notebook_setup():
+    # With --nb-workers the outputs are streamed and sanitized before the
+    # setup of the notebook (which has no sanitizer yet)
+    cell = FakeCheckedCell(streamed=True, images_match=True)
+    assert cell.sanitize('text') == 'text'
+    assert 'sanitize' in cell.timings
+
+
+def test_get_process_rss():
+    if get_psutil() is None and not os.path.exists('/proc/self/statm'):
+        pytest.skip('needs psutil or /proc')
+    assert get_process_rss(os.getpid()) > 0
+    assert get_process_rss(None) is None
+
+
+def test_shards_do_not_depend_on_the_node():
+    from pytest_validate_nb.schedule import record_history
+
+    class Cache(dict):
+        def set(self, key, value):
+            self[key] = value
+
+        def get(self, key, default=None):
+            return dict.get(self, key, default)
+
+    class Options(object):
+        ipynb = True
+        nb_order = 'file'
+        nb_workers = 1
+        nb_shard_durations = None
+
+    class Hook(object):
+        def pytest_deselected(self, items):
+            pass
+
+    class Config(object):
+        hook = Hook()
+
+        def __init__(self, shard, cache):
+            self.option = Options()
+            self.option.nb_shard = shard
+            self.cache = cache
+
+    class Notebook(object):
+        def __init__(self, nodeid):
+            self.nodeid = nodeid
+            self.ncells = 2
+
+    def collect():
+        items = []
+        for name in 'abcdef':
+            notebook = Notebook(name + '.ipynb')
+            for i in range(notebook.ncells):
+                item = IPyNbCell.__new__(IPyNbCell)
+                item.parent = notebook
+                items.append(item)
+        return items
+
+    # Every node only recorded the notebooks it ran in its cache
+    caches = []
+    for durations in ({'a': 40., 'c': 10.}, {'b': 40., 'd': 10.}):
+        caches.append(Cache())
+        record_history(caches[-1], [{'notebook': name + '.ipynb',
+                                     'total': total, 'complete': True}
+                                    for name, total in durations.items()])
+
+    shards = []
+    for node, cache in enumerate(caches):
+        items = collect()
+        pytest_collection_modifyitems(None, Config((node + 1, 2), cache),
+                                      items)
+        shards.append(set(item.parent.nodeid for item in items))
+    assert not shards[0] & shards[1]
+    assert shards[0] | shards[1] == set(name + '.ipynb' for name in 'abcdef')
+
+
+def test_measured_cells_are_not_pipelined():
+    class Options(object):
+        nb_pipeline = True
+        nb_record_baseline = False
+
+    class Config(object):
+        option = Options()
+
+    class Kernel(object):
+        def __init__(self):
+            self.sent = []
+
+        def can_pipeline(self):
+            return True
+
+        def start_router(self):
+            pass
+
+        def execute_cell_input(self, source, **kwargs):
+            self.sent.append(source)
+            return source
+
+    class Node(object):
+        def __init__(self, options):
+            self.source = 'x = 1'
+            self.metadata = {METADATA_KEY: options}
+
+    class Cell(object):
+        measures_itself = IPyNbCell.__dict__['measures_itself']
+        time_budget = IPyNbCell.__dict__['time_budget']
+        get_option = IPyNbCell.__dict__['get_option']
+
+        def __init__(self, notebook, options):
+            self.config = notebook.config
+            self.parent = notebook
+            self.cell = Node(options)
+            self.msg_id = None
+
+        def uses_helpers(self):
+            return False
+
+    class Notebook(object):
+        submit_cells = IPyNbFile.__dict__['submit_cells']
+
+        def __init__(self, *options):
+            self.config = Config()
+            self.kernel = Kernel()
+            self.nb = Node({})
+            self.selected_cells = [Cell(self, cell_options)
+                                   for cell_options in options]
+
+    def sent(*options):
+        notebook = Notebook(*options)
+        notebook.submit_cells()
+        return len(notebook.kernel.sent)
+
+    assert sent({}, {}) == 2
+    # Without a baseline, the ratio is not a budget
+    assert sent({}, {'max_time_ratio': 2}) == 2
+    assert sent({}, {'max_time': 1}) == 0
+    assert sent({}, {'max_time_ratio': 2, 'baseline_time': 0.5}) == 0
+    assert sent({}, {'max_rss_growth': 100}) == 0
+    Options.nb_record_baseline = True
+    try:
+        assert sent({}, {}) == 0
+    finally:
+        Options.nb_record_baseline = False
+
+
+def test_durations(tmpdir):
+    import json
+    from pytest_validate_nb.durations import Durations
+
+    class Cell(object):
+        def __init__(self, num, timings):
+            self.cell_num = self.index = num
+            self.timings = timings
+
+    class Notebook(object):
+        cached_pass = False
+        skip_reason = None
+        background = None
+
+        def __init__(self, nodeid, ncells, cells, **timings):
+            self.nodeid = nodeid
+            self.ncells = ncells
+            self.selected_cells = cells
+            self.timings = timings
+
+    durations = Durations()
+    durations.add(Notebook('fast.ipynb', 1,
+                           [Cell(0, {'execute': 0.1, 'drain': 0.})],
+                           setup=0.5, teardown=0.1, read=1.))
+    durations.add(Notebook('slow.ipynb', 3,
+                           [Cell(0, {'execute': 2., 'drain': 0.5,
+                                     'compare': 0.5, 'messages': 4,
+                                     'rss_growth': 2 * 1024 ** 2}),
+                            Cell(1, {'execute': 1.})],
+                           setup=1., teardown=0.))
+    skipped = Notebook('skipped.ipynb', 2, None)
+    skipped.skip_reason = 'cell 1 raised an error'
+    durations.add(skipped)
+
+    fast, slow, skipped = durations.records()
+    # The time to read the notebook (at collection) is not part of it
+    assert fast['total'] == pytest.approx(0.7)
+    assert fast['complete'] and fast['read'] == 1.
+    assert slow['total'] == pytest.approx(5.)
+    # Only 2 of its 3 cells ran
+    assert not slow['complete']
+    assert [cell['cell'] for cell in slow['cells']] == [0, 1]
+    assert skipped['total'] == 0 and skipped['cells'] == []
+    assert not skipped['complete']
+
+    lines = durations.summary(1)
+    assert len(lines) == 5
+    assert lines[1].split()[0] == '5.000s'
+    assert lines[1].endswith('slow.ipynb')
+    assert lines[4].split()[:4] == ['2.000s', '0.500s', '0.000s', '0.500s']
+    assert '2.0MB' in lines[4]
+    assert lines[4].endswith('slow.ipynb::cell 0')
+    # 2 headers, a blank line, 3 notebooks and 3 cells
+    assert len(durations.summary()) == 9
+
+    fname = str(tmpdir.join('durations.json'))
+    durations.write_json(fname)
+    with open(fname) as f:
+        written = json.load(f)
+    assert written['version'] == 1
+    assert written['notebooks'] == json.loads(
+        json.dumps(durations.records()))
+
+
+def test_load_profile(tmpdir):
+    import cProfile
+
+    def profiled_function():
+        return sum(range(1000))
+
+    fnames = []
+    for i in range(2):
+        profile = cProfile.Profile()
+        profile.runcall(profiled_function)
+        fnames.append(str(tmpdir.join('cell%d.pstats' % i)))
+        profile.dump_stats(fnames[-1])
+    # An empty file (nothing was profiled) and a missing one are skipped
+    tmpdir.join('empty.pstats').write('')
+    others = [str(tmpdir.join('empty.pstats')),
+              str(tmpdir.join('missing.pstats'))]
+
+    stats = load_profile(fnames + others)
+    calls = [value[1] for key, value in stats.stats.items()
+             if key[2] == 'profiled_function']
+    assert calls == [2]
+    assert load_profile(others) is None
+
+    summary = format_profile(fnames[0], 5)
+    assert 'profiled_function' in summary
+    assert summary.endswith('Full profile: %s' % fnames[0])
+    assert format_profile(others[1], 5) == 'Nothing was profiled in the kernel'
+
+
+class FakeNode(object):
+    """ Notebook or cell with the plugin `options` in its metadata. """
+    def __init__(self, options):
+        self.source = 'x = 1'
+        self.metadata = {METADATA_KEY: options}
+
+
+class FakeMeasuredCell(object):
+    """ IPyNbCell with the options of its metadata and its timings. """
+    get_option = IPyNbCell.__dict__['get_option']
+
+    def __init__(self, options, timings, notebook_options=None):
+        self.cell_num = 1
+        self.cell = FakeNode(options)
+        self.parent = FakeMeasuredCell.Parent()
+        self.parent.nb = FakeNode(notebook_options or {})
+        self.timings = timings
+
+    class Parent(object):
+        nodeid = 'notebook.ipynb'
+
+
+def test_check_memory():
+    MB = 1024 ** 2
+
+    class Cell(FakeMeasuredCell):
+        check_memory = IPyNbCell.__dict__['check_memory']
+
+    def check(options, peak_rss_before=None, notebook_options=None,
+              **timings):
+        cell = Cell(options, timings, notebook_options)
+        cell.peak_rss_before = peak_rss_before
+        try:
+            cell.check_memory()
+        except NbCellError as e:
+            return str(e)
+        return None
+
+    assert check({'max_rss_growth': 10}, rss_growth=5 * MB) is None
+    error = check({'max_rss_growth': 10}, rss_growth=20 * MB)
+    assert 'growth of the resident memory' in error
+    assert '20.0 MB, above the limit of 10 MB' in error
+    # The limits of the notebook apply to all its cells
+    assert check({}, notebook_options={'max_traced_peak': 1},
+                 traced_peak=2 * MB) is not None
+    # Nothing to check without a measure (e.g. no psutil nor /proc)
+    assert check({'max_rss_growth': 10}) is None
+
+    # Only the cell going over the peak fails, not the ones after it
+    assert check({'max_peak_rss': 100}, peak_rss_before=50 * MB,
+                 peak_rss=150 * MB) is not None
+    assert check({'max_peak_rss': 100}, peak_rss_before=150 * MB,
+                 peak_rss=150 * MB) is None
+    assert check({'max_peak_rss': 100}, peak_rss_before=None,
+                 peak_rss=150 * MB) is not None
+
+
+def test_time_budget():
+    class Options(object):
+        nb_record_baseline = False
+        nb_budget_action = 'fail'
+
+    class Config(object):
+        option = Options()
+
+    class Cell(FakeMeasuredCell):
+        time_budget = IPyNbCell.__dict__['time_budget']
+        check_time = IPyNbCell.__dict__['check_time']
+        wall_time = IPyNbCell.__dict__['wall_time']
+        config = Config()
+
+    def budget(options):
+        return Cell(options, {}).time_budget()[0]
+
+    assert budget({}) is None
+    assert budget({'max_time': 2}) == 2.
+    # A ratio is only a budget with a baseline
+    assert budget({'max_time_ratio': 1.5}) is None
+    assert budget({'max_time_ratio': 1.5, 'baseline_time': 2.}) == 3.
+    # The smallest budget applies
+    assert budget({'max_time': 2, 'max_time_ratio': 1.5,
+                   'baseline_time': 1.}) == 1.5
+    assert budget({'max_time': 2, 'max_time_ratio': 1.5,
+                   'baseline_time': 4.}) == 2.
+
+    options = {'max_time': 2}
+    Cell(options, {'execute': 1.5, 'drain': 0.1}).check_time()
+    # Not finished (e.g. timed out): nothing to check
+    Cell(options, {'execute': 5.}).check_time()
+    with pytest.raises(NbCellError) as excinfo:
+        Cell(options, {'execute': 1.5, 'drain': 1.}).check_time()
+    assert 'cell took 2.500s, above its time budget of 2.000s' in str(
+        excinfo.value)
+
+    with pytest.warns(UserWarning) as record:
+        Cell(dict(options, budget_action='warn'),
+             {'execute': 1.5, 'drain': 1.}).check_time()
+    assert 'notebook.ipynb::cell 1' in str(record[0].message)
+
+    # The budgets are not checked while the baselines are recorded
+    Options.nb_record_baseline = True
+    try:
+        Cell(options, {'execute': 1.5, 'drain': 1.}).check_time()
+    finally:
+        Options.nb_record_baseline = False
+
+
+def test_cached_references():
+    import io
+    from pytest_validate_nb.nbreader import read_notebook
+
+    class Cache(dict):
+        def set(self, key, value):
+            self[key] = value
+
+    class Config(object):
+        cache = Cache()
+
+    class Notebook(object):
+        references_cache_key = IPyNbFile.__dict__['references_cache_key']
+        load_references = IPyNbFile.__dict__['load_references']
+        store_references = IPyNbFile.__dict__['store_references']
+
+        def __init__(self, fspath, config=Config()):
+            self.fspath = fspath
+            self.config = config
+
+    def key(contents, patterns):
+        digest = read_notebook(io.BytesIO(contents))[1]
+        return digest + Sanitizer(patterns).fingerprint
+
+    contents = b'{"cells": [], "metadata": {}, "nbformat": 4}'
+    patterns = {'0x[0-9a-f]+': 'ADDRESS'}
+    references = {'0': {'text/plain': '<Figure at ADDRESS>'}}
+    notebook = Notebook('/a/notebook.ipynb')
+    assert notebook.load_references(key(contents, patterns)) is None
+    notebook.store_references(key(contents, patterns), references)
+    assert notebook.load_references(key(contents, patterns)) == references
+
+    # Other contents or sanitize patterns invalidate the references, and
+    # every notebook has its own
+    changed = contents.replace(b'{}', b'{"kernelspec": {}}')
+    assert notebook.load_references(key(changed, patterns)) is None
+    assert notebook.load_references(key(contents, {})) is None
+    assert Notebook('/b/notebook.ipynb').load_references(
+        key(contents, patterns)) is None
+    # Without the cache provider of pytest
+    notebook = Notebook('/a/notebook.ipynb', config=object())
+    notebook.store_references(key(contents, patterns), references)
+    assert notebook.load_references(key(contents, patterns)) is None